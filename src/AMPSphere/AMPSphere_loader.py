@@ -1,20 +1,211 @@
 """
 This module goes through the big fat AMPSphere predictions
 and critically extracts all potential amps.
+The file is read in chunks of the needed columns only, filtered with vectorized masks
+and sorted with an external merge of the sorted chunks, so memory stays bounded.
 """
+import argparse
+import csv
+import heapq
+import io
+import math
+import tempfile
+import time
+from pathlib import Path
 
 import pandas as pd
 
 FILE_PATH = "../../inputs/AMPSphere_all_predicted.csv" # file available on zenodo: http://zenodo.org/records/15471481
 FILTERED_PATH = "../../outputs/AMPSphere_filtered.csv"
 
-def read_ampsphere():
-    df = pd.read_csv(FILE_PATH)
-    mask = df.apply(lambda row: (row["HIGH_PROBA"]
-                          and row["PRED_01"] >= 0.87
-                          and row["PRED_02"] >= 0.97
-                          and row["PRED_03"] >= 0.87), axis=1)
-    filtered = df[mask]
-    filtered.sort_values("PRED_02")
-    filtered.to_csv(FILTERED_PATH)
+THRESHOLDS = {"PRED_01": 0.87, "PRED_02": 0.97, "PRED_03": 0.87}
+SORT_COLUMN = "PRED_02"
+CHUNK_SIZE = 500_000
 
+
+def filter_mask(chunk: pd.DataFrame, thresholds: dict[str, float], high_proba=True) -> pd.Series:
+    """
+    Rows with HIGH_PROBA set (if high_proba) and every column of thresholds at or above its threshold.
+    """
+    mask = pd.Series(True, index=chunk.index)
+    if high_proba:
+        mask &= chunk["HIGH_PROBA"].astype(bool)
+    for column, threshold in thresholds.items():
+        mask &= chunk[column] >= threshold
+    return mask
+
+
+def _sort_key(column: int, ascending: bool):
+    # missing values go last in both directions, like in sort_values
+    def key(row):
+        value = float(row[column]) if row[column] else math.nan
+        if math.isnan(value):
+            return (1, 0.0) if ascending else (0, 0.0)
+        return (0, value) if ascending else (1, value)
+    return key
+
+
+def _column_kind(series: pd.Series):
+    if series.isna().all():
+        return None
+    if pd.api.types.is_bool_dtype(series):
+        return "bool"
+    if pd.api.types.is_integer_dtype(series):
+        return "int"
+    if pd.api.types.is_float_dtype(series):
+        return "float"
+    return "str"
+
+
+def _merge_kinds(kinds: dict, chunk: pd.DataFrame):
+    """
+    Updates kinds (column -> bool, int, float or str) with the values of chunk,
+    so the parquet schema fits every chunk and not only the first one.
+    """
+    for column in chunk.columns:
+        kind = _column_kind(chunk[column])
+        known = kinds.get(column)
+        if known is None or known == kind:
+            kinds[column] = kind or known
+        elif kind is not None:
+            kinds[column] = "float" if {known, kind} == {"int", "float"} else "str"
+
+
+def read_ampsphere(file_path=FILE_PATH, filtered_path=FILTERED_PATH, thresholds=None, high_proba=True,
+                   columns: list[str] = None, sort_by=SORT_COLUMN, ascending=True, chunk_size=CHUNK_SIZE,
+                   verbose=True) -> int:
+    """
+    Filters AMPSphere predictions into filtered_path (.csv, or .parquet if pyarrow is installed).
+    Args:
+        thresholds (dict): Minimal value per column, defaults to THRESHOLDS.
+        high_proba (bool): Keep only rows with HIGH_PROBA.
+        columns (list[str]): Output columns, all columns if None. Only these and the filtered ones are parsed.
+        sort_by (str): Column to sort the output by, None keeps the file order.
+        chunk_size (int): Rows read at once.
+    Returns:
+        int: Number of rows kept.
+    """
+    thresholds = THRESHOLDS if thresholds is None else thresholds
+    usecols = None
+    if columns is not None:
+        needed = list(thresholds) + (["HIGH_PROBA"] if high_proba else []) + ([sort_by] if sort_by else [])
+        usecols = list(dict.fromkeys(list(columns) + needed))
+
+    start = time.perf_counter()
+    rows_read = 0
+    kept = 0
+    header = None
+    kinds = {}
+    runs = []
+    # the sort column is kept in the runs until they are merged
+    run_columns = None if columns is None else list(dict.fromkeys(list(columns) + ([sort_by] if sort_by else [])))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for chunk in pd.read_csv(file_path, usecols=usecols, chunksize=chunk_size):
+            rows_read += len(chunk)
+            filtered = chunk[filter_mask(chunk, thresholds, high_proba)]
+            if run_columns is not None:
+                filtered = filtered[run_columns]
+            _merge_kinds(kinds, filtered)
+            if sort_by:
+                filtered = filtered.sort_values(sort_by, ascending=ascending, kind="stable")
+            if header is None:
+                header = [""] + list(filtered.columns)
+            if len(filtered):
+                run_path = Path(tmp_dir) / f"run_{len(runs)}.csv"
+                filtered.to_csv(run_path, header=False)
+                runs.append(run_path)
+                kept += len(filtered)
+            if verbose:
+                elapsed = time.perf_counter() - start
+                print(f"Read {rows_read} rows ({rows_read / elapsed:.0f} rows/s), kept {kept}")
+
+        files = [open(run_path, newline="") for run_path in runs]
+        try:
+            readers = [csv.reader(f) for f in files]
+            if sort_by:
+                rows = heapq.merge(*readers, key=_sort_key(header.index(sort_by), ascending), reverse=not ascending)
+            else:
+                rows = (row for reader in readers for row in reader)
+            header = header or []
+            if columns is not None and sort_by and sort_by not in columns:
+                dropped = header.index(sort_by)
+                header = header[:dropped] + header[dropped + 1:]
+                rows = (row[:dropped] + row[dropped + 1:] for row in rows)
+            _write_rows(filtered_path, header, rows, {column: kinds.get(column) for column in header[1:]})
+        finally:
+            for f in files:
+                f.close()
+
+    if verbose:
+        elapsed = time.perf_counter() - start
+        print(f"Kept {kept} of {rows_read} rows in {elapsed:.1f} s ({rows_read / elapsed:.0f} rows/s)"
+              f" -> {filtered_path}")
+    return kept
+
+
+_ARROW_TYPES = {"bool": "bool_", "int": "int64", "float": "float64", "str": "string", None: "string"}
+_PANDAS_TYPES = {"bool": "boolean", "int": "Int64", "float": "float64", "str": "string", None: "string"}
+
+
+def _write_rows(path, header: list[str], rows, kinds: dict = None, batch_size=100_000):
+    """
+    Writes merged csv rows as csv or, for a .parquet path, as parquet row groups.
+    Args:
+        kinds (dict): Column -> bool, int, float or str (None for columns without values), see _merge_kinds.
+            Gives the parquet schema, columns not in it are written as strings.
+    """
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    if path.suffix != ".parquet":
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    kinds = {column: (kinds or {}).get(column) for column in header[1:]}
+    schema = pa.schema([(column, getattr(pa, _ARROW_TYPES[kind])()) for column, kind in kinds.items()])
+    dtypes = {column: _PANDAS_TYPES[kind] for column, kind in kinds.items()}
+    with pq.ParquetWriter(path, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                _write_parquet_batch(pa, writer, header, dtypes, batch)
+                batch = []
+        if batch:
+            _write_parquet_batch(pa, writer, header, dtypes, batch)
+
+
+def _write_parquet_batch(pa, writer, header, dtypes, batch):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([header] + batch)
+    buffer.seek(0)
+    frame = pd.read_csv(buffer, index_col=0, dtype=dtypes)
+    writer.write_table(pa.Table.from_pandas(frame, schema=writer.schema, preserve_index=False))
+
+
+def _parse_threshold(text: str) -> tuple[str, float]:
+    column, value = text.split("=")
+    return column, float(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Filter AMPSphere predictions")
+    parser.add_argument("--input", default=FILE_PATH, help="AMPSphere_all_predicted.csv")
+    parser.add_argument("--output", default=FILTERED_PATH, help="Output .csv or .parquet file")
+    parser.add_argument("--threshold", type=_parse_threshold, action="append",
+                        help="COLUMN=VALUE minimal value, can be repeated (default: PRED_01=0.87 PRED_02=0.97 "
+                             "PRED_03=0.87)")
+    parser.add_argument("--all_proba", action="store_true", help="Do not require HIGH_PROBA")
+    parser.add_argument("--columns", nargs="+", help="Output columns (default: all)")
+    parser.add_argument("--sort_by", default=SORT_COLUMN, help="Column to sort by")
+    parser.add_argument("--descending", action="store_true", help="Sort from the highest value")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE, help="Rows read at once")
+    args = parser.parse_args()
+
+    read_ampsphere(args.input, args.output, dict(args.threshold) if args.threshold else None,
+                   high_proba=not args.all_proba, columns=args.columns, sort_by=args.sort_by,
+                   ascending=not args.descending, chunk_size=args.chunk_size)
@@ -1,8 +1,19 @@
 """
 Filter raw data from DBAASP,
 create positive and negative dataset.
+The five strain files are merged into one peptide x strain activity table (median of duplicate measurements),
+labelled with the thresholds and cached as .npy columns next to the raw data.
+The cache is rebuilt when a source file or a threshold changes, later loads are memory-mapped.
 """
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
 
+import numpy as np
+
+ROOT_PATH = Path(__file__).parents[2]
 
 # --- SETTINGS ---
 bsubtilis = "data_DBAASP/raw/DBAASP_bsubtilis_peptides.csv"
@@ -15,3 +26,265 @@ threshold_active = 25
 threshold_inactive = 75
 # ----------------
 
+SOURCES = {"bsubtilis": bsubtilis, "ecoli": ecoli, "paegiurosa": paegiurosa, "saureus": saureus,
+           "sepidermidis": sepidermidis}
+CACHE_PATH = ROOT_PATH / "data_DBAASP/cache"
+CACHE_VERSION = 1
+
+# labels of a peptide against a strain
+ACTIVE = 1
+INACTIVE = 0
+AMBIGUOUS = -1  # measured between the thresholds
+MISSING = -2    # not measured
+
+_COLUMNS = ("sequences", "activity", "labels", "counts")
+
+
+def _resolve(path) -> Path:
+    path = Path(path)
+    return path if path.is_absolute() else ROOT_PATH / path
+
+
+def _sha256(path) -> str:
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def labels_from_activity(activity: np.ndarray, active=threshold_active, inactive=threshold_inactive) -> np.ndarray:
+    """
+    ACTIVE at or below active, INACTIVE at or above inactive, AMBIGUOUS between them, MISSING for NaN.
+    """
+    labels = np.full(activity.shape, MISSING, dtype=np.int8)
+    measured = ~np.isnan(activity)
+    labels[measured] = AMBIGUOUS
+    labels[measured & (activity <= active)] = ACTIVE
+    labels[measured & (activity >= inactive)] = INACTIVE
+    return labels
+
+
+def build_table(sources: dict[str, str] = None) -> tuple[list[str], list[str], np.ndarray, np.ndarray]:
+    """
+    Merges the strain files into one table, sequences in order of first occurrence.
+    Returns:
+        list[str]: Sequences.
+        list[str]: Strains.
+        np.ndarray: float64 (sequences, strains) median activity, NaN where not measured.
+        np.ndarray: uint16 (sequences, strains) number of measurements.
+    """
+    import pandas as pd
+    sources = SOURCES if sources is None else sources
+    frames = []
+    for strain, path in sources.items():
+        frame = pd.read_csv(_resolve(path), usecols=["SEQUENCE", "ACTIVITY"], keep_default_na=False,
+                            dtype={"SEQUENCE": str})
+        frame["ACTIVITY"] = pd.to_numeric(frame["ACTIVITY"], errors="coerce")
+        frame = frame[(frame["SEQUENCE"] != "") & frame["ACTIVITY"].notna()]
+        frames.append(frame.assign(STRAIN=strain))
+    merged = pd.concat(frames, ignore_index=True)
+
+    sequences = list(dict.fromkeys(merged["SEQUENCE"]))
+    strains = list(sources)
+    rows = pd.Index(sequences).get_indexer(merged["SEQUENCE"])
+    columns = pd.Index(strains).get_indexer(merged["STRAIN"])
+    grouped = merged.assign(row=rows, column=columns).groupby(["row", "column"])["ACTIVITY"]
+    medians = grouped.median()
+    sizes = grouped.size()
+
+    activity = np.full((len(sequences), len(strains)), np.nan)
+    counts = np.zeros((len(sequences), len(strains)), dtype=np.uint16)
+    index_rows = medians.index.get_level_values(0)
+    index_columns = medians.index.get_level_values(1)
+    activity[index_rows, index_columns] = medians.to_numpy()
+    counts[index_rows, index_columns] = sizes.to_numpy()
+    return sequences, strains, activity, counts
+
+
+class DBAASPDataset:
+    """
+    Peptide x strain activity table. Rows are looked up by sequence through a dict built on first use,
+    the arrays may be memory-mapped.
+    """
+    def __init__(self, sequences: np.ndarray, strains: list[str], activity: np.ndarray, labels: np.ndarray,
+                 counts: np.ndarray):
+        self.sequences = sequences  # fixed width bytes
+        self.strains = list(strains)
+        self.activity = activity
+        self.labels = labels
+        self.counts = counts
+        self._index = None
+        self._strain_index = {strain: column for column, strain in enumerate(self.strains)}
+
+    @property
+    def index(self) -> dict[str, int]:
+        if self._index is None:
+            self._index = {seq: row for row, seq in enumerate(self.sequence_list())}
+        return self._index
+
+    def sequence_list(self) -> list[str]:
+        return [seq.decode("ascii") for seq in self.sequences.tolist()]
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __contains__(self, sequence: str):
+        return sequence in self.index
+
+    def __repr__(self):
+        return f"DBAASPDataset(sequences={len(self)}, strains={self.strains})"
+
+    def row(self, sequence: str) -> int:
+        """
+        Row of sequence, raises KeyError if it is not in DBAASP.
+        """
+        return self.index[sequence]
+
+    def strain_activity(self, sequence: str) -> dict[str, float]:
+        """
+        Median activity of sequence against every strain it was measured on.
+        """
+        activity = self.activity[self.row(sequence)]
+        return {strain: float(value) for strain, value in zip(self.strains, activity.tolist()) if value == value}
+
+    def strain_labels(self, sequence: str) -> dict[str, int]:
+        """
+        Label of sequence against every strain it was measured on.
+        """
+        labels = self.labels[self.row(sequence)]
+        return {strain: label for strain, label in zip(self.strains, labels.tolist()) if label != MISSING}
+
+    def _mask(self, label: int, strain: str = None) -> np.ndarray:
+        if strain is not None:
+            return np.asarray(self.labels[:, self._strain_index[strain]] == label)
+        if label == ACTIVE:
+            return np.asarray((self.labels == ACTIVE).any(axis=1))
+        # inactive against every strain it was measured on
+        labels = np.asarray(self.labels)
+        return ((labels == label) | (labels == MISSING)).all(axis=1) & (labels != MISSING).any(axis=1)
+
+    def positives(self, strain: str = None) -> list[str]:
+        """
+        Sequences active against strain, or against any strain if strain is None.
+        """
+        return [seq.decode("ascii") for seq in self.sequences[self._mask(ACTIVE, strain)].tolist()]
+
+    def negatives(self, strain: str = None) -> list[str]:
+        """
+        Sequences inactive against strain, or against all strains they were measured on if strain is None.
+        """
+        return [seq.decode("ascii") for seq in self.sequences[self._mask(INACTIVE, strain)].tolist()]
+
+    def to_frame(self):
+        """
+        Activity table as a pd.DataFrame indexed by sequence.
+        """
+        import pandas as pd
+        return pd.DataFrame(np.asarray(self.activity), index=pd.Index(self.sequence_list(), name="SEQUENCE"),
+                            columns=self.strains)
+
+
+def _source_state(sources: dict[str, str]) -> dict[str, dict]:
+    state = {}
+    for strain, path in sources.items():
+        stat = _resolve(path).stat()
+        state[strain] = {"path": str(path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    return state
+
+
+def _cache_is_valid(meta: dict, sources: dict[str, str], settings: dict) -> bool:
+    """
+    Compares sizes and mtimes of the sources with the cache, files with a new mtime are compared by sha256.
+    Unchanged files with a new mtime get it updated in meta.
+    """
+    if meta.get("settings") != settings or list(meta.get("sources", {})) != list(sources):
+        return False
+    for strain, state in _source_state(sources).items():
+        cached = meta["sources"][strain]
+        if cached["path"] != state["path"] or cached["size"] != state["size"]:
+            return False
+        if cached["mtime_ns"] != state["mtime_ns"]:
+            if cached["sha256"] != _sha256(_resolve(sources[strain])):
+                return False
+            cached["mtime_ns"] = state["mtime_ns"]
+    return True
+
+
+def _write_meta(cache_dir: Path, meta: dict):
+    tmp = cache_dir / f"meta.{os.getpid()}.tmp"
+    tmp.write_text(json.dumps(meta, indent=2))
+    os.replace(tmp, cache_dir / "meta.json")
+
+
+def _save(cache_dir: Path, name: str, array: np.ndarray):
+    tmp = cache_dir / f"{name}.{os.getpid()}.tmp.npy"
+    np.save(tmp, array)
+    os.replace(tmp, cache_dir / f"{name}.npy")
+
+
+def build_cache(sources: dict[str, str] = None, cache_dir=CACHE_PATH, active=threshold_active,
+                inactive=threshold_inactive):
+    """
+    Builds the table and writes its columns and meta.json (written last, so a partial cache is never valid).
+    """
+    sources = SOURCES if sources is None else sources
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    sequences, strains, activity, counts = build_table(sources)
+    width = max((len(seq) for seq in sequences), default=1)
+    _save(cache_dir, "sequences", np.array(sequences, dtype=f"S{width}"))
+    _save(cache_dir, "activity", activity)
+    _save(cache_dir, "labels", labels_from_activity(activity, active, inactive))
+    _save(cache_dir, "counts", counts)
+
+    state = _source_state(sources)
+    for strain in state:
+        state[strain]["sha256"] = _sha256(_resolve(sources[strain]))
+    meta = {"settings": {"version": CACHE_VERSION, "active": active, "inactive": inactive},
+            "sources": state, "strains": strains}
+    _write_meta(cache_dir, meta)
+
+
+def load_dataset(sources: dict[str, str] = None, cache_dir=CACHE_PATH, active=threshold_active,
+                 inactive=threshold_inactive, rebuild=False, mmap=True) -> DBAASPDataset:
+    """
+    Loads the DBAASP table from the cache, (re)building it if a source or a threshold changed.
+    Args:
+        sources (dict): Strain name to csv path (relative to the repository root), defaults to SOURCES.
+        active, inactive: Activity thresholds of the labels, see labels_from_activity.
+        rebuild (bool): Rebuild the cache even if it is up to date.
+        mmap (bool): Memory-map the arrays instead of reading them.
+    """
+    sources = SOURCES if sources is None else sources
+    cache_dir = Path(cache_dir)
+    settings = {"version": CACHE_VERSION, "active": active, "inactive": inactive}
+    meta_path = cache_dir / "meta.json"
+    meta = json.loads(meta_path.read_text()) if meta_path.exists() else {}
+    mtimes = {strain: state["mtime_ns"] for strain, state in meta.get("sources", {}).items()}
+    if rebuild or not meta or not _cache_is_valid(meta, sources, settings):
+        build_cache(sources, cache_dir, active, inactive)
+        meta = json.loads(meta_path.read_text())
+    elif mtimes != {strain: state["mtime_ns"] for strain, state in meta["sources"].items()}:
+        _write_meta(cache_dir, meta)
+
+    mmap_mode = "r" if mmap else None
+    arrays = {name: np.load(cache_dir / f"{name}.npy", mmap_mode=mmap_mode) for name in _COLUMNS}
+    return DBAASPDataset(arrays["sequences"], meta["strains"], arrays["activity"], arrays["labels"],
+                         arrays["counts"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the DBAASP activity table and positive/negative sets")
+    parser.add_argument("--cache", default=str(CACHE_PATH), help="Directory of the cached table")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the cache even if it is up to date")
+    parser.add_argument("--strain", choices=list(SOURCES), help="Sets for one strain (default: all strains)")
+    parser.add_argument("--positives", help="FASTA file for the active sequences")
+    parser.add_argument("--negatives", help="FASTA file for the inactive sequences")
+    args = parser.parse_args()
+
+    dataset = load_dataset(cache_dir=args.cache, rebuild=args.rebuild)
+    positives = dataset.positives(args.strain)
+    negatives = dataset.negatives(args.strain)
+    print(f"{dataset}: {len(positives)} active, {len(negatives)} inactive")
+    if args.positives or args.negatives:
+        from fasta import write_fasta
+        for path, sequences, name in [(args.positives, positives, "active"), (args.negatives, negatives, "inactive")]:
+            if path:
+                write_fasta(path, ((f"{name}_{i}", seq) for i, seq in enumerate(sequences)))
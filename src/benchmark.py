@@ -0,0 +1,356 @@
+"""
+Offline benchmarks of the scoring hot paths.
+Every case runs on synthetic peptides of fixed lengths and on the bundled inputs/ and DBAASP sets,
+results (sequences/s, latency per call, peak traced memory) are written as JSON
+and can be compared against a stored baseline.
+Startup times of the modules and command line tools are measured in fresh interpreters
+and checked against a budget.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as ort
+import pandas as pd
+
+import calculator
+import generator
+from DBAASP.DBAASP_loader import load_dataset
+from fasta import read_sequences
+from hill_climbing.hill_climber import HillClimber, make_scorer
+from predictor import MacrelPredictor
+
+ROOT_PATH = Path(__file__).parents[1]
+INPUTS_PATH = ROOT_PATH / "inputs"
+RESULTS_PATH = ROOT_PATH / "outputs/benchmark.json"
+
+BATCH_SIZES = [1, 64, 1024]
+LENGTHS = [12, 25, 50]
+
+# commands run in a fresh interpreter from src/ and their budget in seconds, interpreter startup included
+STARTUP_COMMANDS = {
+    "python": (["-c", "pass"], None),
+    "import predictor": (["-c", "import predictor"], 1.0),
+    "import calculator": (["-c", "import calculator"], 1.0),
+    "import generator": (["-c", "import generator"], 1.0),
+    "hill_climber --help": (["-m", "hill_climbing.hill_climber", "--help"], 1.0),
+    "beam_search --help": (["-m", "hill_climbing.beam_search", "--help"], 1.0),
+    "json_to_fasta --help": (["-m", "hill_climbing.json_to_fasta", "--help"], 0.5),
+    "scoring_service --help": (["scoring_service.py", "--help"], 1.0),
+    # first score includes loading the model, it has no budget
+    "first score": (["-c", "from calculator import AMPKillerPredictor;"
+                           "AMPKillerPredictor().calculate_and_predict_seqs(['GIGKFLHSAKKFGKAFVGEIMNS'])"], None),
+}
+
+
+def synthetic_peptides(count: int, length: int, seed=0) -> list[str]:
+    rng = random.Random(seed * 1000 + length)
+    return ["".join(rng.choices(generator.aabet_without_C, k=length)) for _ in range(count)]
+
+
+def _canonical(sequences) -> list[str]:
+    # macrel's compute_all only knows the 20 canonical residues
+    alphabet = set(generator.aabet)
+    return list(dict.fromkeys(seq for seq in sequences if seq and set(seq) <= alphabet))
+
+
+def input_peptides(path=INPUTS_PATH) -> list[str]:
+    """
+    Canonical sequences of the FASTA files and of the Sequence column of the csv files in inputs/.
+    """
+    sequences = []
+    for file in sorted(Path(path).iterdir()):
+        if file.suffix == ".fasta":
+            sequences.extend(read_sequences(file))
+        elif file.suffix == ".csv":
+            sequences.extend(pd.read_csv(file)["Sequence"].dropna())
+    return _canonical(sequences)
+
+
+def dbaasp_peptides() -> list[str]:
+    # the cached DBAASP table, sequences in the order of the strain files
+    return _canonical(load_dataset().sequence_list())
+
+
+def load_datasets(names: list[str], count: int, lengths=LENGTHS) -> dict[str, list[str]]:
+    datasets = {}
+    for name in names:
+        if name == "synthetic":
+            for length in lengths:
+                datasets[f"synthetic_{length}"] = synthetic_peptides(count, length)
+        elif name == "inputs":
+            datasets[name] = input_peptides()
+        elif name == "dbaasp":
+            datasets[name] = dbaasp_peptides()
+        else:
+            raise ValueError(f"Unknown dataset {name}")
+    return datasets
+
+
+class Context:
+    """
+    Models and climbers built once, so loading them is not part of any measurement.
+    """
+    def __init__(self):
+        self.macrel = MacrelPredictor()
+        self.killer = make_scorer()
+        self.climbers = {}
+        self._features = {}
+
+    def features(self, batch: list[str]) -> list[np.ndarray]:
+        """
+        Per-sequence feature rows of batch, computed once so predict_seqs is timed on its own.
+        """
+        key = tuple(batch)
+        if key not in self._features:
+            self._features[key] = list(calculator.macrel_descriptors_from_seqs(batch)[:, None, :])
+        return self._features[key]
+
+    def climber(self, batch_size: int) -> HillClimber:
+        if batch_size not in self.climbers:
+            self.climbers[batch_size] = HillClimber(scorer=self.killer, batch_size=batch_size)
+        return self.climbers[batch_size]
+
+
+# Each case gets one batch of sequences and returns the number of items it processed.
+# Cases with batched=False are run one sequence at a time, max_sequences bounds the slow ones.
+def _macrel_descriptors_from_seq(context: Context, batch: list[str], batch_size: int) -> int:
+    for seq in batch:
+        calculator.macrel_descriptors_from_seq(seq)
+    return len(batch)
+
+
+def _macrel_descriptors_from_seqs(context: Context, batch: list[str], batch_size: int) -> int:
+    calculator.macrel_descriptors_from_seqs(batch)
+    return len(batch)
+
+
+def _macrel_predict_seqs(context: Context, batch: list[str], batch_size: int) -> int:
+    context.macrel.predict_seqs(context.features(batch))
+    return len(batch)
+
+
+def _macrel_calculate_and_predict_seqs(context: Context, batch: list[str], batch_size: int) -> int:
+    context.macrel.calculate_and_predict_seqs(batch)
+    return len(batch)
+
+
+def _amp_killer_calculate_and_predict_seqs(context: Context, batch: list[str], batch_size: int) -> int:
+    context.killer.calculate_and_predict_seqs(batch)
+    return len(batch)
+
+
+def _generate_all_neighbors(context: Context, batch: list[str], batch_size: int) -> int:
+    return sum(len(generator.generate_all_neighbors(seq)) for seq in batch)
+
+
+def _hill_climber_do_one_step(context: Context, batch: list[str], batch_size: int) -> int:
+    context.climber(batch_size).do_one_step(batch[0])
+    return 1
+
+
+CASES = {
+    "macrel_descriptors_from_seq": dict(run=_macrel_descriptors_from_seq, batched=False, max_sequences=256),
+    "macrel_descriptors_from_seqs": dict(run=_macrel_descriptors_from_seqs, batched=True, max_sequences=None),
+    "macrel_predict_seqs": dict(run=_macrel_predict_seqs, batched=True, max_sequences=None),
+    "macrel_calculate_and_predict_seqs": dict(run=_macrel_calculate_and_predict_seqs, batched=True,
+                                              max_sequences=None),
+    "amp_killer_calculate_and_predict_seqs": dict(run=_amp_killer_calculate_and_predict_seqs, batched=True,
+                                                  max_sequences=None),
+    "generate_all_neighbors": dict(run=_generate_all_neighbors, batched=False, max_sequences=256),
+    # one epoch per sequence, batch_size is HillClimber.batch_size
+    "hill_climber_do_one_step": dict(run=_hill_climber_do_one_step, batched=True, max_sequences=8,
+                                     one_per_call=True),
+}
+
+
+def _batches(sequences: list[str], batch_size: int, one_per_call=False) -> list[list[str]]:
+    if one_per_call:
+        return [[seq] for seq in sequences]
+    return [sequences[start:start + batch_size] for start in range(0, len(sequences), batch_size)]
+
+
+def run_case(context: Context, case: str, sequences: list[str], batch_size: int, repeat=3,
+             measure_memory=True) -> dict:
+    """
+    Times repeat passes over sequences and keeps the fastest one.
+    Returns:
+        dict: items, seconds, items_per_second, latency_ms (per call) and peak_memory_mb of one pass.
+    """
+    spec = CASES[case]
+    if spec["max_sequences"]:
+        sequences = sequences[:spec["max_sequences"]]
+    batches = _batches(sequences, batch_size, spec.get("one_per_call", False))
+    run = spec["run"]
+    run(context, batches[0], batch_size)  # warm up caches and ONNX
+
+    best = None
+    items = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = sum(run(context, batch, batch_size) for batch in batches)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak = None
+    if measure_memory:
+        tracemalloc.start()
+        for batch in batches:
+            run(context, batch, batch_size)
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    return {
+        "items": items,
+        "sequences": len(sequences),
+        "seconds": best,
+        "items_per_second": items / best if best else float("inf"),
+        "latency_ms": best / len(batches) * 1000,
+        "peak_memory_mb": peak,
+    }
+
+
+def run_benchmarks(cases: list[str], datasets: dict[str, list[str]], batch_sizes=BATCH_SIZES, repeat=3,
+                   measure_memory=True, verbose=True) -> dict:
+    context = Context()
+    results = []
+    for case in cases:
+        sizes = batch_sizes if CASES[case]["batched"] else [1]
+        for dataset, sequences in datasets.items():
+            if not sequences:
+                continue
+            for batch_size in sizes:
+                result = {"case": case, "dataset": dataset, "batch_size": batch_size,
+                          **run_case(context, case, sequences, batch_size, repeat, measure_memory)}
+                results.append(result)
+                if verbose:
+                    memory = f"{result['peak_memory_mb']:9.2f} MB" if result["peak_memory_mb"] is not None else ""
+                    print(f"{case:40} {dataset:14} batch {batch_size:5}: {result['items_per_second']:12.1f} items/s"
+                          f" {result['latency_ms']:10.3f} ms/call {memory}")
+    return {"meta": environment(), "results": results}
+
+
+def run_startup(names: list[str] = None, repeat=3, scale=1.0, verbose=True) -> list[dict]:
+    """
+    Times every command of STARTUP_COMMANDS in repeat fresh interpreters and keeps the fastest run.
+    Budgets are multiplied by scale, e.g. for slower machines.
+    Returns:
+        list of results like run_benchmarks, with case "startup", the command as dataset,
+        budget_s and over_budget.
+    """
+    source = Path(__file__).parent
+    results = []
+    for name in names or list(STARTUP_COMMANDS):
+        args, budget = STARTUP_COMMANDS[name]
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, *args], cwd=source, check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        budget = budget * scale if budget is not None else None
+        result = {"case": "startup", "dataset": name, "batch_size": 1, "items": 1, "sequences": 0,
+                  "seconds": best, "items_per_second": 1 / best, "latency_ms": best * 1000,
+                  "peak_memory_mb": None, "budget_s": budget, "over_budget": budget is not None and best > budget}
+        results.append(result)
+        if verbose:
+            limit = f"(budget {budget:.2f} s)" if budget is not None else ""
+            flag = " OVER BUDGET" if result["over_budget"] else ""
+            print(f"{'startup':40} {name:24} {best:8.3f} s {limit}{flag}")
+    return results
+
+
+def environment() -> dict:
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "onnxruntime": ort.__version__,
+    }
+
+
+def _key(result: dict) -> tuple:
+    return result["case"], result["dataset"], result["batch_size"]
+
+
+def compare(results: dict, baseline: dict, threshold=0.1) -> list[dict]:
+    """
+    Cases whose throughput fell more than threshold (a fraction) below the baseline.
+    """
+    baseline_results = {_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        reference = baseline_results.get(_key(result))
+        if reference is None:
+            continue
+        ratio = result["items_per_second"] / reference["items_per_second"]
+        if ratio < 1 - threshold:
+            regressions.append({"case": result["case"], "dataset": result["dataset"],
+                                "batch_size": result["batch_size"], "ratio": ratio,
+                                "items_per_second": result["items_per_second"],
+                                "baseline_items_per_second": reference["items_per_second"]})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark predictor, calculator, generator and hill climbing")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES), help="Cases to run")
+    parser.add_argument("--datasets", nargs="+", choices=["synthetic", "inputs", "dbaasp"],
+                        default=["synthetic", "inputs", "dbaasp"])
+    parser.add_argument("--lengths", nargs="+", type=int, default=LENGTHS, help="Lengths of synthetic peptides")
+    parser.add_argument("--count", type=int, default=2048, help="Synthetic peptides per length")
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=BATCH_SIZES)
+    parser.add_argument("--repeat", type=int, default=3, help="Passes per measurement, the fastest one is kept")
+    parser.add_argument("--no_memory", action="store_true", help="Skip the tracemalloc pass")
+    parser.add_argument("--output", type=str, default=str(RESULTS_PATH), help="JSON file for the results")
+    parser.add_argument("--baseline", type=str, help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Allowed relative throughput loss against the baseline")
+    parser.add_argument("--startup", nargs="*", choices=list(STARTUP_COMMANDS),
+                        help="Only time the startup of these commands (all if none given), skipping the cases")
+    parser.add_argument("--no_startup", action="store_true", help="Skip the startup times")
+    parser.add_argument("--startup_scale", type=float, default=1.0,
+                        help="Multiplies the startup budgets, e.g. 2 on a slow machine")
+    args = parser.parse_args()
+
+    if args.startup is not None:
+        results = {"meta": environment(), "results": []}
+    else:
+        datasets = load_datasets(args.datasets, args.count, args.lengths)
+        results = run_benchmarks(args.cases, datasets, args.batch_sizes, args.repeat, not args.no_memory)
+    if not args.no_startup:
+        results["results"].extend(run_startup(args.startup, args.repeat, args.startup_scale))
+    output = Path(args.output)
+    output.parent.mkdir(exist_ok=True, parents=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved {len(results['results'])} results to {output.resolve()}")
+
+    over_budget = [result for result in results["results"] if result.get("over_budget")]
+    for result in over_budget:
+        print(f"OVER BUDGET startup of {result['dataset']}: {result['seconds']:.3f} s > {result['budget_s']:.2f} s")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['case']} {regression['dataset']} batch {regression['batch_size']}: "
+                  f"{regression['items_per_second']:.1f} items/s is {regression['ratio']:.0%} of the baseline "
+                  f"{regression['baseline_items_per_second']:.1f}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%}")
+    if over_budget:
+        sys.exit(1)
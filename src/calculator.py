@@ -1,32 +1,69 @@
 """
 Calculates features for peptide sequences using Macrel library.
+pandas, peptides, Biopython and modlamp are imported by the functions that use them,
+so importing this module (and scoring with the batch engines in features) stays fast.
 """
-import pandas as pd
+from __future__ import annotations
+
+import hashlib
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
 import numpy as np
-from charset_normalizer.md import lru_cache
 from macrel.macrel_features import compute_all
-from Bio.SeqUtils.ProtParam import ProteinAnalysis
-import peptides
-import loader
-from modlamp.descriptors import GlobalDescriptor, PeptideDescriptor
+import features
+import fasta
+import instrumentation
+
+from predictor import MacrelPredictor, Predictor
+
+if TYPE_CHECKING:
+    import pandas as pd
 
-from predictor import Predictor
+# AMPKillerPredictor scoring rules, they are part of its fingerprint so cached scores follow rule changes.
+# Bump KILLER_RULES_VERSION when killer_scores changes in a way these constants don't capture.
+KILLER_RULES_VERSION = 1
+KILLER_MACREL_WEIGHT = 2
+KILLER_MOMENT_BAND = (0.4, 0.59)
+KILLER_RATIO_BAND = (0.5, 0.7)
+KILLER_CHARGE_BAND = (5, 7)
 
 
 def macrel_descriptors_from_seq(sequence: str) -> np.ndarray:
     """
     Extracts 22 features using the compute_all function from macrel.
     """
-    features = compute_all(sequence)
+    with instrumentation.timer("features.macrel_compute_all"):
+        features = compute_all(sequence)
 
     # Convert to float32 numpy array for ONNX compatibility
     return np.array(features, dtype=np.float32).reshape(1, -1)
 
 
+def macrel_descriptors_from_seqs(seqs: list[str]) -> np.ndarray:
+    """
+    Extracts 22 Macrel features for all sequences at once.
+    Returns float32 array of shape (len(seqs), 22), same values as compute_all.
+    """
+    with instrumentation.timer("features.macrel", len(seqs)):
+        return features.macrel_descriptors_from_seqs(seqs)
+
+
+def macrel_descriptors_of_substitutions(seq: str, positions: list[int], residues: list[str]) -> np.ndarray:
+    """
+    Extracts 22 Macrel features for single-point mutants of seq (residues[i] at positions[i])
+    by updating the parent's cached composition and scale sums.
+    """
+    with instrumentation.timer("features.macrel_substitutions", len(positions)):
+        return features.macrel_descriptors_of_substitutions(seq, positions, residues)
+
+
 def peptides_descriptors_from_seqs(seqs: list[str]):
     """
     Extracts about 50 descriptors from package peptides.
     """
+    import pandas as pd
+    import peptides
     descriptors_list_list = []
     for seq in seqs:
         descriptors = peptides.Peptide(seq).descriptors()  # compute descriptors
@@ -36,16 +73,21 @@ def peptides_descriptors_from_seqs(seqs: list[str]):
     return descriptors_df
 
 
-def peptides_descriptors_from_fasta(filepath):
+def peptides_descriptors_from_fasta(filepath, chunk_size=10000):
     """
     Extracts about 50 descriptors from package peptides.
+    Reads the file in chunks of chunk_size sequences.
     """
-    sequences = loader.load_fasta(filepath)
-    descriptors_df = peptides_descriptors_from_seqs(sequences)
-    return descriptors_df
+    import pandas as pd
+    chunks = [peptides_descriptors_from_seqs(seqs)
+              for seqs in fasta.chunked(fasta.read_sequences(filepath), chunk_size)]
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
 
 
 def alphahelices(sequence: str, verbose=False) -> float:
+    from Bio.SeqUtils.ProtParam import ProteinAnalysis
     analysed_seq = ProteinAnalysis(sequence)
 
     # returns a tuple: (Helix, Turn, Sheet)
@@ -60,6 +102,7 @@ def alphahelices(sequence: str, verbose=False) -> float:
 @lru_cache(maxsize=10000)
 def hydrophobic_moment(seq: str) -> float:
     # global uH value
+    from modlamp.descriptors import PeptideDescriptor
     calc = PeptideDescriptor(seq, 'eisenberg')
     calc.calculate_moment(window=1000, angle=100, modality='mean')
     return float(calc.descriptor[0][0])
@@ -68,6 +111,7 @@ def hydrophobic_moment(seq: str) -> float:
 @lru_cache(maxsize=10000)
 def hydrophobicity(seq: str) -> float:
     # average hydrophobicity (H)
+    from modlamp.descriptors import PeptideDescriptor
     calc = PeptideDescriptor(seq, 'eisenberg')
     calc.calculate_global(window=1000, modality='mean')
     return float(calc.descriptor[0][0])
@@ -75,27 +119,32 @@ def hydrophobicity(seq: str) -> float:
 
 @lru_cache(maxsize=10000)
 def charge(seq, amide=False) -> float:
+    from modlamp.descriptors import GlobalDescriptor
     calc = GlobalDescriptor(seq)
     calc.calculate_charge(amide=amide)
     return float(calc.descriptor[0][0])
 
 
 def amps_analysis(seqs: list[str], verbose=False) -> pd.DataFrame:
-    hm = []     # hydrophobic moment
-    h = []      # hydrophobicity
-    c = []      # charge
-    ah = []     # alphahelices
-    for seq in seqs:
-        hm.append(round(hydrophobic_moment(seq), 2))
-        h.append(round(hydrophobicity(seq), 2))
-        c.append(round(charge(seq), 2))
-        ah.append(round(alphahelices(seq), 2))
+    """
+    Hydrophobic moment, hydrophobicity, charge and alpha-helix fraction of all seqs,
+    computed as arrays for the whole batch. Same values as the per-sequence functions above.
+    """
+    import pandas as pd
+    seqs = list(seqs)
+    descriptors = features.modlamp_descriptors_from_seqs(seqs, ph=7.4, amide=False)
+    helices = features.secondary_structure_from_seqs(seqs)[:, 0]
+
+    def rounded(values) -> list[float]:
+        # python's round like the per-sequence functions, np.round can differ on ties
+        return [round(value, 2) for value in values.tolist()]
+
     analyzed = {
         "Sequence" : seqs,
-        "Hydrophobic moment" : hm,
-        "Hydrophobicity" : h,
-        "Charge" : c,
-        "Alphahelices" : ah
+        "Hydrophobic moment" : rounded(descriptors["moment"]),
+        "Hydrophobicity" : rounded(descriptors["hydrophobicity"]),
+        "Charge" : rounded(descriptors["charge"]),
+        "Alphahelices" : rounded(helices)
     }
     if verbose:
         print(pd.DataFrame(analyzed))
@@ -103,13 +152,56 @@ def amps_analysis(seqs: list[str], verbose=False) -> pd.DataFrame:
     return pd.DataFrame(analyzed)
 
 
+def killer_scores(macrel_probs: np.ndarray, uH: np.ndarray, h_ratio: np.ndarray, z: np.ndarray) -> list[float]:
+    """
+    Vectorized weighting of AMPKillerPredictor.amp_killer_score, adds the bonuses as masks.
+    """
+    score = macrel_probs * KILLER_MACREL_WEIGHT
+    score += (KILLER_MOMENT_BAND[0] <= uH) & (uH <= KILLER_MOMENT_BAND[1])
+    score -= uH > KILLER_MOMENT_BAND[1]
+    score += (KILLER_RATIO_BAND[0] <= h_ratio) & (h_ratio <= KILLER_RATIO_BAND[1])
+    score += (KILLER_CHARGE_BAND[0] <= z) & (z <= KILLER_CHARGE_BAND[1])
+    return score.tolist()
+
+
+def killer_rules_digest() -> str:
+    """
+    Short hash of KILLER_RULES_VERSION and the rule constants.
+    """
+    rules = (KILLER_RULES_VERSION, KILLER_MACREL_WEIGHT, KILLER_MOMENT_BAND, KILLER_RATIO_BAND, KILLER_CHARGE_BAND)
+    return hashlib.sha1(repr(rules).encode()).hexdigest()[:12]
+
+
 class AMPKillerPredictor(Predictor):
-    def __init__(self):
-        import predictor
-        self.macrel = predictor.MacrelPredictor()
+    def __init__(self, macrel: Predictor = None):
+        self.macrel = macrel or MacrelPredictor()
+
+    @property
+    def fingerprint(self) -> str:
+        return f"{self.__class__.__name__}:rules-{killer_rules_digest()}/{self.macrel.fingerprint}"
 
     def calculate_and_predict_seqs(self, sequences: list[str]) -> list[float]:
-        return [self.amp_killer_score(seq) for seq in sequences]
+        """
+        Batch version of amp_killer_score: one Macrel call for all sequences,
+        descriptors as arrays and the bonuses as masks. Same scores as amp_killer_score.
+        """
+        if not sequences:
+            return []
+        macrel_probs = np.array(self.macrel.calculate_and_predict_seqs(sequences))
+        with instrumentation.timer("features.modlamp", len(sequences)):
+            descriptors = features.modlamp_descriptors_from_seqs(sequences, ph=7.4)
+        return killer_scores(macrel_probs, descriptors["moment"],
+                             descriptors["hydrophobic_ratio"], descriptors["charge"])
+
+    def calculate_and_predict_substitutions(self, sequence: str, positions: list[int],
+                                            residues: list[str]) -> list[float]:
+        with instrumentation.timer("features.modlamp_substitutions", len(positions)):
+            descriptors = features.modlamp_descriptors_of_substitutions(sequence, positions, residues)
+        if descriptors is None or not len(positions):
+            return super().calculate_and_predict_substitutions(sequence, positions, residues)
+        macrel_probs = self.macrel.calculate_and_predict_substitutions(sequence, positions, residues)
+        return killer_scores(np.array(macrel_probs), descriptors["moment"],
+                             descriptors["hydrophobic_ratio"], descriptors["charge"])
 
     def amp_killer_score(self, seq: str) -> float:
         """
@@ -124,6 +216,7 @@ class AMPKillerPredictor(Predictor):
         macrel_prob = self.macrel.calculate_and_predict_seqs([seq])[0]
 
         # 2. Physical Descriptors (The nudges)
+        from modlamp.descriptors import GlobalDescriptor, PeptideDescriptor
         pep = PeptideDescriptor(seq, 'eisenberg')
         pep.calculate_moment(window=1000, angle=100)
         uH = pep.descriptor[0][0]  # moment
@@ -135,20 +228,20 @@ class AMPKillerPredictor(Predictor):
 
         # --- WEIGHTING LOGIC ---
         # Multiplier of 2.0 ensures Macrel dominates the physical bonuses
-        score = macrel_prob * 2
+        score = macrel_prob * KILLER_MACREL_WEIGHT
 
         # 1. Hydrophobic Moment (0.4 - 0.59)
-        if 0.4 <= uH <= 0.59:
+        if KILLER_MOMENT_BAND[0] <= uH <= KILLER_MOMENT_BAND[1]:
             score += 1
-        elif uH > 0.59:
+        elif uH > KILLER_MOMENT_BAND[1]:
             score -= 1
 
         # 2. Hydrophobic Ratio (0.5 - 0.7)
-        if 0.5 <= h_ratio <= 0.7:
+        if KILLER_RATIO_BAND[0] <= h_ratio <= KILLER_RATIO_BAND[1]:
             score += 1
 
         # 3. Net Charge (+5 to +7)
-        if 5 <= z <= 7:
+        if KILLER_CHARGE_BAND[0] <= z <= KILLER_CHARGE_BAND[1]:
             score += 1
         #
         # # 4. Proline Centering
@@ -0,0 +1,172 @@
+"""
+Streaming FASTA reading and writing for plain and gzipped files.
+Records are yielded one by one, so memory does not grow with the size of the library.
+"""
+import gzip
+import io
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def is_gzipped(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_fasta(path, mode="r"):
+    """
+    Opens a FASTA file as text, gzip is detected from the content when reading and from a .gz suffix when writing.
+    """
+    if "r" in mode:
+        gzipped = is_gzipped(path)
+    else:
+        gzipped = Path(path).suffix == ".gz"
+    if gzipped:
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+def read_fasta(path) -> Iterator[tuple[str, str]]:
+    """
+    Yields (header, sequence) records, sequences may span several lines.
+    Header is the text after ">", sequence lines before the first header get an empty header.
+    """
+    with open_fasta(path) as f:
+        header = None
+        lines = []
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(">"):
+                if header is not None or lines:
+                    yield header or "", "".join(lines)
+                header = line[1:].strip()
+                lines = []
+            else:
+                lines.append(line)
+        if header is not None or lines:
+            yield header or "", "".join(lines)
+
+
+def read_sequences(path) -> Iterator[str]:
+    """
+    Yields non-empty sequences of a FASTA file.
+    """
+    for _, sequence in read_fasta(path):
+        if sequence:
+            yield sequence
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """
+    Yields lists of at most size items, e.g. batches of sequences for the scorers.
+    """
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class FastaWriter:
+    """
+    Buffered FASTA writer, gzipped if the path ends with .gz.
+    """
+    def __init__(self, path, buffer_size=1 << 20):
+        self._file = open_fasta(path, "w")
+        self._buffer = io.StringIO()
+        self._buffer_size = buffer_size
+
+    def write(self, header: str, sequence: str):
+        self._buffer.write(f">{header}\n{sequence}\n")
+        if self._buffer.tell() >= self._buffer_size:
+            self.flush()
+
+    def write_records(self, records: Iterable[tuple[str, str]]):
+        for header, sequence in records:
+            self.write(header, sequence)
+
+    def flush(self):
+        self._file.write(self._buffer.getvalue())
+        self._buffer = io.StringIO()
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_fasta(path, records: Iterable[tuple[str, str]]):
+    with FastaWriter(path) as writer:
+        writer.write_records(records)
+
+
+class FastaIndex:
+    """
+    Byte offsets of the records of a plain FASTA file for random access by header or record number.
+    The index is stored next to the file as <file>.idx and rebuilt when the FASTA file is newer.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        if is_gzipped(self.path):
+            raise ValueError(f"{self.path} is gzipped, random access needs a plain FASTA file")
+        self.index_path = self.path.with_name(self.path.name + ".idx")
+        if self.index_path.exists() and self.index_path.stat().st_mtime >= self.path.stat().st_mtime:
+            self._load()
+        else:
+            self._build()
+
+    def _build(self):
+        self.headers = []
+        self.offsets = []
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.startswith(b">"):
+                    self.headers.append(line[1:].decode().strip())
+                    self.offsets.append(offset)
+                offset += len(line)
+        with open(self.index_path, "w") as f:
+            f.writelines(f"{header}\t{offset}\n" for header, offset in zip(self.headers, self.offsets))
+        self._positions = {header: i for i, header in enumerate(self.headers)}
+
+    def _load(self):
+        self.headers = []
+        self.offsets = []
+        with open(self.index_path) as f:
+            for line in f:
+                header, offset = line.rstrip("\n").rsplit("\t", 1)
+                self.headers.append(header)
+                self.offsets.append(int(offset))
+        self._positions = {header: i for i, header in enumerate(self.headers)}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, header: str):
+        return header in self._positions
+
+    def record(self, i: int) -> tuple[str, str]:
+        """
+        Returns the i-th (header, sequence) record.
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[i])
+            f.readline()
+            lines = []
+            for line in f:
+                if line.startswith(b">"):
+                    break
+                lines.append(line.decode().strip())
+        return self.headers[i], "".join(lines)
+
+    def __getitem__(self, header: str) -> str:
+        return self.record(self._positions[header])[1]
@@ -1,27 +1,54 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
-from generator import generate_all_neighbors
+from fasta import FastaWriter, read_fasta
+from generator import iter_neighbors
 
 
-def fasta_to_neighbors(fasta_path: Path, output_folder: Path):
-    with open(fasta_path, 'r') as f:
-        text = f.read()
-    name = ""
-    for line in text.splitlines():
-        if line.startswith(">"):
-            name = line[1:].strip()
-        else:
-            neighbors = generate_all_neighbors(line.strip())
-            with open(f"{output_folder}/{name}.fasta", 'w') as f:
-                f.write(f">{name}\n")
-                f.write(f"{line.strip()}\n")
-                for i, neighbor in enumerate(neighbors):
-                    f.write(f">{name}_{i}\n")
-                    f.write(f"{neighbor}\n")
+def write_neighbors(record: tuple[str, str], output_folder: Path, radius=1) -> int:
+    """
+    Streams the neighbours of one record into <output_folder>/<name>.fasta, the record itself first.
+    Returns:
+        int: Number of neighbours written.
+    """
+    name, sequence = record
+    count = 0
+    with FastaWriter(f"{output_folder}/{name}.fasta") as writer:
+        writer.write(name, sequence)
+        for count, neighbor in enumerate(iter_neighbors(sequence, radius=radius), start=1):
+            writer.write(f"{name}_{count - 1}", neighbor)
+    return count
+
+
+def fasta_to_neighbors(fasta_path: Path, output_folder: Path, radius=1, workers=1) -> int:
+    """
+    Writes one FASTA of distinct neighbours per record of fasta_path.
+    Args:
+        radius (int): Edit distance of the neighbourhood, see generator.iter_neighbors.
+        workers (int): Processes writing records in parallel, -1 for all cpus.
+    Returns:
+        int: Number of neighbours written in total.
+    """
+    write = partial(write_neighbors, output_folder=output_folder, radius=radius)
+    if workers == -1:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        return sum(map(write, read_fasta(fasta_path)))
+    with ProcessPoolExecutor(workers) as executor:
+        return sum(executor.map(write, read_fasta(fasta_path), chunksize=4))
 
 
 if __name__ == '__main__':
-    output_path = Path(r"/outputs/native_neighbors")
+    parser = argparse.ArgumentParser(description="Write the neighbourhood of every peptide of a FASTA file")
+    parser.add_argument("--input", default=r"/outputs/natives.fasta", help="FASTA file with the peptides")
+    parser.add_argument("--output", default=r"/outputs/native_neighbors", help="Folder for the neighbour files")
+    parser.add_argument("--radius", type=int, default=1, help="Edit distance of the neighbourhood")
+    parser.add_argument("--workers", type=int, default=1, help="Parallel processes, -1 for all cpus")
+    args = parser.parse_args()
+
+    output_path = Path(args.output)
     output_path.mkdir(exist_ok=True)
-    fasta_to_neighbors(Path(r"/outputs/natives.fasta"),
-                       output_path)
+    fasta_to_neighbors(Path(args.input), output_path, radius=args.radius, workers=args.workers)
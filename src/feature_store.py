@@ -0,0 +1,261 @@
+"""
+Precomputed features of peptide libraries.
+A store is a directory with the Macrel feature matrix (and optionally the peptides descriptors)
+as raw row-major files read through np.memmap, the sequences one per line and meta.json.
+Appending writes the new rows first and meta.json last, rows after meta's row count are dropped on open,
+so an interrupted append never leaves a half-written store.
+Rescoring a library is then a pure inference pass, see score_store.
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+import calculator
+import fasta
+import features
+import instrumentation
+from predictor import MacrelPredictor
+
+STORE_VERSION = 1
+MACREL_COLUMNS = 22
+CHUNK_SIZE = 100_000
+_CANONICAL = frozenset(features.ALPHABET)
+
+
+def read_library(path, column=None, chunk_size=CHUNK_SIZE) -> Iterator[str]:
+    """
+    Sequences of a (gzipped) FASTA file, or of the column column of a csv file (Sequence or SEQUENCE by default).
+    """
+    path = Path(path)
+    if ".csv" not in path.suffixes:
+        yield from fasta.read_sequences(path)
+        return
+    import pandas as pd
+    if column is None:
+        header = pd.read_csv(path, nrows=0).columns
+        column = "Sequence" if "Sequence" in header else "SEQUENCE"
+    for chunk in pd.read_csv(path, usecols=[column], chunksize=chunk_size, keep_default_na=False):
+        yield from chunk[column].astype(str)
+
+
+class FeatureStore:
+    """
+    Feature rows of a growing set of distinct sequences, row i belongs to the i-th appended sequence.
+    The matrices are read-only memmaps, slices of them can be passed to MacrelPredictor.predict_matrix.
+    """
+    def __init__(self, path, peptides=False):
+        """
+        Opens the store in directory path, creating it if needed.
+        Args:
+            peptides (bool): For a new store, also keep calculator.peptides_descriptors_from_seqs.
+        """
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True, parents=True)
+        self._meta_path = self.path / "meta.json"
+        if self._meta_path.exists():
+            self.meta = json.loads(self._meta_path.read_text())
+            if self.meta.get("version") != STORE_VERSION:
+                raise ValueError(f"{self.path} has feature store version {self.meta.get('version')}, "
+                                 f"expected {STORE_VERSION}")
+        else:
+            self.meta = {"version": STORE_VERSION, "rows": 0, "sequences_bytes": 0,
+                         "peptides": peptides, "peptides_columns": None}
+        self._drop_uncommitted()
+        self._index = None
+        self._views = {}
+        self.skipped = 0
+
+    @property
+    def _sequences_path(self) -> Path:
+        return self.path / "sequences.txt"
+
+    def _matrix_path(self, name: str) -> Path:
+        return self.path / f"{name}.bin"
+
+    def _row_bytes(self, name: str) -> int:
+        if name == "macrel":
+            return MACREL_COLUMNS * np.dtype(np.float32).itemsize
+        return len(self.meta["peptides_columns"] or []) * np.dtype(np.float64).itemsize
+
+    def _drop_uncommitted(self):
+        # leftovers of an interrupted append
+        sizes = {self._sequences_path: self.meta["sequences_bytes"],
+                 self._matrix_path("macrel"): self.meta["rows"] * self._row_bytes("macrel")}
+        if self.meta["peptides"]:
+            sizes[self._matrix_path("peptides")] = self.meta["rows"] * self._row_bytes("peptides")
+        for file, size in sizes.items():
+            if file.exists() and file.stat().st_size > size:
+                os.truncate(file, size)
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def __contains__(self, sequence: str):
+        return sequence in self.index
+
+    def __repr__(self):
+        return f"FeatureStore({str(self.path)!r}, rows={len(self)}, peptides={self.meta['peptides']})"
+
+    def iter_sequences(self) -> Iterator[str]:
+        """
+        Sequences in row order, streamed from the index file.
+        """
+        if not len(self):
+            return
+        with open(self._sequences_path) as f:
+            for _, line in zip(range(len(self)), f):
+                yield line.rstrip("\n")
+
+    def sequences(self) -> list[str]:
+        return list(self.iter_sequences())
+
+    @property
+    def index(self) -> dict[str, int]:
+        """
+        Sequence -> row, read from the index file on first use.
+        """
+        if self._index is None:
+            self._index = {seq: row for row, seq in enumerate(self.iter_sequences())}
+        return self._index
+
+    def _view(self, name: str, dtype, columns: int) -> np.ndarray:
+        rows = len(self)
+        view = self._views.get(name)
+        if view is None or len(view) != rows:
+            if rows == 0:
+                view = np.empty((0, columns), dtype=dtype)
+            else:
+                view = np.memmap(self._matrix_path(name), dtype=dtype, mode="r", shape=(rows, columns))
+            self._views[name] = view
+        return view
+
+    @property
+    def macrel(self) -> np.ndarray:
+        """
+        float32 (rows, 22) Macrel features, as calculator.macrel_descriptors_from_seqs.
+        """
+        return self._view("macrel", np.float32, MACREL_COLUMNS)
+
+    @property
+    def peptides(self) -> np.ndarray:
+        """
+        float64 (rows, len(peptides_columns)) peptides descriptors, None if the store does not keep them.
+        """
+        if not self.meta["peptides"]:
+            return None
+        return self._view("peptides", np.float64, len(self.meta["peptides_columns"] or []))
+
+    @property
+    def peptides_columns(self) -> list[str]:
+        return self.meta["peptides_columns"]
+
+    def rows(self, sequences: Iterable[str]) -> np.ndarray:
+        """
+        Rows of sequences, raises KeyError for sequences that are not in the store.
+        """
+        index = self.index
+        return np.fromiter((index[seq] for seq in sequences), dtype=np.int64)
+
+    def macrel_features(self, sequences: Iterable[str]) -> np.ndarray:
+        return self.macrel[self.rows(sequences)]
+
+    def append(self, sequences: Iterable[str], chunk_size=CHUNK_SIZE, verbose=False) -> int:
+        """
+        Computes and stores the features of the sequences that are not in the store yet, chunk by chunk.
+        Every chunk is committed on its own. Empty sequences and sequences with residues outside
+        features.ALPHABET can't be featurized, they are skipped and counted in self.skipped.
+        Returns:
+            int: Number of new rows.
+        """
+        index = self.index
+        added = 0
+        skipped = 0
+        for chunk in fasta.chunked(sequences, chunk_size):
+            new = [seq for seq in dict.fromkeys(chunk) if seq not in index]
+            valid = [seq for seq in new if seq and _CANONICAL.issuperset(seq)]
+            skipped += len(new) - len(valid)
+            if valid:
+                with instrumentation.timer("feature_store.append", len(valid)):
+                    self._append_chunk(valid)
+                added += len(valid)
+            if verbose and new:
+                print(f"Stored {len(self)} sequences ({added} new, {skipped} skipped)")
+        self.skipped += skipped
+        return added
+
+    def _append_chunk(self, sequences: list[str]):
+        macrel = np.ascontiguousarray(calculator.macrel_descriptors_from_seqs(sequences), dtype=np.float32)
+        files = {"macrel": macrel}
+        if self.meta["peptides"]:
+            descriptors = calculator.peptides_descriptors_from_seqs(sequences)
+            if self.meta["peptides_columns"] is None:
+                self.meta["peptides_columns"] = [str(column) for column in descriptors.columns]
+            files["peptides"] = np.ascontiguousarray(descriptors[self.meta["peptides_columns"]].to_numpy(np.float64))
+
+        text = "".join(f"{seq}\n" for seq in sequences).encode()
+        for name, matrix in files.items():
+            self._write(self._matrix_path(name), matrix.tobytes())
+        self._write(self._sequences_path, text)
+
+        start = len(self)
+        self.meta["rows"] += len(sequences)
+        self.meta["sequences_bytes"] += len(text)
+        tmp = self._meta_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(self.meta, indent=2))
+        os.replace(tmp, self._meta_path)
+        for row, seq in enumerate(sequences, start=start):
+            self._index[seq] = row
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        with open(path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def score_store(store: FeatureStore, predictor: MacrelPredictor = None, batch_size=65536, start=0,
+                stop=None) -> np.ndarray:
+    """
+    AMP probabilities of rows start:stop of store, straight from the stored Macrel features.
+    """
+    predictor = predictor or MacrelPredictor()
+    return predictor.predict_matrix(store.macrel[start:stop], batch_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute features of peptide libraries and score them")
+    parser.add_argument("store", help="Directory of the feature store")
+    parser.add_argument("--add", nargs="+", default=[], metavar="FILE",
+                        help="FASTA or csv files whose sequences are added to the store")
+    parser.add_argument("--column", help="Sequence column of csv files (default: Sequence or SEQUENCE)")
+    parser.add_argument("--peptides", action="store_true",
+                        help="Also keep the peptides descriptors (only when the store is created)")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE, help="Sequences featurized at once")
+    parser.add_argument("--score", help="Write sequence,score of every stored sequence to this csv file")
+    parser.add_argument("--batch_size", type=int, default=65536, help="Rows per ONNX run when scoring")
+    args = parser.parse_args()
+
+    store = FeatureStore(args.store, peptides=args.peptides)
+    for file in args.add:
+        skipped = store.skipped
+        added = store.append(read_library(file, args.column), args.chunk_size, verbose=True)
+        print(f"Added {added} sequences of {file}, skipped {store.skipped - skipped} empty or non-canonical ones")
+    print(store)
+
+    if args.score:
+        import csv
+        from itertools import islice
+        predictor = MacrelPredictor()
+        with open(args.score, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["sequence", "score"])
+            sequences = store.iter_sequences()
+            for start in range(0, len(store), args.batch_size):
+                scores = score_store(store, predictor, args.batch_size, start, start + args.batch_size)
+                writer.writerows(zip(islice(sequences, len(scores)), scores.tolist()))
+        print(f"Saved {len(store)} scores to {args.score}")
@@ -0,0 +1,543 @@
+"""
+Calculates Macrel and modlamp features for whole batches of peptide sequences with NumPy.
+Sequences are integer encoded into a padded residue matrix,
+scales are looked up from tables and windowed terms are summed over shifted slices.
+Single-point mutants of one parent can be featurized incrementally from a SubstitutionState.
+"""
+from functools import lru_cache
+
+import numpy as np
+from macrel.database import eisenberg, instability2, _aa_groups
+from macrel.database import boman_scale, CTDD_groups
+from macrel.macrel_features import compute_all, pos_pks10, neg_pks10
+
+ALPHABET = "ACDEFGHIKLMNPQRSTVWY"
+_ALPHABET_SET = set(ALPHABET)
+PAD = len(ALPHABET)     # code of the padding after the end of shorter sequences
+UNKNOWN = 255           # code of residues outside ALPHABET
+
+_CODES = np.full(256, UNKNOWN, dtype=np.uint8)
+for _code, _aa in enumerate(ALPHABET):
+    _CODES[ord(_aa)] = _code
+
+
+def _table(scale: dict, default=0.0) -> np.ndarray:
+    """
+    Returns a lookup table indexed by residue code, the padding maps to 0.
+    """
+    return np.array([scale.get(aa, default) for aa in ALPHABET] + [0.0], dtype=np.float64)
+
+
+def _groups_matrix(groups) -> np.ndarray:
+    """
+    Returns a (residues, groups) membership matrix.
+    """
+    return np.array([[aa in group for group in groups] for aa in ALPHABET], dtype=np.int64)
+
+
+EISENBERG = _table(eisenberg)
+BOMAN = _table(boman_scale)
+INSTABILITY = np.zeros((PAD + 1, PAD + 1), dtype=np.float64)
+for _i, _a in enumerate(ALPHABET):
+    for _j, _b in enumerate(ALPHABET):
+        INSTABILITY[_i, _j] = instability2.get(_a + _b, 0.0)
+COMPOSITION_GROUPS = _groups_matrix(_aa_groups)
+CTDD_GROUPS = _groups_matrix(CTDD_groups)
+
+# charged residues in the same order as macrel sums them, termini are counted separately
+POS_CHARGED = [(ALPHABET.find(aa), pk10) for aa, pk10 in pos_pks10.items()]
+NEG_CHARGED = [(ALPHABET.find(aa), pk10) for aa, pk10 in neg_pks10.items()]
+
+HMOMENT_WINDOW = 11
+HMOMENT_ANGLE = 100
+
+# modlamp scale (modlamp.core.load_scale("eisenberg"), copied because modlamp.core imports scikit-learn)
+# and pKs (modlamp.descriptors._charge), used by PeptideDescriptor / GlobalDescriptor
+MODLAMP_EISENBERG = _table({"I": 1.4, "F": 1.2, "V": 1.1, "L": 1.1, "W": 0.81, "M": 0.64, "A": 0.62, "G": 0.48,
+                            "C": 0.29, "Y": 0.26, "P": 0.12, "T": -0.05, "S": -0.18, "H": -0.4, "E": -0.74,
+                            "N": -0.78, "Q": -0.85, "D": -0.9, "K": -1.5, "R": -2.5})
+MODLAMP_POS_PKS = {"Nterm": 9.38, "K": 10.67, "R": 12.10, "H": 6.04}
+MODLAMP_NEG_PKS = {"Cterm": 2.15, "D": 3.71, "E": 4.15, "C": 8.14, "Y": 10.10}
+MODLAMP_AMIDE_CTERM_PK = 15.0
+MODLAMP_HYDROPHOBIC = [ALPHABET.index(aa) for aa in "ACFILMV"]
+MODLAMP_DESCRIPTORS = ["moment", "hydrophobicity", "charge", "hydrophobic_ratio"]
+
+# residues of ProteinAnalysis.secondary_structure_fraction (Biopython >= 1.82), summed in this order
+SECONDARY_STRUCTURE = {"helix": "EMALK", "turn": "NPGSD", "sheet": "VIYFWLT"}
+
+
+def encode(sequences: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Integer encodes sequences.
+    Args:
+        sequences (list[str]): Peptide sequences.
+    Returns:
+        np.ndarray: uint8 matrix of shape (n, max_length), rows padded with PAD, unknown residues are UNKNOWN.
+        np.ndarray: Lengths of the sequences.
+    """
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    width = int(lengths.max()) if len(sequences) else 0
+    matrix = np.full((len(sequences), width), PAD, dtype=np.uint8)
+    flat = np.frombuffer("".join(sequences).encode("ascii", errors="replace"), dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    rows = np.repeat(np.arange(len(sequences)), lengths)
+    cols = np.arange(len(flat)) - np.repeat(starts, lengths)
+    matrix[rows, cols] = _CODES[flat]
+    return matrix, lengths
+
+
+def _encoded(sequences) -> tuple[np.ndarray, np.ndarray]:
+    # a PeptideBatch is already encoded
+    if hasattr(sequences, "encoded"):
+        return sequences.encoded()
+    return encode(sequences)
+
+
+def residue_counts(matrix: np.ndarray) -> np.ndarray:
+    """
+    Returns (n, len(ALPHABET)) counts of every residue in every row of an encoded matrix.
+    """
+    n = matrix.shape[0]
+    offsets = (np.arange(n, dtype=np.int64) * (PAD + 1))[:, None]
+    counts = np.bincount((matrix + offsets).ravel(), minlength=n * (PAD + 1))
+    return counts.reshape(n, PAD + 1)[:, :PAD]
+
+
+def first_positions(matrix: np.ndarray) -> np.ndarray:
+    """
+    Returns (n, len(ALPHABET)) index of the first occurrence of every residue, matrix width if it is absent.
+    """
+    n, width = matrix.shape
+    first = np.full((n, PAD + 1), width, dtype=np.int64)
+    rows = np.arange(n)
+    for position in range(width - 1, -1, -1):
+        first[rows, matrix[:, position]] = position
+    return first[:, :PAD]
+
+
+def _ordered_sum(sorted_counts: np.ndarray, order: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    """
+    Sums counts * scale over residues in the order of their first occurrence,
+    which is the order macrel iterates its Counter in.
+    sorted_counts are the counts taken along order = argsort(first_positions).
+    """
+    return np.cumsum(sorted_counts * scale[order], axis=1)[:, -1]
+
+
+def _charged_counts(counts: np.ndarray) -> np.ndarray:
+    """
+    Returns (n, 9) counts of the charged groups in the order of POS_CHARGED + NEG_CHARGED.
+    """
+    terminus = np.ones(counts.shape[0], dtype=np.int64)
+    return np.column_stack([terminus if code < 0 else counts[:, code] for code, _ in POS_CHARGED + NEG_CHARGED])
+
+
+def _unique_rows(rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    np.unique(rows, axis=0, return_inverse=True) for small non-negative integer rows.
+    """
+    radix = rows.max(axis=0) + 1
+    if np.prod(radix.astype(np.float64)) >= 2 ** 62:
+        unique, inverse = np.unique(rows, axis=0, return_inverse=True)
+        return unique, inverse.reshape(-1)
+    weights = np.concatenate([np.cumprod(radix[::-1])[::-1][1:], [1]])
+    keys, first, inverse = np.unique(rows @ weights, return_index=True, return_inverse=True)
+    return rows[first], inverse.reshape(-1)
+
+
+_PK10 = np.array([pk10 for _, pk10 in POS_CHARGED + NEG_CHARGED])
+_IS_POS = np.arange(len(_PK10)) < len(POS_CHARGED)
+
+
+def _charge(charged: np.ndarray, ph: np.ndarray) -> np.ndarray:
+    """
+    Vectorized macrel.macrel_features.pep_charge_aa.
+    The cumulative sum adds the terms in macrel's order, negative groups are subtracted.
+    """
+    ph10 = (10 ** ph)[:, None]
+    c_r = np.where(_IS_POS, _PK10 / ph10, ph10 / _PK10)
+    partial_charge = c_r / (c_r + 1.0)
+    terms = charged * partial_charge
+    return np.cumsum(np.where(_IS_POS, terms, -terms), axis=1)[:, -1]
+
+
+def _isoelectric_point(charged: np.ndarray, charge: np.ndarray) -> np.ndarray:
+    """
+    Vectorized macrel.macrel_features.isoelectric_point, charge is the net charge at pH 7.
+    Every sequence follows the same steps as in macrel, finished ones are masked out.
+    """
+    ph = np.full(len(charge), 7.0)
+    charge = charge.copy()
+    up = charge > 0.0
+    for step, active in ((1.0, up), (-1.0, ~up & (charge < 0.0))):
+        idx = np.flatnonzero(active)
+        while len(idx):
+            ph[idx] += step
+            charge[idx] = _charge(charged[idx], ph[idx])
+            idx = idx[charge[idx] > 0.0] if step > 0 else idx[charge[idx] < 0.0]
+
+    ph1 = np.where(up, ph - 1.0, ph)
+    ph2 = np.where(up, ph, ph + 1.0)
+    idx = np.flatnonzero((ph2 - ph1 > 0.0001) & (charge != 0.0))
+    while len(idx):
+        mid = (ph1[idx] + ph2[idx]) / 2.0
+        ph[idx] = mid
+        mid_charge = _charge(charged[idx], mid)
+        positive = mid_charge > 0.0
+        ph1[idx[positive]] = mid[positive]
+        ph2[idx[~positive]] = mid[~positive]
+        idx = idx[(ph2[idx] - ph1[idx] > 0.0001) & (mid_charge != 0.0)]
+    return ph
+
+
+def _instability_index(matrix: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    if matrix.shape[1] < 2:
+        return np.zeros(len(lengths))
+    pairs = INSTABILITY[matrix[:, :-1], matrix[:, 1:]]
+    return (10.0 / lengths) * np.cumsum(pairs, axis=1)[:, -1]
+
+
+def window_moments(values: np.ndarray, window: int, angle=HMOMENT_ANGLE) -> np.ndarray:
+    """
+    Returns squared moments vsin**2 + vcos**2 of all windows of a (n, width) matrix of scale values.
+    """
+    rads = angle * (np.pi / 180) * np.arange(window)
+    n_windows = values.shape[1] - window + 1
+    vcos = np.zeros((values.shape[0], n_windows))
+    vsin = np.zeros((values.shape[0], n_windows))
+    for k in range(window):
+        vcos += values[:, k:k + n_windows] * np.cos(rads[k])
+        vsin += values[:, k:k + n_windows] * np.sin(rads[k])
+    return vsin ** 2 + vcos ** 2
+
+
+def _hmoment(matrix: np.ndarray, lengths: np.ndarray, window=HMOMENT_WINDOW) -> np.ndarray:
+    """
+    Vectorized macrel.macrel_features.hmoment, the maximal moment over windows of the eisenberg scale.
+    """
+    values = EISENBERG[matrix]
+    result = np.zeros(len(lengths))
+    long = lengths >= window
+    if long.any():
+        moms = window_moments(values[long], window)
+        valid = np.arange(moms.shape[1]) <= (lengths[long] - window)[:, None]
+        result[long] = np.sqrt(np.where(valid, moms, -1.0).max(axis=1)) / window
+    for length in np.unique(lengths[~long]):
+        rows = lengths == length
+        result[rows] = np.sqrt(window_moments(values[rows, :length], length)[:, 0]) / length
+    return result
+
+
+def _ctdd(first: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    group_first = np.stack([first[:, group.astype(bool)].min(axis=1) for group in CTDD_GROUPS.T], axis=1)
+    found = group_first < lengths[:, None]
+    return np.where(found, (group_first + 1) / lengths[:, None] * 100, 0.0)
+
+
+def macrel_features(matrix: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Computes the 22 Macrel features of encoded sequences in the order of macrel's compute_all.
+    The matrix must not contain UNKNOWN residues or empty sequences.
+    Returns:
+        np.ndarray: float64 array of shape (n, 22).
+    """
+    counts = residue_counts(matrix)
+    first = first_positions(matrix)
+    return _macrel_columns(matrix, lengths, counts, first, _hmoment(matrix, lengths))
+
+
+def _macrel_columns(matrix: np.ndarray, lengths: np.ndarray, counts: np.ndarray, first: np.ndarray,
+                    hmoment: np.ndarray) -> np.ndarray:
+    lengths_f = lengths.astype(np.float64)
+
+    composition = (counts @ COMPOSITION_GROUPS) / lengths[:, None]
+
+    # charge and pI only depend on the charged counts, which repeat a lot within a batch
+    charged, inverse = _unique_rows(_charged_counts(counts))
+    charge = _charge(charged, np.full(len(charged), 7.0))
+    pi = _isoelectric_point(charged, charge)[inverse]
+    charge = charge[inverse]
+
+    a, v = counts[:, ALPHABET.index("A")], counts[:, ALPHABET.index("V")]
+    i, l = counts[:, ALPHABET.index("I")], counts[:, ALPHABET.index("L")]
+    aliphatic = 100.0 * (a + 2.9 * v + 3.9 * (i + l)) / lengths_f
+
+    order = np.argsort(first, axis=1, kind="stable")
+    sorted_counts = np.take_along_axis(counts, order, axis=1)
+
+    return np.column_stack([
+        composition,
+        charge,
+        pi,
+        aliphatic,
+        _instability_index(matrix, lengths),
+        _ordered_sum(sorted_counts, order, BOMAN) / lengths_f,
+        _ordered_sum(sorted_counts, order, EISENBERG) / lengths_f,
+        hmoment,
+        _ctdd(first, lengths),
+    ])
+
+
+def macrel_descriptors_from_seqs(sequences: list[str]) -> np.ndarray:
+    """
+    Computes the 22 Macrel features for a batch of sequences, a list of str or a PeptideBatch.
+    Sequences with residues outside ALPHABET are passed to macrel's compute_all one by one.
+    Returns:
+        np.ndarray: float32 array of shape (n, 22) for ONNX.
+    """
+    matrix, lengths = _encoded(sequences)
+    supported = (lengths > 0) & (matrix != UNKNOWN).all(axis=1)
+    features = np.empty((len(sequences), 22), dtype=np.float32)
+    if supported.any():
+        features[supported] = macrel_features(matrix[supported], lengths[supported])
+    for idx in np.flatnonzero(~supported):
+        features[idx] = compute_all(sequences[idx])
+    return features
+
+
+def modlamp_moment(values: np.ndarray, angle=HMOMENT_ANGLE) -> np.ndarray:
+    """
+    Global hydrophobic moment of equally long rows of scale values,
+    as PeptideDescriptor.calculate_moment with a window longer than the sequences.
+    """
+    rads = angle * (np.pi / 180) * np.arange(values.shape[1])
+    vcos = (values * np.cos(rads)).sum(axis=1)
+    vsin = (values * np.sin(rads)).sum(axis=1)
+    return np.sqrt(vsin ** 2 + vcos ** 2) / values.shape[1]
+
+
+def modlamp_charge(counts: np.ndarray, ph=7.4, amide=True) -> np.ndarray:
+    """
+    Net charge from residue counts, as GlobalDescriptor.calculate_charge (rounded to 3 decimals).
+    """
+    neg_pks = dict(MODLAMP_NEG_PKS, Cterm=MODLAMP_AMIDE_CTERM_PK) if amide else MODLAMP_NEG_PKS
+    terminus = np.ones(counts.shape[0])
+    pos_charge = np.zeros(counts.shape[0])
+    for aa, pk in MODLAMP_POS_PKS.items():
+        c_r = 10 ** (pk - ph)
+        pos_charge += (terminus if aa == "Nterm" else counts[:, ALPHABET.index(aa)]) * (c_r / (c_r + 1.0))
+    neg_charge = np.zeros(counts.shape[0])
+    for aa, pk in neg_pks.items():
+        c_r = 10 ** (ph - pk)
+        neg_charge += (terminus if aa == "Cterm" else counts[:, ALPHABET.index(aa)]) * (c_r / (c_r + 1.0))
+    # python's round, np.round differs on ties and the charge bands are compared on rounded values
+    return np.array([round(z, 3) for z in (pos_charge - neg_charge).tolist()])
+
+
+def modlamp_hydrophobic_ratio(counts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Relative frequency of A, C, F, I, L, M and V, as GlobalDescriptor.hydrophobic_ratio.
+    """
+    return counts[:, MODLAMP_HYDROPHOBIC].sum(axis=1) / lengths.astype(np.float64)
+
+
+def modlamp_descriptors_from_seqs(sequences: list[str], ph=7.4, amide=True) -> dict[str, np.ndarray]:
+    """
+    Computes modlamp-style descriptors for a batch of sequences: global eisenberg hydrophobic moment,
+    mean hydrophobicity, charge and hydrophobic ratio.
+    Moments are summed per sequence length, so they equal modlamp's values exactly.
+    Sequences with residues outside ALPHABET are computed with modlamp one by one.
+    Returns:
+        dict of float64 arrays of shape (n,).
+    """
+    matrix, lengths = _encoded(sequences)
+    supported = (lengths > 0) & (matrix != UNKNOWN).all(axis=1)
+    descriptors = {name: np.empty(len(sequences)) for name in MODLAMP_DESCRIPTORS}
+    if supported.any():
+        matrix, lengths = matrix[supported], lengths[supported]
+        values = MODLAMP_EISENBERG[matrix]
+        counts = residue_counts(matrix)
+        moment = np.empty(len(lengths))
+        hydrophobicity = np.empty(len(lengths))
+        for length in np.unique(lengths):
+            rows = lengths == length
+            length_values = values[rows, :length]
+            moment[rows] = modlamp_moment(length_values)
+            hydrophobicity[rows] = length_values.sum(axis=1) / float(length)
+        descriptors["moment"][supported] = moment
+        descriptors["hydrophobicity"][supported] = hydrophobicity
+        descriptors["charge"][supported] = modlamp_charge(counts, ph=ph, amide=amide)
+        descriptors["hydrophobic_ratio"][supported] = modlamp_hydrophobic_ratio(counts, lengths)
+    for idx in np.flatnonzero(~supported):
+        for name, value in _modlamp_reference(sequences[idx], ph, amide).items():
+            descriptors[name][idx] = value
+    return descriptors
+
+
+def _modlamp_reference(sequence: str, ph: float, amide: bool) -> dict[str, float]:
+    from modlamp.descriptors import GlobalDescriptor, PeptideDescriptor
+    pep = PeptideDescriptor(sequence, 'eisenberg')
+    pep.calculate_moment(window=1000, angle=HMOMENT_ANGLE)
+    moment = pep.descriptor[0][0]
+    pep.calculate_global(window=1000, modality='mean')
+    glob = GlobalDescriptor(sequence)
+    glob.calculate_charge(ph=ph, amide=amide)
+    charge = glob.descriptor[0][0]
+    glob.hydrophobic_ratio()
+    return {"moment": moment, "hydrophobicity": pep.descriptor[0][0],
+            "charge": charge, "hydrophobic_ratio": glob.descriptor[0][0]}
+
+
+def secondary_structure_from_seqs(sequences: list[str]) -> np.ndarray:
+    """
+    Computes helix, turn and sheet fractions for a batch of sequences,
+    same values as Biopython's ProteinAnalysis.secondary_structure_fraction.
+    Returns:
+        np.ndarray: float64 array of shape (n, 3).
+    """
+    matrix, lengths = _encoded(sequences)
+    supported = (lengths > 0) & (matrix != UNKNOWN).all(axis=1)
+    fractions = np.empty((len(sequences), len(SECONDARY_STRUCTURE)))
+    if supported.any():
+        counts = residue_counts(matrix[supported])
+        for col, residues in enumerate(SECONDARY_STRUCTURE.values()):
+            fraction = np.zeros(len(counts))
+            for aa in residues:
+                fraction += counts[:, ALPHABET.index(aa)] * 100 / lengths[supported] / 100
+            fractions[supported, col] = fraction
+    if not supported.all():
+        from Bio.SeqUtils.ProtParam import ProteinAnalysis
+    for idx in np.flatnonzero(~supported):
+        fractions[idx] = ProteinAnalysis(sequences[idx]).secondary_structure_fraction()
+    return fractions
+
+
+class SubstitutionState:
+    """
+    Cached state of a parent sequence for featurizing its single-point mutants.
+    Counts and first occurrences are updated in O(1) per mutant and the hydrophobic moment
+    only recomputes the windows that cover the substituted position, all values are equal
+    to the batch engine on the mutant sequences.
+    """
+    def __init__(self, sequence: str):
+        matrix, lengths = encode([sequence])
+        self.sequence = sequence
+        self.length = len(sequence)
+        self.codes = matrix[0]
+        self.counts = residue_counts(matrix)[0]
+        self.first = first_positions(matrix)[0]
+
+        # next position of the same residue, so the first occurrence can move when it is substituted
+        self.next_same = np.full(self.length, self.length, dtype=np.int64)
+        last = {}
+        for position in range(self.length - 1, -1, -1):
+            code = int(self.codes[position])
+            self.next_same[position] = last.get(code, self.length)
+            last[code] = position
+
+        self.moments = None
+        if self.length >= 2 * HMOMENT_WINDOW - 1:
+            self.moments = window_moments(EISENBERG[self.codes][None, :], HMOMENT_WINDOW)[0]
+            self.prefix_max = np.maximum.accumulate(self.moments)
+            self.suffix_max = np.maximum.accumulate(self.moments[::-1])[::-1]
+
+    def mutants(self, positions: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """
+        Returns the encoded (m, length) matrix of the mutants.
+        """
+        matrix = np.tile(self.codes, (len(positions), 1))
+        matrix[np.arange(len(positions)), positions] = codes
+        return matrix
+
+    def counts_and_first(self, positions: np.ndarray, codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns residue counts and first positions of the mutants, same as residue_counts and first_positions.
+        """
+        rows = np.arange(len(positions))
+        old = self.codes[positions]
+        counts = np.tile(self.counts, (len(positions), 1))
+        counts[rows, old] -= 1
+        counts[rows, codes] += 1
+
+        first = np.tile(self.first, (len(positions), 1))
+        moved = first[rows, old] == positions
+        first[rows[moved], old[moved]] = self.next_same[positions[moved]]
+        first[rows, codes] = np.minimum(first[rows, codes], positions)
+        return counts, first
+
+    def hmoment(self, matrix: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """
+        Macrel hydrophobic moment of the mutants, recomputing only the windows around the substitution.
+        """
+        if self.moments is None:
+            return _hmoment(matrix, np.full(len(positions), self.length))
+        window = HMOMENT_WINDOW
+        n_windows = len(self.moments)
+        # 2 * window - 1 residues hold all windows that contain the substituted position
+        start = np.clip(positions - (window - 1), 0, n_windows - window)
+        cols = start[:, None] + np.arange(2 * window - 1)
+        local = window_moments(EISENBERG[np.take_along_axis(matrix, cols, axis=1)], window).max(axis=1)
+        before = np.where(start > 0, self.prefix_max[np.maximum(start - 1, 0)], -1.0)
+        after = np.where(start + window < n_windows,
+                         self.suffix_max[np.minimum(start + window, n_windows - 1)], -1.0)
+        return np.sqrt(np.maximum(local, np.maximum(before, after))) / window
+
+
+@lru_cache(maxsize=64)
+def substitution_state(sequence: str) -> SubstitutionState | None:
+    """
+    Returns the cached SubstitutionState of sequence or None if it has residues outside ALPHABET.
+    """
+    if not sequence or not set(sequence) <= _ALPHABET_SET:
+        return None
+    return SubstitutionState(sequence)
+
+
+def _substitutions(sequence: str, positions: list[int], residues: list[str]):
+    """
+    Returns the parent state with encoded positions and residues, None if the fast path does not apply.
+    """
+    state = substitution_state(sequence)
+    residues = "".join(residues)
+    if state is None or len(residues) != len(positions) or not set(residues) <= _ALPHABET_SET:
+        return None
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1)
+    codes = _CODES[np.frombuffer(residues.encode("ascii"), dtype=np.uint8)]
+    return state, positions, codes
+
+
+def mutate(sequence: str, positions: list[int], residues: list[str]) -> list[str]:
+    """
+    Returns single-point mutants of sequence with residues[i] at positions[i].
+    """
+    return [sequence[:pos] + aa + sequence[pos + 1:] for pos, aa in zip(positions, residues)]
+
+
+def macrel_descriptors_of_substitutions(sequence: str, positions: list[int], residues: list[str]) -> np.ndarray:
+    """
+    Computes the 22 Macrel features of single-point mutants of sequence, residues[i] at positions[i],
+    incrementally from the parent's cached state.
+    Returns:
+        np.ndarray: float32 array of shape (len(positions), 22), same values as macrel_descriptors_from_seqs.
+    """
+    parsed = _substitutions(sequence, positions, residues)
+    if parsed is None:
+        return macrel_descriptors_from_seqs(mutate(sequence, positions, residues))
+    state, positions, codes = parsed
+    matrix = state.mutants(positions, codes)
+    counts, first = state.counts_and_first(positions, codes)
+    lengths = np.full(len(positions), state.length)
+    return _macrel_columns(matrix, lengths, counts, first, state.hmoment(matrix, positions)).astype(np.float32)
+
+
+def modlamp_descriptors_of_substitutions(sequence: str, positions: list[int], residues: list[str],
+                                         ph=7.4, amide=True) -> dict[str, np.ndarray] | None:
+    """
+    Computes modlamp-style descriptors of single-point mutants of sequence:
+    global eisenberg hydrophobic moment, mean hydrophobicity, charge and hydrophobic ratio.
+    Returns:
+        dict of arrays or None if a residue is outside ALPHABET.
+    """
+    parsed = _substitutions(sequence, positions, residues)
+    if parsed is None:
+        return None
+    state, positions, codes = parsed
+    values = MODLAMP_EISENBERG[state.mutants(positions, codes)]
+    counts, _ = state.counts_and_first(positions, codes)
+    lengths = np.full(len(positions), state.length)
+    return {
+        "moment": modlamp_moment(values),
+        "hydrophobicity": values.sum(axis=1) / float(state.length),
+        "charge": modlamp_charge(counts, ph=ph, amide=amide),
+        "hydrophobic_ratio": modlamp_hydrophobic_ratio(counts, lengths),
+    }
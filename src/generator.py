@@ -2,25 +2,25 @@
 This module generates various thingies...
 """
 import random
-from modlamp.sequences import Helices
-from modlamp.descriptors import GlobalDescriptor
-from modlamp.sequences import Helices
-from modlamp.descriptors import GlobalDescriptor
+from typing import Iterator
 
-aabet = "ACDEFGHIKLMNPQRSTVWY"
-aabet_without_C = "ADEFGHIKLMNPQRSTVWY"
+import numpy as np
 
+import instrumentation
+from features import encode
+from peptide_batch import PeptideBatch
 
-from modlamp.sequences import AmphipathicArc
-from modlamp.descriptors import GlobalDescriptor, PeptideDescriptor
-from modlamp.sequences import Kinked
-from modlamp.descriptors import GlobalDescriptor, PeptideDescriptor
+aabet = "ACDEFGHIKLMNPQRSTVWY"
+aabet_without_C = "ADEFGHIKLMNPQRSTVWY"
 
 
+# modlamp.sequences pulls in scikit-learn, the template generators import it when called
 def generate_killer_kinks(n_candidates=10, min_len=18, max_len=25):
     """
     Generates kinked AMPs and identifies the hinge (Proline) position.
     """
+    from modlamp.sequences import Kinked
+    from modlamp.descriptors import GlobalDescriptor, PeptideDescriptor
     # 1. Generate sequences using the Kinked rule (basic residues every 3-4 AAs)
     lib = Kinked(n_candidates, min_len, max_len)
     lib.generate_sequences()
@@ -60,6 +60,8 @@ def generate_amphipatic_helices(n_candidates=100, min_len=18, max_len=25):
     """
     Generates potential helical AMPs, filtering for high amphipathicity and positive charge.
     """
+    from modlamp.sequences import AmphipathicArc
+    from modlamp.descriptors import GlobalDescriptor, PeptideDescriptor
     # 1. Generate Raw Candidates using an alpha-helix template (180 degree arc)
     # This class places Hydrophobic vs Polar AAs in a helical pattern.
     lib = AmphipathicArc(n_candidates, min_len, max_len)
@@ -113,13 +115,14 @@ def generate_completions(sequence: str, masked_positions: list[int], num_complet
         used_alphabet = aabet
 
     completions = []
-    for _ in range(num_completions):
-        completion = list(sequence)
-        for pos in masked_positions:
-            original_aa = completion[pos]
-            new_aa = choose_aa(original_aa, used_alphabet=used_alphabet)
-            completion[pos] = new_aa
-        completions.append("".join(completion))
+    with instrumentation.timer("generator.completions", num_completions):
+        for _ in range(num_completions):
+            completion = list(sequence)
+            for pos in masked_positions:
+                original_aa = completion[pos]
+                new_aa = choose_aa(original_aa, used_alphabet=used_alphabet)
+                completion[pos] = new_aa
+            completions.append("".join(completion))
     return completions
 
 
@@ -136,22 +139,171 @@ def generate_neighbours(sequence: str, num_neighbours: int, forget_cys=False) ->
         used_alphabet = aabet
 
     neighbours = []
-    for _ in range(num_neighbours):
-        neighbour = list(sequence)
-        pos = random.randint(0, len(sequence) - 1)
-        original_aa = neighbour[pos]
-        new_aa = choose_aa(original_aa, used_alphabet=used_alphabet)
-        neighbour[pos] = new_aa
-        neighbours.append("".join(neighbour))
+    with instrumentation.timer("generator.neighbours", num_neighbours):
+        for _ in range(num_neighbours):
+            neighbour = list(sequence)
+            pos = random.randint(0, len(sequence) - 1)
+            original_aa = neighbour[pos]
+            new_aa = choose_aa(original_aa, used_alphabet=used_alphabet)
+            neighbour[pos] = new_aa
+            neighbours.append("".join(neighbour))
     return neighbours
 
 
-def generate_all_neighbors(peptide: str, alphabet: str = aabet_without_C) -> list[str]:
-    neighbors = []
+def spawn_seeds(seed, n: int) -> list[np.random.SeedSequence]:
+    """
+    n independent child seeds of seed, e.g. one random stream per worker:
+    rng = np.random.default_rng(spawn_seeds(seed, workers)[worker])
+    """
+    return np.random.SeedSequence(seed).spawn(n)
+
+
+def _replacement_table(alphabet: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Codes of alphabet and, for every residue code, how many other residues of alphabet it can be replaced with.
+    """
+    codes = np.sort(encode([alphabet])[0].reshape(-1))
+    in_alphabet = np.zeros(256, dtype=bool)
+    in_alphabet[codes] = True
+    return codes, len(codes) - in_alphabet
+
+
+def _draw_replacements(rng: np.random.Generator, original: np.ndarray, codes: np.ndarray,
+                       choices: np.ndarray) -> np.ndarray:
+    # uniform over alphabet without the original residue, like choose_aa: draw among the other
+    # residues and skip the original's slot
+    drawn = (rng.random(original.shape) * choices[original]).astype(np.int64)
+    original_slot = np.searchsorted(codes, original)
+    skip = (original_slot < len(codes)) & (codes[np.minimum(original_slot, len(codes) - 1)] == original)
+    drawn += skip & (drawn >= original_slot)
+    return codes[drawn]
+
+
+def _unique_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Indices of the first occurrence of every distinct row, in order.
+    """
+    matrix = np.ascontiguousarray(matrix)
+    keys = matrix.view(np.dtype((np.void, matrix.shape[1]))).ravel()
+    return np.sort(np.unique(keys, return_index=True)[1])
+
+
+def sample_completions(sequence: str, masked_positions: list[int], num_completions: int, forget_cys=False,
+                       seed=None, unique=False, as_batch=False) -> list[str] | PeptideBatch:
+    """
+    Vectorized, seeded generate_completions: all masked positions of all completions are drawn at once.
+    Args:
+        sequence (str): source sequence of canonical residues
+        masked_positions (list[int]): Positions to be changed.
+        num_completions (int): Number of generated peptides.
+        seed: int, np.random.SeedSequence (see spawn_seeds) or np.random.Generator, None for fresh entropy.
+        unique (bool): Drop repeated completions and draw again until num_completions distinct ones exist
+            or all possible completions are generated.
+        as_batch (bool): Return a PeptideBatch instead of strings.
+    """
+    rng = np.random.default_rng(seed)
+    codes, choices = _replacement_table(aabet_without_C if forget_cys else aabet)
+    matrix, lengths = encode([sequence])
+    masked_positions = np.asarray(masked_positions, dtype=np.int64)
+    original = matrix[0, masked_positions]
+    if unique:
+        possible = np.prod(choices[original].astype(np.float64))
+        num_completions = int(min(num_completions, possible))
+
+    with instrumentation.timer("generator.sample_completions", num_completions):
+        drawn = np.empty((0, len(masked_positions)), dtype=np.uint8)
+        while len(drawn) < num_completions:
+            missing = num_completions - len(drawn)
+            new = _draw_replacements(rng, np.broadcast_to(original, (missing, len(original))), codes, choices)
+            drawn = np.concatenate([drawn, new.astype(np.uint8)])
+            if not unique:
+                break
+            drawn = drawn[_unique_rows(drawn)]
+        completions = np.repeat(matrix, num_completions, axis=0)
+        completions[:, masked_positions] = drawn
+    batch = PeptideBatch(completions, np.repeat(lengths, num_completions))
+    return batch if as_batch else batch.to_strings()
+
+
+def sample_neighbours(sequence: str, num_neighbours: int, forget_cys=False, seed=None, unique=False,
+                      as_batch=False) -> list[str] | PeptideBatch:
+    """
+    Vectorized, seeded generate_neighbours: positions and new residues of all neighbours are drawn at once.
+    Args:
+        sequence (str): source sequence of canonical residues
+        num_neighbours (int): Number of generated peptides.
+        seed: int, np.random.SeedSequence (see spawn_seeds) or np.random.Generator, None for fresh entropy.
+        unique (bool): Drop repeated neighbours and draw again until num_neighbours distinct ones exist
+            or the whole single-point neighbourhood is generated.
+        as_batch (bool): Return a PeptideBatch instead of strings.
+    """
+    rng = np.random.default_rng(seed)
+    codes, choices = _replacement_table(aabet_without_C if forget_cys else aabet)
+    matrix, lengths = encode([sequence])
+    if unique:
+        num_neighbours = int(min(num_neighbours, choices[matrix[0]].sum()))
+
+    with instrumentation.timer("generator.sample_neighbours", num_neighbours):
+        positions = np.empty(0, dtype=np.int64)
+        residues = np.empty(0, dtype=np.uint8)
+        while len(positions) < num_neighbours:
+            missing = num_neighbours - len(positions)
+            new_positions = rng.integers(0, len(sequence), missing)
+            positions = np.concatenate([positions, new_positions])
+            residues = np.concatenate([residues, _draw_replacements(rng, matrix[0, new_positions], codes, choices)
+                                       .astype(np.uint8)])
+            if not unique:
+                break
+            first = np.sort(np.unique(positions * 256 + residues, return_index=True)[1])
+            positions, residues = positions[first], residues[first]
+        neighbours = np.repeat(matrix, num_neighbours, axis=0)
+        neighbours[np.arange(num_neighbours), positions] = residues
+    batch = PeptideBatch(neighbours, np.repeat(lengths, num_neighbours))
+    return batch if as_batch else batch.to_strings()
+
+
+def _single_edits(peptide: str, alphabet: str) -> Iterator[str]:
+    """
+    Yields distinct single substitutions, insertions and deletions of peptide.
+    Only the first residue of a run of equal residues is deleted and a residue is only inserted
+    in front of a different one, so no string comes out twice.
+    """
     for i in range(len(peptide)):
-        neighbors.append(peptide[:i] + peptide[i + 1:])
+        if i == 0 or peptide[i - 1] != peptide[i]:
+            yield peptide[:i] + peptide[i + 1:]
         for aa in alphabet:
             if aa != peptide[i]:
-                neighbors.append(peptide[:i] + aa + peptide[i + 1:])
-                neighbors.append(peptide[:i] + aa + peptide[i:])
+                yield peptide[:i] + aa + peptide[i + 1:]
+                yield peptide[:i] + aa + peptide[i:]
+
+
+def iter_neighbors(peptide: str, alphabet: str = aabet_without_C, radius: int = 1) -> Iterator[str]:
+    """
+    Yields every distinct peptide within radius edits of peptide once, the peptide itself excluded.
+    Edits are substitutions, deletions and insertions in front of a residue.
+    Args:
+        peptide (str): source sequence
+        alphabet (str): residues used for substitutions and insertions
+        radius (int): 1 streams the neighbourhood, 2 also yields neighbours of neighbours
+    """
+    if radius == 1:
+        yield from _single_edits(peptide, alphabet)
+        return
+    seen = {peptide}
+    frontier = [peptide]
+    for _ in range(radius):
+        next_frontier = []
+        for sequence in frontier:
+            for neighbor in _single_edits(sequence, alphabet):
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    next_frontier.append(neighbor)
+                    yield neighbor
+        frontier = next_frontier
+
+
+def generate_all_neighbors(peptide: str, alphabet: str = aabet_without_C) -> list[str]:
+    with instrumentation.timer("generator.all_neighbors") as timer:
+        neighbors = list(iter_neighbors(peptide, alphabet))
+        timer.items = len(neighbors)
     return neighbors
@@ -1,14 +1,14 @@
 """
 Here is code for lead optimization.
 """
+import numpy as np
 import pandas as pd
 
-from generator import generate_completions
-import calculator
+from generator import sample_completions
 from predictor import MacrelPredictor
 
 
-def climb_high(seq: str, positions: list[int], num_completions=10, epochs=10, mask_all=False, until_finished=False, verbose=False) -> str:
+def climb_high(seq: str, positions: list[int], num_completions=10, epochs=10, mask_all=False, until_finished=False, verbose=False, seed=None) -> str:
     """
     Optimizes peptide sequence with hill climbing.
         Args:
@@ -19,9 +19,12 @@ def climb_high(seq: str, positions: list[int], num_completions=10, epochs=10, ma
             mask_all (bool): If true, ignores "positions" and masks all positions.
             until_finished (bool): If true, ignores "epochs" and generates until new sequence is equal to the previous one.
             verbose (bool): If true, prints new seq and its AMP proba every epoch.
+            seed: Seed of the mutant generation (int, np.random.SeedSequence or np.random.Generator).
         Returns:
             str: Optimalized sequence.
     """
+    macrel = MacrelPredictor()
+    rng = np.random.default_rng(seed)
     counter = 0
     while (counter < epochs) or until_finished:
         if mask_all:
@@ -29,20 +32,17 @@ def climb_high(seq: str, positions: list[int], num_completions=10, epochs=10, ma
 
         # Mutants
         all_mutants = []
+        mutated_positions = []
         for pos in positions:
-            mutants = generate_completions(seq, [pos], num_completions)
+            mutants = sample_completions(seq, [pos], num_completions, seed=rng)
             all_mutants = all_mutants + mutants
+            mutated_positions = mutated_positions + [pos] * len(mutants)
         seqs = all_mutants + [seq]
 
-        # Features
-        features = []
-        for seq in seqs:
-            feat = calculator.macrel_descriptors_from_seq(seq)
-            features.append(feat)
-
-        # Predictions
-        macrel = MacrelPredictor()
-        predictions = macrel.predict_seqs(features)
+        # Predictions, mutant features are updated from the parent
+        residues = [mutant[pos] for mutant, pos in zip(all_mutants, mutated_positions)]
+        predictions = (macrel.calculate_and_predict_substitutions(seq, mutated_positions, residues)
+                       + macrel.calculate_and_predict_seqs([seq]))
         d = {"Sequence": seqs, "Pred": predictions}
         df = pd.DataFrame(d)
 
@@ -0,0 +1,150 @@
+"""
+Beam search over single-point mutants.
+Every generation expands all sequences of the beam at once, scores the new mutants of every parent
+through the scorer's incremental substitution path and keeps the beam_width best sequences seen so far.
+"""
+import random
+from pathlib import Path
+
+import argparse
+from pydantic import BaseModel, Field
+
+from fasta import read_sequences
+from generator import aabet_without_C
+from hill_climbing.hill_climber import (HillClimbingResult, HillClimbingResults, make_scorer, score_in_batches,
+                                        score_substitutions_in_batches)
+from hill_climbing.json_to_fasta import json_to_fasta
+from hill_climbing.results_io import ResultsWriter, resume_run
+from predictor import MacrelPredictor, Predictor
+
+
+class BeamSearch(BaseModel):
+    alphabet: list[str] = aabet_without_C
+    scorer: Predictor = Field(default_factory=MacrelPredictor)
+    beam_width: int = Field(default=8, gt=0)
+    generations: int = Field(default=100, gt=0)
+    batch_size: int = Field(default=4096, gt=0)
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def expand(self, beam: list[str], scores: dict[str, float]) -> dict[str, tuple[str, int, str]]:
+        """
+        Single-point mutants of the beam that were never scored, each only once.
+        Returns:
+            dict: mutant -> (the beam sequence it was first built from, position, residue).
+        """
+        children = {}
+        for parent in beam:
+            for position in range(len(parent)):
+                for letter in self.alphabet:
+                    if letter != parent[position]:
+                        child = parent[:position] + letter + parent[position + 1:]
+                        if child not in scores and child not in children:
+                            children[child] = (parent, position, letter)
+        return children
+
+    def score_children(self, children: dict[str, tuple[str, int, str]]) -> dict[str, float]:
+        """
+        Scores the mutants of expand parent by parent with score_substitutions_in_batches.
+        """
+        by_parent = {}
+        for child, (parent, position, letter) in children.items():
+            by_parent.setdefault(parent, []).append((child, position, letter))
+        scores = {}
+        for parent, mutants in by_parent.items():
+            positions = [position for _, position, _ in mutants]
+            residues = [letter for _, _, letter in mutants]
+            mutant_scores = score_substitutions_in_batches(self.scorer, parent, positions, residues, self.batch_size)
+            scores.update(zip((child for child, _, _ in mutants), mutant_scores))
+        return scores
+
+    def optimize_sequence(self, sequence: str, verbose=False) -> HillClimbingResults:
+        """
+        Runs beam search from sequence until the beam stops changing or generations run out.
+        Returns:
+            HillClimbingResults: Path of mutations from sequence to the best sequence found.
+        """
+        scores = {sequence: score_in_batches(self.scorer, [sequence], self.batch_size)[0]}
+        parents = {sequence: None}
+        beam = [sequence]
+        for generation in range(self.generations):
+            children = self.expand(beam, scores)
+            scores.update(self.score_children(children))
+            parents.update((child, parent) for child, (parent, _, _) in children.items())
+            # stable sort, so older sequences win ties and an unchanged beam means convergence
+            new_beam = sorted(beam + list(children), key=scores.__getitem__, reverse=True)[:self.beam_width]
+            if verbose:
+                print(f"Generation {generation + 1}: scored {len(children)} sequences, "
+                      f"best score: {scores[new_beam[0]]:.6f} ({new_beam[0]})")
+            if new_beam == beam:
+                if verbose: print(f"Converged at generation {generation + 1}")
+                break
+            beam = new_beam
+
+        path = [beam[0]]
+        while parents[path[-1]] is not None:
+            path.append(parents[path[-1]])
+        path.reverse()
+        results = [HillClimbingResult(sequence=sequence, score=scores[sequence], improvement=0)]
+        for parent, child in zip(path, path[1:]):
+            results.append(HillClimbingResult(sequence=child, score=scores[child],
+                                              improvement=scores[child] - scores[parent]))
+        return HillClimbingResults(results=results, evaluations=len(scores))
+
+    def optimize_sequence_just_string(self, sequence: str, verbose=False) -> str:
+        return self.optimize_sequence(sequence, verbose).results[-1].sequence
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Beam search optimization for peptide sequences")
+    parser.add_argument('--input_seqs', type=str, help='A fasta file with starting sequences')
+    parser.add_argument('--num_sequences', type=int, default=5,
+                        help='Number of sequences to generate (ignored if --input_seqs provided)')
+    parser.add_argument('--min_length', type=int, default=18, help='Minimum length of generated sequences')
+    parser.add_argument('--max_length', type=int, default=25, help='Maximum length of generated sequences')
+    parser.add_argument('--beam_width', type=int, default=8, help='Sequences kept per generation')
+    parser.add_argument('--generations', type=int, default=100, help='Maximal number of generations')
+    parser.add_argument('--output', type=str, default="data", help='Output folder path for results')
+    parser.add_argument('--score_cache', type=str,
+                        help='SQLite file with cached scores, sequences scored in earlier runs are not scored again')
+    parser.add_argument('--scoring_service', type=str,
+                        help='Score with a running scoring_service.py (socket path or host:port) instead of a local model')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the run in the output folder, skipping starting sequences already searched')
+    args = parser.parse_args()
+
+    starting_sequences = list(read_sequences(args.input_seqs)) if args.input_seqs else None
+
+    outputs_directory = Path(args.output or ".")
+    outputs_directory.mkdir(exist_ok=True, parents=True)
+    results_file_path = outputs_directory / "beam_search_results_AMPKillerPredictor.jsonl"
+
+    # trajectories are appended as they finish, so a killed run can be resumed
+    finished, recorded = {}, False
+    if args.resume:
+        try:
+            starting_sequences, finished, recorded = resume_run(results_file_path, starting_sequences)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        results_file_path.unlink(missing_ok=True)
+    if starting_sequences is None:
+        starting_sequences = [
+            "".join(random.choices(aabet_without_C, k=random.randint(args.min_length, args.max_length)))
+            for _ in range(args.num_sequences)
+        ]
+    if finished:
+        print(f"Resuming {results_file_path}: {len(finished)} of {len(starting_sequences)} sequences already done")
+
+    beam_search = BeamSearch(scorer=make_scorer(args.score_cache, scoring_service=args.scoring_service),
+                             beam_width=args.beam_width, generations=args.generations)
+    with ResultsWriter(results_file_path) as writer:
+        if not recorded:
+            writer.write_run(starting_sequences)
+        for index, seq in enumerate(starting_sequences):
+            if index not in finished:
+                writer.write_trajectory(index, beam_search.optimize_sequence(seq, verbose=True))
+
+    json_to_fasta(results_file_path, results_file_path.with_suffix(".fasta"))
+    print(f"Saved {len(starting_sequences)} results to {results_file_path.resolve()}")
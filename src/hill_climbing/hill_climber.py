@@ -1,16 +1,23 @@
-import json
+import math
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
+from typing import Callable
 
 import argparse
-from joblib import Parallel, delayed
 from pydantic import BaseModel, Field
-from pydantic_core import to_jsonable_python
 
+import instrumentation
 from calculator import AMPKillerPredictor
+from fasta import read_sequences, write_fasta
 from generator import aabet_without_C
 from hill_climbing.json_to_fasta import json_to_fasta
+from hill_climbing.results_io import ResultsWriter, read_results, resume_run
 from predictor import MacrelPredictor, Predictor
+from score_cache import CachedPredictor, CacheStats
+from scoring_service import RemotePredictor
 
 
 class HillClimbingResult(BaseModel):
@@ -21,6 +28,9 @@ class HillClimbingResult(BaseModel):
 
 class HillClimbingResults(BaseModel):
     results: list[HillClimbingResult]
+    evaluations: int = 0
+    skipped_evaluations: int = 0
+    tabu_skips: int = 0
 
     def __len__(self):
         return len(self.results)
@@ -32,58 +42,306 @@ class HillClimbingResults(BaseModel):
         return iter(self.results)
 
 
+def score_in_batches(scorer: Predictor, sequences: list[str], batch_size: int) -> list[float]:
+    """
+    Scores sequences with scorer in chunks of at most batch_size sequences.
+    """
+    scores = []
+    for start in range(0, len(sequences), batch_size):
+        scores.extend(scorer.calculate_and_predict_seqs(sequences[start:start + batch_size]))
+    return scores
+
+
+def score_substitutions_in_batches(scorer: Predictor, sequence: str, positions: list[int], residues: list[str],
+                                   batch_size: int) -> list[float]:
+    """
+    Scores single-point mutants of sequence (residues[i] at positions[i]) in chunks of at most batch_size,
+    through the scorer's incremental substitution path.
+    """
+    scores = []
+    for start in range(0, len(positions), batch_size):
+        scores.extend(scorer.calculate_and_predict_substitutions(
+            sequence, positions[start:start + batch_size], residues[start:start + batch_size]))
+    return scores
+
+
+class ClimbMemory(BaseModel):
+    """
+    State of one optimize_sequence run: scores of every sequence seen so far and the recently visited sequences.
+    Kept per run because one HillClimber is shared between threads.
+    """
+    visited: dict[str, float] = {}
+    tabu: list[str] = []
+    evaluations: int = 0
+    skipped_evaluations: int = 0
+    tabu_skips: int = 0
+
+
 class HillClimber(BaseModel):
     alphabet: list[str] = aabet_without_C
     change_multiple: bool = False
-    scorer: Predictor = MacrelPredictor()
+    scorer: Predictor = Field(default_factory=MacrelPredictor)
     epochs: int = Field(default=100, gt=0)
+    batch_size: int = Field(default=4096, gt=0)
+    memoize: bool = True
+    tabu_size: int = Field(default=0, ge=0)
+    patience: int = Field(default=5, gt=0)
 
     class Config:
         arbitrary_types_allowed = True
 
-    def do_one_step(self, original_seq: str) -> HillClimbingResult:
-        original_score = self.scorer.calculate_and_predict_seqs([original_seq])[0]
+    def do_one_step(self, original_seq: str, memory: ClimbMemory = None) -> HillClimbingResult:
+        """
+        Performs one epoch of hill climbing from original_seq.
+        With change_multiple, mutants are built from the best sequence found so far and scored one by one,
+        otherwise the whole single-point neighbourhood is scored in batches of batch_size.
+        Args:
+            memory (ClimbMemory): State of the run, sequences in memory.visited are not scored again and,
+                with tabu_size, the step moves to the best neighbour outside memory.tabu even if it is worse.
+        """
+        with instrumentation.timer("hill_climber.step"):
+            if self.change_multiple:
+                return self._do_one_step_sequential(original_seq, memory)
+            return self._do_one_step_batched(original_seq, memory)
+
+    def _do_one_step_sequential(self, original_seq: str, memory: ClimbMemory = None) -> HillClimbingResult:
+        original_score = self.score_seqs([original_seq], memory)[0]
         best_score = original_score
         best_seq = original_seq
+        tabu = memory is not None and self.tabu_size > 0
+        excluded = set(memory.tabu) if tabu else set()
+        # best single mutant of original_seq outside the tabu list, taken if nothing improves
+        fallback_seq, fallback_score = None, -math.inf
         for position in range(len(original_seq)):
             for letter in self.alphabet:
-                if self.change_multiple:
-                    new_seq = best_seq[:position] + letter + best_seq[position + 1:]
-                else:
-                    new_seq = original_seq[:position] + letter + original_seq[position + 1:]
-                new_score = self.scorer.calculate_and_predict_seqs([new_seq])[0]
+                if letter == best_seq[position]:
+                    continue
+                new_seq = best_seq[:position] + letter + best_seq[position + 1:]
+                if new_seq in excluded:
+                    memory.tabu_skips += 1
+                    continue
+                new_score = self.score_seqs([new_seq], memory)[0]
                 if new_score > best_score:
                     best_score = new_score
                     best_seq = new_seq
+                elif tabu and best_seq == original_seq and new_score > fallback_score:
+                    fallback_seq, fallback_score = new_seq, new_score
+        if best_seq == original_seq and fallback_seq is not None:
+            best_seq, best_score = fallback_seq, fallback_score
         return HillClimbingResult(sequence=best_seq, score=best_score, improvement=best_score - original_score)
 
-    def optimize_sequence(self, sequence: str, verbose=False) -> HillClimbingResults:
-        best_sequence = sequence
+    def _do_one_step_batched(self, original_seq: str, memory: ClimbMemory = None) -> HillClimbingResult:
+        positions, residues = [], []
+        with instrumentation.timer("hill_climber.mutants") as timer:
+            for position in range(len(original_seq)):
+                for letter in self.alphabet:
+                    if letter != original_seq[position]:
+                        positions.append(position)
+                        residues.append(letter)
+            timer.items = len(positions)
+        original_score = self.score_seqs([original_seq], memory)[0]
+        scores = self.score_substitutions(original_seq, positions, residues, memory)
+
+        candidates = range(len(scores))
+        tabu = memory is not None and self.tabu_size > 0
+        if tabu:
+            excluded = set(memory.tabu)
+            candidates = [i for i in candidates if self._mutant(original_seq, positions[i], residues[i]) not in excluded]
+            memory.tabu_skips += len(scores) - len(candidates)
+        # like in sequential mode the parent wins ties and otherwise the first best mutant is taken
+        best_index = max(candidates, key=scores.__getitem__, default=None)
+        with instrumentation.timer("hill_climber.results"):
+            if best_index is None or (scores[best_index] <= original_score and not tabu):
+                return HillClimbingResult(sequence=original_seq, score=original_score, improvement=0.0)
+            best_seq = self._mutant(original_seq, positions[best_index], residues[best_index])
+            best_score = scores[best_index]
+            return HillClimbingResult(sequence=best_seq, score=best_score, improvement=best_score - original_score)
+
+    @staticmethod
+    def _mutant(sequence: str, position: int, residue: str) -> str:
+        return sequence[:position] + residue + sequence[position + 1:]
+
+    def score_seqs(self, sequences: list[str], memory: ClimbMemory = None) -> list[float]:
+        """
+        Scores sequences with the scorer in chunks of at most batch_size sequences.
+        With memoize, sequences already in memory.visited are looked up instead.
+        """
+        if memory is None or not self.memoize:
+            with instrumentation.timer("hill_climber.score_seqs", len(sequences)):
+                scores = score_in_batches(self.scorer, sequences, self.batch_size)
+            if memory is not None:
+                memory.evaluations += len(sequences)
+            return scores
+
+        missing = [seq for seq in dict.fromkeys(sequences) if seq not in memory.visited]
+        instrumentation.count("hill_climber.visited", hits=len(sequences) - len(missing), misses=len(missing))
+        if missing:
+            memory.visited.update(zip(missing, self.score_seqs(missing)))
+        memory.evaluations += len(missing)
+        memory.skipped_evaluations += len(sequences) - len(missing)
+        return [memory.visited[seq] for seq in sequences]
+
+    def score_substitutions(self, sequence: str, positions: list[int], residues: list[str],
+                            memory: ClimbMemory = None) -> list[float]:
+        """
+        Scores single-point mutants of sequence in chunks of at most batch_size mutants.
+        With memoize, mutants already in memory.visited are looked up instead.
+        """
+        if memory is None or not self.memoize:
+            with instrumentation.timer("hill_climber.score_substitutions", len(positions)):
+                scores = score_substitutions_in_batches(self.scorer, sequence, positions, residues, self.batch_size)
+            if memory is not None:
+                memory.evaluations += len(positions)
+            return scores
+
+        mutants = [self._mutant(sequence, pos, aa) for pos, aa in zip(positions, residues)]
+        missing = [i for i, mutant in enumerate(mutants) if mutant not in memory.visited]
+        instrumentation.count("hill_climber.visited", hits=len(mutants) - len(missing), misses=len(missing))
+        if missing:
+            new_scores = self.score_substitutions(sequence, [positions[i] for i in missing],
+                                                  [residues[i] for i in missing])
+            memory.visited.update((mutants[i], score) for i, score in zip(missing, new_scores))
+        memory.evaluations += len(missing)
+        memory.skipped_evaluations += len(mutants) - len(missing)
+        return [memory.visited[mutant] for mutant in mutants]
+
+    def optimize_sequence(self, sequence: str, verbose=False,
+                          on_epoch: Callable[[int, HillClimbingResult], None] = None) -> HillClimbingResults:
+        """
+        Climbs from sequence until no neighbour improves it or epochs run out.
+        With tabu_size, the climber keeps moving to the best neighbour that is not among the last tabu_size
+        visited sequences, and stops after patience epochs without a new best. The trajectory is cut
+        after the best sequence, so its last result is always the best one.
+        on_epoch(epoch, result) is called with every step taken, e.g. to log the progress of long runs.
+        """
+        memory = ClimbMemory()
         step_results = [HillClimbingResult(sequence=sequence,
-                                           score=self.scorer.calculate_and_predict_seqs([sequence])[0],
+                                           score=self.score_seqs([sequence], memory)[0],
                                            improvement=0) ]
+        best_index = 0
+        current = sequence
 
         for epoch in range(self.epochs):
-            result = self.do_one_step(best_sequence)
-            best_sequence = result.sequence
+            if self.tabu_size:
+                memory.tabu = (memory.tabu + [current])[-self.tabu_size:]
+            result = self.do_one_step(current, memory)
+            current = result.sequence
             if verbose:
-                print(f"Epoch {epoch + 1}: Best sequence score: {result.score:.6f} ({best_sequence})")
-            if result.improvement == 0:
+                print(f"Epoch {epoch + 1}: Best sequence score: {result.score:.6f} ({current})")
+            if result.improvement == 0 and (not self.tabu_size or current in memory.tabu):
                 if verbose: print(f"Converged at epoch {epoch + 1}")
                 break
-            else:
-                step_results.append(result)
-        return HillClimbingResults(results=step_results)
+            step_results.append(result)
+            if on_epoch is not None:
+                on_epoch(epoch + 1, result)
+            if result.score > step_results[best_index].score:
+                best_index = len(step_results) - 1
+            elif len(step_results) - 1 - best_index >= self.patience:
+                if verbose: print(f"No new best for {self.patience} epochs, stopping at epoch {epoch + 1}")
+                break
+        with instrumentation.timer("hill_climber.results"):
+            return HillClimbingResults(results=step_results[:best_index + 1], evaluations=memory.evaluations,
+                                       skipped_evaluations=memory.skipped_evaluations,
+                                       tabu_skips=memory.tabu_skips)
 
     def optimize_sequence_just_string(self, sequence: str, verbose=False) -> str:
         return self.optimize_sequence(sequence, verbose).results[-1].sequence
 
 
+def make_scorer(score_cache=None, intra_op_num_threads=0, scoring_service=None) -> Predictor:
+    """
+    AMPKillerPredictor, or a client of the scoring service at address scoring_service (socket path or host:port),
+    optionally behind a score cache.
+    """
+    if scoring_service:
+        scorer = RemotePredictor.from_address(scoring_service)
+    else:
+        scorer = AMPKillerPredictor(MacrelPredictor(intra_op_num_threads=intra_op_num_threads))
+    if score_cache:
+        scorer = CachedPredictor(scorer, path=score_cache)
+    return scorer
+
+
+_worker_climber = None
+_worker_log = None
+
+
+def _init_worker(score_cache, intra_op_num_threads, climber_options, scoring_service, profile, epochs_path):
+    # every worker builds its own ONNX session once, sessions are never pickled
+    global _worker_climber, _worker_log
+    if profile:
+        instrumentation.enable()
+    _worker_climber = HillClimber(scorer=make_scorer(score_cache, intra_op_num_threads, scoring_service),
+                                  **climber_options)
+    _worker_log = ResultsWriter(epochs_path) if epochs_path else None
+
+
+def _optimize_chunk(chunk: list[tuple[int, str]]):
+    results = []
+    for index, seq in chunk:
+        on_epoch = partial(_worker_log.write_epoch, index) if _worker_log else None
+        results.append((index, _worker_climber.optimize_sequence(seq, on_epoch=on_epoch)))
+    scorer = _worker_climber.scorer
+    stages = instrumentation.snapshot()
+    instrumentation.reset()
+    return os.getpid(), scorer.stats if isinstance(scorer, CachedPredictor) else None, stages, results
+
+
+def optimize_in_processes(sequences: list[str], workers=-1, chunk_size=None, score_cache=None,
+                          climber_options: dict = None, scoring_service=None, indices: list[int] = None,
+                          on_result: Callable[[int, HillClimbingResults], None] = None,
+                          epochs_path=None) -> list[HillClimbingResults]:
+    """
+    Optimizes sequences in a pool of worker processes, chunks of sequences are collected as they finish.
+    ONNX intra-op threads are split between the workers so the processes don't oversubscribe the cores.
+    climber_options are passed on to the HillClimber of every worker.
+    If instrumentation is enabled, it is enabled in the workers too and their stats are merged.
+    Args:
+        indices (list[int]): Index of every sequence in the run, 0, 1, ... by default.
+        on_result: Called in this process with (index, results) of every trajectory as soon as its chunk is done.
+        epochs_path: JSONL file the workers append every epoch to, see results_io.ResultsWriter.
+    Returns:
+        list of HillClimbingResults in the order of sequences.
+    """
+    workers = workers if workers > 0 else os.cpu_count()
+    chunk_size = chunk_size or max(1, math.ceil(len(sequences) / (workers * 4)))
+    indices = list(range(len(sequences))) if indices is None else list(indices)
+    indexed = list(zip(indices, sequences))
+    chunks = [indexed[start:start + chunk_size] for start in range(0, len(indexed), chunk_size)]
+    threads = max(1, os.cpu_count() // workers)
+
+    positions = {index: position for position, index in enumerate(indices)}
+    results = [None] * len(sequences)
+    worker_stats = {}
+    initargs = (score_cache, threads, climber_options or {}, scoring_service, instrumentation.enabled(),
+                epochs_path)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+        futures = [pool.submit(_optimize_chunk, chunk) for chunk in chunks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            pid, stats, stages, chunk_results = future.result()
+            worker_stats[pid] = stats
+            instrumentation.merge(stages)
+            for index, result in chunk_results:
+                results[positions[index]] = result
+                if on_result is not None:
+                    on_result(index, result)
+            print(f"Finished chunk {done}/{len(chunks)}")
+
+    if score_cache:
+        total = CacheStats()
+        for stats in worker_stats.values():
+            total.memory_hits += stats.memory_hits
+            total.disk_hits += stats.disk_hits
+            total.misses += stats.misses
+        print(f"Score cache hit rate: {total.hit_rate:.1%} ({total})")
+    return results
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Hill Climbing Optimization for Peptide Sequences")
     parser.add_argument('--input_seqs', type=str, help='A fasta file with starting sequences')
     parser.add_argument('--same_as', type=str,
-                        help='JSON file containing list of HillClimbingResults to use first sequence from each')
+                        help='JSON or JSONL file of HillClimbingResults to use first sequence from each')
     parser.add_argument('--num_sequences', type=int, default=5,
                         help='Number of sequences to generate (ignored if --input_seqs or --same_as provided)')
     parser.add_argument('--min_length', type=int, default=18,
@@ -91,43 +349,123 @@ if __name__ == '__main__':
     parser.add_argument('--max_length', type=int, default=25,
                         help='Maximum length of generated sequences (ignored if --input_seqs or --same_as provided)')
     parser.add_argument('--output', type=str, default="data", help='Output folder path for results')
+    parser.add_argument('--score_cache', type=str,
+                        help='SQLite file with cached scores, sequences scored in earlier runs are not scored again')
+    parser.add_argument('--backend', choices=["threading", "process"], default="threading",
+                        help='Run sequences in threads sharing one model or in worker processes')
+    parser.add_argument('--workers', type=int, default=-1, help='Number of threads or processes, -1 for all cores')
+    parser.add_argument('--chunk_size', type=int,
+                        help='Sequences handed to a worker process at once (default: spread over 4 chunks per worker)')
+    parser.add_argument('--scoring_service', type=str,
+                        help='Score with a running scoring_service.py (socket path or host:port) instead of a local model')
+    parser.add_argument('--profile', nargs='?', const='', metavar='JSON',
+                        help='Print the time spent per stage at the end, and save it to JSON if a path is given')
+    parser.add_argument('--tabu_size', type=int, default=0,
+                        help='Keep climbing past local optima, never revisiting the last TABU_SIZE sequences')
+    parser.add_argument('--patience', type=int, default=5,
+                        help='With --tabu_size, stop after this many epochs without a new best sequence')
+    parser.add_argument('--no_memoize', action='store_true',
+                        help='Score every neighbour again instead of remembering scores within a run')
+    parser.add_argument('--log_epochs', action='store_true',
+                        help='Append every epoch to the results file, not only finished trajectories')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the run in the output folder, skipping starting sequences already climbed')
+    parser.add_argument('--novelty_distance', type=int,
+                        help='Also save the best sequences at least this many edits away from DBAASP peptides')
+    parser.add_argument('--known', nargs='*', default=[],
+                        help='FASTA files of known peptides checked together with DBAASP for --novelty_distance')
 
     args = parser.parse_args()
+    if args.profile is not None:
+        instrumentation.enable()
 
     # Determine starting sequences
-    starting_sequences = []
+    starting_sequences = None
 
     if args.input_seqs:
         # Load sequences from fasta file
-        with open(args.input_seqs, 'r') as f:
-            starting_sequences = [line.strip() for line in f if line.strip() if line[0]!=">"]
+        starting_sequences = list(read_sequences(args.input_seqs))
     elif args.same_as:
-        # Load sequences from JSON file of HillClimbingResults
-        with open(args.same_as, 'r') as f:
-            results_list = json.load(f)
-            for result_data in results_list:
-                if isinstance(result_data, dict) and 'results' in result_data and result_data['results']:
-                    starting_sequences.append(result_data['results'][0]['sequence'])
+        # Load sequences from JSON or JSONL file of HillClimbingResults
+        starting_sequences = []
+        for result_data in sorted(read_results(args.same_as), key=lambda trajectory: trajectory['index']):
+            if result_data.get('results'):
+                starting_sequences.append(result_data['results'][0]['sequence'])
+
+    scorer_name = AMPKillerPredictor.__name__
+    output_file_name = f"hill_climber_results_{scorer_name}.jsonl"
+    outputs_directory = Path(args.output or ".")
+    outputs_directory.mkdir(exist_ok=True, parents=True)
+    results_file_path = outputs_directory / output_file_name
+
+    # trajectories are appended as they finish, so a killed run can be resumed
+    finished, recorded = {}, False
+    if args.resume:
+        try:
+            starting_sequences, finished, recorded = resume_run(results_file_path, starting_sequences)
+        except ValueError as e:
+            parser.error(str(e))
     else:
+        results_file_path.unlink(missing_ok=True)
+    if starting_sequences is None:
         # Generate random sequences
         starting_sequences = [
             "".join(random.choices(aabet_without_C, k=random.randint(args.min_length, args.max_length)))
             for _ in range(args.num_sequences)
         ]
+    pending = [(index, seq) for index, seq in enumerate(starting_sequences) if index not in finished]
+    if finished:
+        print(f"Resuming {results_file_path}: {len(finished)} of {len(starting_sequences)} sequences already done")
 
-    hill_climber = HillClimber(scorer=AMPKillerPredictor())
+    climber_options = dict(tabu_size=args.tabu_size, patience=args.patience, memoize=not args.no_memoize)
+    with ResultsWriter(results_file_path) as writer:
+        if not recorded:
+            writer.write_run(starting_sequences)
+        if args.backend == "process":
+            results = optimize_in_processes([seq for _, seq in pending], args.workers, args.chunk_size,
+                                            args.score_cache, climber_options, args.scoring_service,
+                                            indices=[index for index, _ in pending],
+                                            on_result=writer.write_trajectory,
+                                            epochs_path=results_file_path if args.log_epochs else None)
+        else:
+            from joblib import Parallel, delayed
+            scorer = make_scorer(args.score_cache, scoring_service=args.scoring_service)
+            hill_climber = HillClimber(scorer=scorer, **climber_options)
 
-    results = Parallel(n_jobs=-1, backend="threading", verbose=10)(
-        delayed(hill_climber.optimize_sequence)(seq)
-        for seq in starting_sequences
-    )
+            def climb(index: int, seq: str) -> HillClimbingResults:
+                on_epoch = partial(writer.write_epoch, index) if args.log_epochs else None
+                result = hill_climber.optimize_sequence(seq, on_epoch=on_epoch)
+                writer.write_trajectory(index, result)
+                return result
 
-    output_file_name = f"hill_climber_results_{hill_climber.scorer.__class__.__name__}.json"
-    outputs_directory = Path(args.output or ".")
-    outputs_directory.mkdir(exist_ok=True, parents=True)
-    results_file_path = outputs_directory / output_file_name
+            results = Parallel(n_jobs=args.workers, backend="threading", verbose=10)(
+                delayed(climb)(index, seq)
+                for index, seq in pending
+            )
+            if args.score_cache:
+                print(f"Score cache hit rate: {scorer.stats.hit_rate:.1%} ({scorer.stats})")
+
+    evaluations = sum(result.evaluations for result in results)
+    skipped = sum(result.skipped_evaluations for result in results)
+    print(f"Scored {evaluations} sequences, {skipped} repeated ones were looked up")
 
-    with open(results_file_path, "w") as f:
-        json.dump(results, f, default=to_jsonable_python, indent=2)
     json_to_fasta(results_file_path, results_file_path.with_suffix(".fasta"))
-    print(f"Saved {len(results)} results to {results_file_path.resolve()}")
+    print(f"Saved {len(finished) + len(results)} results to {results_file_path.resolve()}")
+
+    if args.novelty_distance:
+        # drop rediscoveries of known peptides
+        from similarity_index import SimilarityIndex
+        index = SimilarityIndex.from_dbaasp(fasta_paths=args.known)
+        best = [(trajectory['index'], trajectory['results'][-1]['sequence'])
+                for trajectory in sorted(read_results(results_file_path), key=lambda trajectory: trajectory['index'])
+                if trajectory.get('results')]
+        novel = index.is_novel([seq for _, seq in best], args.novelty_distance)
+        novel_path = results_file_path.with_name(f"{results_file_path.stem}_novel.fasta")
+        write_fasta(novel_path, ((f"group_{i}_best", seq) for (i, seq), keep in zip(best, novel) if keep))
+        print(f"{sum(novel)} of {len(best)} best sequences are at least {args.novelty_distance} edits away from "
+              f"{len(index)} known peptides, saved to {novel_path.resolve()}")
+
+    if args.profile is not None:
+        instrumentation.print_report()
+        if args.profile:
+            instrumentation.dump(args.profile)
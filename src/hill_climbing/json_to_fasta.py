@@ -1,26 +1,28 @@
 import argparse
-import json
+
+from fasta import FastaWriter
+from hill_climbing.results_io import read_results
 
 
 def json_to_fasta(json_path, fasta_path):
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-    
-    with open(fasta_path, 'w') as f:
-        for i, results_group in enumerate(data):
-            # The input is a list of HillClimbingResults, each has a 'results' field
-            # which is a list of HillClimbingResult
+    # JSON lists and JSONL streams are both accepted, streamed trajectories are put back in starting order
+    data = sorted(read_results(json_path), key=lambda results_group: results_group['index'])
+
+    with FastaWriter(fasta_path) as writer:
+        for results_group in data:
+            # Each item is a HillClimbingResults, its 'results' field
+            # is a list of HillClimbingResult
+            i = results_group['index']
             results_list = results_group.get('results', [])
             for j, result in enumerate(results_list):
                 sequence = result.get('sequence')
                 if sequence:
                     # Header format: group_{i}_step_{j}
-                    f.write(f">group_{i}_step_{j}\n")
-                    f.write(f"{sequence}\n")
+                    writer.write(f"group_{i}_step_{j}", sequence)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Convert HillClimbingResults JSON to FASTA")
-    parser.add_argument("input_json", help="Path to the input JSON file")
+    parser = argparse.ArgumentParser(description="Convert HillClimbingResults JSON or JSONL to FASTA")
+    parser.add_argument("input_json", help="Path to the input JSON or JSONL file")
     parser.add_argument("output_fasta", help="Path to the output FASTA file")
     
     args = parser.parse_args()
@@ -1,12 +1,132 @@
-import json
 import argparse
-import matplotlib.pyplot as plt
+import json
+import warnings
 from pathlib import Path
 
+import matplotlib.pyplot as plt
+import numpy as np
+
+from hill_climbing.results_io import read_results
+
+PERCENTILES = (10, 25, 75, 90)
+CACHE_VERSION = 2
+
+
+def score_matrix(path, partial=False) -> np.ndarray:
+    """
+    Scores of every trajectory of a results file, streamed with read_results, in the order of the starting sequences.
+    Column i holds epoch i, so the starting sequences are in column 0. Partial trajectories lack the starting
+    sequence (see read_results), they start in column 1.
+    Returns:
+        np.ndarray: (trajectories, epochs) float matrix, NaN where a trajectory has no score.
+    """
+    trajectories = []
+    for hc_results in read_results(path, partial=partial):
+        scores = [r.get('score', 0.0) for r in hc_results.get('results') or []]
+        if scores:
+            trajectories.append((hc_results['index'], 1 if hc_results.get('partial') else 0, scores))
+    trajectories.sort(key=lambda trajectory: trajectory[0])
+
+    offsets = np.array([offset for _, offset, _ in trajectories], dtype=np.int64)
+    ends = offsets + np.array([len(scores) for _, _, scores in trajectories], dtype=np.int64)
+    matrix = np.full((len(trajectories), ends.max(initial=0)), np.nan)
+    columns = np.arange(matrix.shape[1])
+    matrix[(columns >= offsets[:, None]) & (columns < ends[:, None])] = \
+        [score for _, _, scores in trajectories for score in scores]
+    return matrix
+
+
+def aggregate(matrix: np.ndarray, percentiles=PERCENTILES, samples=0, seed=0) -> dict[str, np.ndarray]:
+    """
+    Per-epoch statistics of the trajectories still running at that epoch.
+    Args:
+        samples (int): Number of randomly chosen trajectories kept as raw lines.
+    Returns:
+        dict: "trajectories", per epoch "count", "mean", "median" and "percentiles" (len(percentiles), epochs),
+            "samples" (samples, epochs) with NaN padding. Statistics of epochs without scores are NaN.
+    """
+    rng = np.random.default_rng(seed)
+    sampled = np.sort(rng.choice(len(matrix), min(samples, len(matrix)), replace=False))
+    with warnings.catch_warnings():
+        # epoch 0 has no scores if all trajectories are partial
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if len(percentiles):
+            bands = np.nanpercentile(matrix, percentiles, axis=0).reshape(len(percentiles), matrix.shape[1])
+        else:
+            bands = np.empty((0, matrix.shape[1]))
+        return {
+            "trajectories": np.array(len(matrix)),
+            "count": (~np.isnan(matrix)).sum(axis=0),
+            "mean": np.nanmean(matrix, axis=0),
+            "median": np.nanmedian(matrix, axis=0),
+            "percentiles": bands,
+            "samples": matrix[sampled],
+        }
+
+
+def cached_aggregate(path, partial=False, percentiles=PERCENTILES, samples=0, seed=0, cache=True) -> dict:
+    """
+    aggregate of the scores of path, saved to <path stem>_aggregate.npz next to it.
+    The cache is reused while the results file and the settings are unchanged.
+    """
+    path = Path(path)
+    cache_path = path.with_name(f"{path.stem}_aggregate.npz")
+    stat = path.stat()
+    key = json.dumps({"version": CACHE_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                      "partial": partial, "percentiles": list(percentiles), "samples": samples, "seed": seed})
+    if cache and cache_path.exists():
+        with np.load(cache_path) as cached:
+            if str(cached["key"]) == key:
+                return {name: cached[name] for name in cached.files if name != "key"}
+
+    aggregated = aggregate(score_matrix(path, partial), percentiles, samples, seed)
+    if cache:
+        tmp = cache_path.with_name(f"{cache_path.stem}.tmp.npz")
+        np.savez(tmp, key=np.array(key), **aggregated)
+        tmp.replace(cache_path)
+    return aggregated
+
+
+def plot_aggregate(aggregated: dict, label: str, percentiles=PERCENTILES, color=None):
+    """
+    Percentile bands (outermost pair first), median, mean and the sampled raw lines of one results file.
+    The middle percentile of an odd count has no pair, it is drawn as a dotted line.
+    """
+    epochs = np.arange(len(aggregated["mean"]))
+    line, = plt.plot(epochs, aggregated["median"], color=color, linewidth=2, label=f'{label} (median)')
+    color = line.get_color()
+    plt.plot(epochs, aggregated["mean"], color=color, linewidth=2.5, linestyle='--', label=f'{label} (avg)')
+
+    order = np.argsort(percentiles)
+    bands = aggregated["percentiles"][order]
+    ordered = np.asarray(percentiles)[order]
+    for low in range(len(bands) // 2):
+        high = len(bands) - 1 - low
+        plt.fill_between(epochs, bands[low], bands[high], color=color, alpha=0.15, linewidth=0,
+                         label=f'{label} ({ordered[low]:g}-{ordered[high]:g}th percentile)')
+    if len(bands) % 2:
+        middle = len(bands) // 2
+        plt.plot(epochs, bands[middle], color=color, linewidth=1.2, linestyle=':',
+                 label=f'{label} ({ordered[middle]:g}th percentile)')
+
+    if len(aggregated["samples"]):
+        plt.plot(epochs, aggregated["samples"].T, color=color, alpha=0.2, linewidth=0.8)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Plot Hill Climbing results from JSON files.')
-    parser.add_argument('files', nargs='+', help='JSON files containing HillClimbingResults')
+    parser.add_argument('files', nargs='+', help='JSON or JSONL files containing HillClimbingResults')
+    parser.add_argument('--partial', action='store_true',
+                        help='Also plot unfinished trajectories of JSONL files written with --log_epochs')
     parser.add_argument('--output', help='Output filename (default: hill_climbing_plot.png)')
+    parser.add_argument('--percentiles', type=float, nargs='+', default=list(PERCENTILES),
+                        help='Percentiles drawn as bands, paired from the outside in, '
+                             'the middle one of an odd count is drawn as a line')
+    parser.add_argument('--raw', type=int, default=50,
+                        help='Number of randomly sampled trajectories drawn as thin lines per file')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the trajectory sample')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='Recompute the aggregates instead of reusing <file>_aggregate.npz')
     args = parser.parse_args()
 
     if not args.files:
@@ -22,55 +142,23 @@ def main():
 
     for file_path in args.files:
         path = Path(file_path)
-        with open(path, 'r') as f:
-            data = json.load(f)
-        
-        color = None
-        label_added = False
-        all_scores_per_epoch = []
-
-        for hc_results in data:
-            # Handle both list of results and results key
-            if isinstance(hc_results, dict) and 'results' in hc_results:
-                results = hc_results['results']
-            elif isinstance(hc_results, list):
-                results = hc_results
-            else:
-                continue
-
-            scores = [r.get('score', 0.0) for r in results]
-            epochs = list(range(len(scores)))
-
-            if not scores:
-                continue
-
-            all_scores_per_epoch.append(scores)
-
-            if not label_added:
-                line, = plt.plot(epochs, scores, label=path.stem, alpha=scores[-1])
-                color = line.get_color()
-                label_added = True
-            else:
-                plt.plot(epochs, scores, color=color, alpha=scores[-1])
-
-        # Calculate and plot average line
-        if all_scores_per_epoch:
-            max_length = max(len(s) for s in all_scores_per_epoch)
-            avg_scores = []
-            for i in range(max_length):
-                epoch_scores = [s[i] for s in all_scores_per_epoch if i < len(s)]
-                avg_scores.append(sum(epoch_scores) / len(epoch_scores))
-            avg_epochs = list(range(len(avg_scores)))
-            plt.plot(avg_epochs, avg_scores, color=color, linewidth=2.5, linestyle='--', alpha=1.0,
-                     label=f'{path.stem} (avg)')
+        aggregated = cached_aggregate(path, args.partial, args.percentiles, args.raw, args.seed, not args.no_cache)
+        if not len(aggregated["mean"]):
+            print(f"No trajectories in {path}")
+            continue
+        plot_aggregate(aggregated, path.stem, args.percentiles)
+        print(f"{path.stem}: {int(aggregated['trajectories'])} trajectories, up to {len(aggregated['mean'])} epochs")
+
     plt.ylabel('Score')
     plt.xlabel('Epoch')
     plt.title('Hill Climbing Progress')
     plt.legend()
     plt.grid(True)
-    
+
     plt.savefig(output_path)
+    plt.close()
     print(f"Plot saved to {output_path}")
 
+
 if __name__ == '__main__':
     main()
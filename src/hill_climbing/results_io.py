@@ -0,0 +1,166 @@
+"""
+Hill climbing results on disk, either one JSON list of HillClimbingResults
+or a JSONL stream that is appended record by record while a run progresses:
+
+    {"type": "run", "starting_sequences": [...]}
+    {"type": "epoch", "index": 3, "epoch": 1, "sequence": ..., "score": ..., "improvement": ...}
+    {"type": "trajectory", "index": 3, "results": [...], "evaluations": ...}
+
+index is the position of the starting sequence, trajectories are written in the order they finish.
+"""
+import json
+import os
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterator
+
+from pydantic_core import to_jsonable_python
+
+
+def is_jsonl(path) -> bool:
+    """
+    .jsonl files, or any file whose first character does not start a JSON list.
+    """
+    path = Path(path)
+    if path.suffix == ".jsonl":
+        return True
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                return not line.lstrip().startswith("[")
+    return False
+
+
+def _records(path) -> Iterator[dict]:
+    # a run killed while writing leaves a truncated line, it is skipped
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def read_results(path, partial=False) -> Iterator[dict]:
+    """
+    Yields trajectories as HillClimbingResults dicts with an extra "index", from a JSON or JSONL file.
+    Args:
+        partial (bool): Also yield unfinished trajectories of a JSONL file, built from their epoch records
+            (the starting sequence itself is not among them).
+    """
+    if not is_jsonl(path):
+        with open(path) as f:
+            data = json.load(f)
+        for index, trajectory in enumerate(data):
+            # plain lists of HillClimbingResult are accepted as well
+            if isinstance(trajectory, list):
+                trajectory = {"results": trajectory}
+            yield {"index": index, **trajectory}
+        return
+
+    finished = set()
+    epochs = defaultdict(dict)
+    for record in _records(path):
+        kind = record.pop("type", "trajectory")
+        if kind == "trajectory":
+            finished.add(record.get("index"))
+            yield record
+        elif kind == "epoch" and partial:
+            epochs[record.pop("index")][record.pop("epoch")] = record
+    for index, steps in epochs.items():
+        if index not in finished:
+            yield {"index": index, "results": [steps[epoch] for epoch in sorted(steps)], "partial": True}
+
+
+def read_run(path) -> dict:
+    """
+    Starting sequences of the run and the trajectories finished so far, for resuming a JSONL file.
+    Returns:
+        dict: "starting_sequences" (None if not recorded) and "finished" {index: starting sequence}.
+    """
+    run = {"starting_sequences": None, "finished": {}}
+    if not Path(path).exists():
+        return run
+    for record in _records(path):
+        if record.get("type") == "run":
+            run["starting_sequences"] = record["starting_sequences"]
+        elif record.get("type") == "trajectory" and record.get("results"):
+            run["finished"][record["index"]] = record["results"][0]["sequence"]
+    return run
+
+
+def resume_run(path, starting_sequences: list[str] = None) -> tuple[list[str], dict[int, str], bool]:
+    """
+    Checks the run in path before resuming it.
+    Args:
+        starting_sequences (list[str]): Sequences given for this run, None to continue with the recorded ones.
+    Returns:
+        list[str]: Starting sequences of the run, None if neither recorded nor given.
+        dict: {index: starting sequence} of the finished trajectories.
+        bool: Whether path already holds the run record.
+    Raises:
+        ValueError: The given sequences differ from the recorded ones,
+            or a finished trajectory does not start from the sequence at its index.
+    """
+    run = read_run(path)
+    recorded = run["starting_sequences"]
+    if recorded is not None and starting_sequences is not None and list(starting_sequences) != recorded:
+        raise ValueError(f"{path} was started from {len(recorded)} other sequences, "
+                         f"resume without new input or write to another output folder")
+    sequences = recorded if recorded is not None else starting_sequences
+    if sequences is not None:
+        # every record is checked, later ones of the same index would hide a mismatch in read_run
+        for record in _records(path):
+            if record.get("type") != "trajectory" or not record.get("results"):
+                continue
+            index, sequence = record.get("index"), record["results"][0]["sequence"]
+            if not isinstance(index, int) or not 0 <= index < len(sequences) or sequences[index] != sequence:
+                raise ValueError(f"Trajectory {index} of {path} starts from {sequence}, "
+                                 f"not from starting sequence {index} of the run")
+    return sequences, run["finished"], recorded is not None
+
+
+class ResultsWriter:
+    """
+    Appends JSONL records, each with a single write on an O_APPEND descriptor,
+    so threads and worker processes can share one file.
+    """
+    def __init__(self, path, fsync=False):
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.path = path
+        self._fsync = fsync
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # terminate a line truncated by a killed run before appending
+        size = path.stat().st_size
+        if size:
+            with open(path, "rb") as f:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    os.write(self._fd, b"\n")
+
+    def write(self, record: dict):
+        os.write(self._fd, (json.dumps(record, default=to_jsonable_python) + "\n").encode())
+        if self._fsync:
+            os.fsync(self._fd)
+
+    def write_run(self, starting_sequences: list[str]):
+        self.write({"type": "run", "starting_sequences": starting_sequences})
+
+    def write_epoch(self, index: int, epoch: int, result):
+        self.write({"type": "epoch", "index": index, "epoch": epoch, **to_jsonable_python(result)})
+
+    def write_trajectory(self, index: int, results):
+        self.write({"type": "trajectory", "index": index, **to_jsonable_python(results)})
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
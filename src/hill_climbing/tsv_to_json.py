@@ -5,17 +5,14 @@ from pathlib import Path
 
 from pydantic_core import to_jsonable_python
 
+from fasta import read_fasta
 from hill_climbing.hill_climber import HillClimbingResult, HillClimbingResults
+from hill_climbing.results_io import ResultsWriter
 
 
 def tsv_to_json(tsv_path, fasta_path, output_json_path):
     # Read fasta for name to seq dictionary
-    name_to_seq = {}
-    with open(fasta_path, 'r') as f:
-        text = f.read()
-        for lines in [line.split('\n') for line in text.split('>')[1:]]:
-            name, seq = lines[0], lines[1]
-            name_to_seq[name.strip()] = seq.strip()
+    name_to_seq = dict(read_fasta(fasta_path))
 
     results = []
     current_run = []
@@ -47,7 +44,13 @@ def tsv_to_json(tsv_path, fasta_path, output_json_path):
                 score = 1-confidence
             current_run.append(HillClimbingResult(sequence=name_to_seq[name], score=score))
     results.append(current_run)
-    # Save the updated JSON
+    # Save the updated JSON, or a JSONL stream like hill_climber.py writes if the output ends with .jsonl
+    if Path(output_json_path).suffix == ".jsonl":
+        Path(output_json_path).unlink(missing_ok=True)
+        with ResultsWriter(output_json_path) as writer:
+            for index, x in enumerate(results):
+                writer.write_trajectory(index, HillClimbingResults(results=x))
+        return
     with open(output_json_path, 'w') as f:
         json.dump([HillClimbingResults(results=x) for x in results], f, indent=2, default=to_jsonable_python)
 
@@ -56,7 +59,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert TSV back to HillClimbingResults JSON")
     parser.add_argument("input_tsv", help="Path to the input TSV file")
     parser.add_argument("original_fasta", help="Path to the original fasta file (to match sequences)")
-    parser.add_argument("output_json", help="Path to the output JSON file")
+    parser.add_argument("output_json", help="Path to the output JSON file (.jsonl for a JSONL stream)")
 
     args = parser.parse_args()
     tsv_to_json(args.input_tsv, args.original_fasta, args.output_json)
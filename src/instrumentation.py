@@ -0,0 +1,225 @@
+"""
+Opt-in timers and counters for the stages of the scoring pipelines.
+Probes are always in place but do nothing until instrumentation is enabled, e.g. with profile():
+
+    with instrumentation.profile() as stats:
+        hill_climber.optimize_sequence(seq)
+    instrumentation.print_report()
+"""
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+_enabled = False
+_lock = threading.Lock()
+_stages = {}
+
+# wall times kept per stage for the percentiles, a uniform sample of all calls once exceeded
+RESERVOIR_SIZE = 1024
+
+
+class StageStats:
+    """
+    Calls, processed items, total and maximal wall time, a bounded reservoir sample of the wall times
+    and cache hits/misses of one stage.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.hits = 0
+        self.misses = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.durations = []
+        self._random = random.Random(0)
+
+    def add(self, elapsed: float, items: int):
+        self.calls += 1
+        self.items += items
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        if len(self.durations) < RESERVOIR_SIZE:
+            self.durations.append(elapsed)
+        else:
+            slot = self._random.randrange(self.calls)
+            if slot < RESERVOIR_SIZE:
+                self.durations[slot] = elapsed
+
+    def merge(self, other: "StageStats"):
+        if self.calls + other.calls and len(self.durations) + len(other.durations) > RESERVOIR_SIZE:
+            # each side keeps a share of the reservoir proportional to the calls it sampled from
+            own = round(RESERVOIR_SIZE * self.calls / (self.calls + other.calls))
+            own = min(max(own, RESERVOIR_SIZE - len(other.durations)), len(self.durations))
+            self.durations = (self._random.sample(self.durations, own)
+                              + self._random.sample(other.durations, RESERVOIR_SIZE - own))
+        else:
+            self.durations = self.durations + other.durations
+        self.calls += other.calls
+        self.items += other.items
+        self.hits += other.hits
+        self.misses += other.misses
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def summary(self) -> dict:
+        summary = {"calls": self.calls, "items": self.items}
+        if self.durations:
+            total = self.total * 1000
+            p50, p90, p99 = np.percentile(np.array(self.durations) * 1000, [50, 90, 99])
+            summary.update(total_s=self.total, mean_ms=total / self.calls, p50_ms=float(p50),
+                           p90_ms=float(p90), p99_ms=float(p99), max_ms=self.max * 1000,
+                           items_per_s=self.items / total * 1000 if total else None)
+        if self.hits or self.misses:
+            summary.update(hits=self.hits, misses=self.misses, hit_rate=self.hits / (self.hits + self.misses))
+        return summary
+
+
+def _stage(name: str) -> StageStats:
+    stats = _stages.get(name)
+    if stats is None:
+        stats = _stages.setdefault(name, StageStats())
+    return stats
+
+
+class _Timer:
+    __slots__ = ("name", "items", "start")
+
+    def __init__(self, name: str, items: int):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            _stage(self.name).add(elapsed, self.items)
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    @property
+    def items(self) -> int:
+        return 0
+
+    @items.setter
+    def items(self, value):
+        # shared by every thread, so call sites can set items without checking enabled()
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def timer(name: str, items=1):
+    """
+    Context manager timing one call of stage name that processed items items.
+    A shared no-op when instrumentation is disabled.
+    """
+    if not _enabled:
+        return _NO_TIMER
+    return _Timer(name, items)
+
+
+def count(name: str, items=0, hits=0, misses=0):
+    """
+    Adds items and cache hits/misses to stage name without timing it.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        stats = _stage(name)
+        stats.items += items
+        stats.hits += hits
+        stats.misses += misses
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+
+
+def snapshot() -> dict[str, StageStats]:
+    """
+    Copy of the collected stats, picklable, so worker processes can send theirs to the parent.
+    """
+    with _lock:
+        copies = {}
+        for name, stats in _stages.items():
+            copies[name] = StageStats()
+            copies[name].merge(stats)
+        return copies
+
+
+def merge(stages: dict[str, StageStats]):
+    with _lock:
+        for name, stats in stages.items():
+            _stage(name).merge(stats)
+
+
+@contextmanager
+def profile(reset_stats=True):
+    """
+    Enables instrumentation inside the block and yields the live stats, the previous state is restored after.
+    """
+    was_enabled = _enabled
+    if reset_stats:
+        reset()
+    enable()
+    try:
+        yield _stages
+    finally:
+        if not was_enabled:
+            disable()
+
+
+def report() -> dict[str, dict]:
+    with _lock:
+        return {name: stats.summary() for name, stats in sorted(_stages.items())}
+
+
+def dump(path):
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=2)
+
+
+def print_report():
+    print(f"{'stage':32} {'calls':>9} {'items':>11} {'total s':>9} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}"
+          f" {'hit rate':>9}")
+    for name, summary in report().items():
+        hit_rate = f"{summary['hit_rate']:9.1%}" if "hit_rate" in summary else ""
+        if "total_s" in summary:
+            print(f"{name:32} {summary['calls']:9} {summary['items']:11} {summary['total_s']:9.3f} "
+                  f"{summary['mean_ms']:9.3f} {summary['p50_ms']:9.3f} {summary['p99_ms']:9.3f} {hit_rate}")
+        else:
+            print(f"{name:32} {summary['calls']:9} {summary['items']:11} {'':9} {'':9} {'':9} {'':9} {hit_rate}")
@@ -5,6 +5,8 @@ returns list or pd.DataFrame.
 
 import pandas as pd
 
+import fasta
+
 def load_csv(file_path: str, column_name: str) -> list[str]:
     """
     Returns list from specified column.
@@ -14,20 +16,8 @@ def load_csv(file_path: str, column_name: str) -> list[str]:
 
 
 def load_fasta(file_path: str) -> list[str]:
-    sequences = []
-    with open(file_path, 'r') as f:
-        current_seq = []
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith(">"):
-                if current_seq:
-                    sequences.append("".join(current_seq))
-                current_seq = []
-            else:
-                current_seq.append(line)
-        if current_seq:
-            sequences.append("".join(current_seq))
-    return sequences
+    """
+    Returns all sequences of a (gzipped) fasta file, use fasta.read_sequences to stream them.
+    """
+    return list(fasta.read_sequences(file_path))
 
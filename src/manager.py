@@ -27,6 +27,7 @@ import calculator
 import plotter
 from predictor import MacrelPredictor
 from hill_climber import climb_high
+from similarity_index import NoveltyFilter, SimilarityIndex
 
 ROOT_PATH = "../"
 
@@ -49,13 +50,10 @@ def generate_and_predict():
     """
     sequences = generator.generate_completions(dnv5, positions, num_completions=num_completions)
 
-    features = []
-    for sequence in sequences:
-        feat = calculator.macrel_descriptors_from_seq(sequence)
-        features.append(feat)
+    features = calculator.macrel_descriptors_from_seqs(sequences)
 
     macrel = MacrelPredictor()
-    predictions = macrel.predict_seqs(features)
+    predictions = macrel.predict_features(features)
 
     d = {"Sequence": sequences, "Macrel_prediction": predictions}
     df = pd.DataFrame(d)
@@ -79,6 +77,8 @@ def execute():
 
     # generating
     seqs = generator.generate_amphipatic_helices()
+    # drop rediscoveries of known AMPs
+    seqs = NoveltyFilter(SimilarityIndex.from_dbaasp(), min_distance=3)(seqs)
     if not seqs:
         print("No sequences found.")
     print(seqs)
@@ -0,0 +1,242 @@
+"""
+Compact batch of peptides: a uint8 matrix of residue codes (features.ALPHABET order, padded with features.PAD)
+and the sequence lengths. Mutation operators work on whole batches with NumPy indexing,
+strings are only built at the I/O boundaries with to_strings.
+Batches of sequences with residues outside ALPHABET also keep the original ASCII bytes in raw,
+so those sequences come back unchanged and the feature engines fall back to them like for strings.
+"""
+from typing import Iterator
+
+import numpy as np
+
+from features import ALPHABET, PAD, UNKNOWN, encode
+
+_LETTERS = np.full(256, ord("X"), dtype=np.uint8)
+_LETTERS[:len(ALPHABET)] = np.frombuffer(ALPHABET.encode(), dtype=np.uint8)
+
+
+def _ascii_matrix(sequences: list[str], width: int) -> np.ndarray:
+    matrix = np.full((len(sequences), width), PAD, dtype=np.uint8)
+    for row, seq in enumerate(sequences):
+        matrix[row, :len(seq)] = np.frombuffer(seq.encode("ascii", errors="replace"), dtype=np.uint8)
+    return matrix
+
+
+def residue_codes(residues) -> np.ndarray:
+    """
+    Codes of residues given as a string or a list of one-letter strings.
+    """
+    return encode(["".join(residues)])[0].reshape(-1)
+
+
+def _pad_column(matrix: np.ndarray) -> np.ndarray:
+    # one more column, so every sequence can grow by one residue
+    return np.concatenate([matrix, np.full((len(matrix), 1), PAD, dtype=np.uint8)], axis=1)
+
+
+def _shift_left(matrix: np.ndarray, rows: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Rows of matrix with the residue at positions removed, later residues move one column left.
+    """
+    left = np.concatenate([matrix[:, 1:], np.full((len(matrix), 1), PAD, dtype=np.uint8)], axis=1)
+    columns = np.arange(matrix.shape[1])
+    return np.where(columns >= positions[:, None], left[rows], matrix[rows])
+
+
+def _shift_right(matrix: np.ndarray, rows: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    Rows of matrix with residues from positions on moved one column right, the last column is dropped.
+    """
+    right = np.concatenate([np.full((len(matrix), 1), PAD, dtype=np.uint8), matrix[:, :-1]], axis=1)
+    columns = np.arange(matrix.shape[1])
+    return np.where(columns > positions[:, None], right[rows], matrix[rows])
+
+
+class PeptideBatch:
+    """
+    Peptides as an (n, width) uint8 matrix of residue codes and their lengths.
+    Columns after the end of a sequence hold PAD, residues outside ALPHABET are UNKNOWN.
+    raw is None, or the same matrix as ASCII bytes if some residues are UNKNOWN.
+    Accepted wherever the feature engines and predictors take a list of sequences.
+    """
+    __slots__ = ("matrix", "lengths", "raw")
+
+    def __init__(self, matrix: np.ndarray, lengths: np.ndarray, raw: np.ndarray = None):
+        self.matrix = matrix
+        self.lengths = lengths
+        self.raw = raw
+
+    @classmethod
+    def from_strings(cls, sequences) -> "PeptideBatch":
+        sequences = list(sequences)
+        matrix, lengths = encode(sequences)
+        raw = _ascii_matrix(sequences, matrix.shape[1]) if (matrix == UNKNOWN).any() else None
+        return cls(matrix, lengths, raw)
+
+    @classmethod
+    def concat(cls, batches: list["PeptideBatch"]) -> "PeptideBatch":
+        width = max((batch.width for batch in batches), default=0)
+        matrix = np.full((sum(len(batch) for batch in batches), width), PAD, dtype=np.uint8)
+        raw = np.full_like(matrix, PAD) if any(batch.raw is not None for batch in batches) else None
+        start = 0
+        for batch in batches:
+            matrix[start:start + len(batch), :batch.width] = batch.matrix
+            if raw is not None:
+                raw[start:start + len(batch), :batch.width] = batch._letters()
+            start += len(batch)
+        return cls(matrix, np.concatenate([batch.lengths for batch in batches]).astype(np.int64), raw)
+
+    @property
+    def width(self) -> int:
+        return self.matrix.shape[1]
+
+    def encoded(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Matrix trimmed to the longest sequence and the lengths, as features.encode returns them.
+        """
+        width = int(self.lengths.max()) if len(self.lengths) else 0
+        return self.matrix[:, :width], self.lengths
+
+    def _letters(self) -> np.ndarray:
+        return _LETTERS[self.matrix] if self.raw is None else self.raw
+
+    def to_strings(self) -> list[str]:
+        """
+        Decodes all sequences with one bytes decode, residues outside ALPHABET come back from raw.
+        """
+        if (self.lengths == self.width).all():
+            width = self.width
+            text = self._letters().tobytes().decode("ascii", errors="replace")
+            return [text[start:start + width] for start in range(0, len(text), width)] if width else [""] * len(self)
+        columns = np.arange(self.width)
+        letters = self._letters()[columns < self.lengths[:, None]]
+        text = letters.tobytes().decode("ascii", errors="replace")
+        ends = np.cumsum(self.lengths).tolist()
+        return [text[end - length:end] for end, length in zip(ends, self.lengths.tolist())]
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.to_strings())
+
+    def __getitem__(self, index):
+        """
+        A str for an integer index, a PeptideBatch for slices, masks and index arrays.
+        """
+        if isinstance(index, (int, np.integer)):
+            return self[[index]].to_strings()[0]
+        return PeptideBatch(self.matrix[index], self.lengths[index], None if self.raw is None else self.raw[index])
+
+    def __repr__(self):
+        return f"PeptideBatch(n={len(self)}, width={self.width})"
+
+    def _rows(self, rows) -> tuple[np.ndarray, np.ndarray]:
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        return rows, self.lengths[rows]
+
+    def substitute(self, rows, positions, codes) -> "PeptideBatch":
+        """
+        Mutants with codes[i] at positions[i] of sequence rows[i] (rows=None for one mutant per sequence).
+        """
+        rows, lengths = self._rows(rows)
+        positions = np.asarray(positions, dtype=np.int64)
+        if (positions >= lengths).any():
+            raise IndexError("Substitution position after the end of the sequence")
+        matrix = self.matrix[rows]
+        matrix[np.arange(len(rows)), positions] = codes
+        raw = None
+        if self.raw is not None:
+            raw = self.raw[rows]
+            raw[np.arange(len(rows)), positions] = _LETTERS[codes]
+        return PeptideBatch(matrix, lengths.copy(), raw)
+
+    def insert(self, rows, positions, codes) -> "PeptideBatch":
+        """
+        Mutants with codes[i] inserted before positions[i] of sequence rows[i], positions may equal the length.
+        """
+        rows, lengths = self._rows(rows)
+        positions = np.asarray(positions, dtype=np.int64)
+        if (positions > lengths).any():
+            raise IndexError("Insertion position after the end of the sequence")
+        matrix = _shift_right(_pad_column(self.matrix), rows, positions)
+        matrix[np.arange(len(rows)), positions] = codes
+        raw = None
+        if self.raw is not None:
+            raw = _shift_right(_pad_column(self.raw), rows, positions)
+            raw[np.arange(len(rows)), positions] = _LETTERS[codes]
+        return PeptideBatch(matrix, lengths + 1, raw)
+
+    def delete(self, rows, positions) -> "PeptideBatch":
+        """
+        Mutants without the residue at positions[i] of sequence rows[i].
+        """
+        rows, lengths = self._rows(rows)
+        positions = np.asarray(positions, dtype=np.int64)
+        if (positions >= lengths).any():
+            raise IndexError("Deletion position after the end of the sequence")
+        raw = None if self.raw is None else _shift_left(self.raw, rows, positions)
+        return PeptideBatch(_shift_left(self.matrix, rows, positions), lengths - 1, raw)
+
+    def neighbourhood(self, alphabet="ADEFGHIKLMNPQRSTVWY", substitutions=True, insertions=True,
+                      deletions=True) -> tuple["PeptideBatch", np.ndarray]:
+        """
+        All distinct single-edit neighbours of every sequence, in the order of generator.iter_neighbors:
+        per position the deletion (only of the first residue of a run), then per residue of alphabet
+        the substitution and the insertion in front of it (both only for residues that differ).
+        Memory is about n * width * (1 + 2 * len(alphabet)) * width bytes.
+        Returns:
+            PeptideBatch: Neighbours of all sequences.
+            np.ndarray: Index of the parent sequence of every neighbour.
+        """
+        codes = residue_codes(alphabet)
+        n, width = self.matrix.shape
+        current = self.matrix[:, :, None]
+        in_sequence = (np.arange(width) < self.lengths[:, None])[:, :, None]
+        differs = (codes[None, None, :] != current) & in_sequence
+
+        letters = self._letters()
+        first_of_run = np.ones((n, width), dtype=bool)
+        first_of_run[:, 1:] = letters[:, 1:] != letters[:, :-1]
+        first_of_run = first_of_run[:, :, None] & in_sequence
+
+        # one slot per operation: deletion, then substitution and insertion for every residue
+        slots = np.zeros((n, width, 1 + 2 * len(codes)), dtype=bool)
+        slots[:, :, :1] = first_of_run & deletions
+        slots[:, :, 1::2] = differs & substitutions
+        slots[:, :, 2::2] = differs & insertions
+        rows, positions, slot = np.nonzero(slots)
+        kinds = np.where(slot == 0, 0, 2 - slot % 2)  # 0 delete, 1 substitute, 2 insert
+        residue = codes[np.maximum(slot - 1, 0) // 2]
+
+        deleted = np.flatnonzero(kinds == 0)
+        inserted = np.flatnonzero(kinds == 2)
+        edited = np.flatnonzero(kinds > 0)
+
+        def edit(source: np.ndarray, values: np.ndarray) -> np.ndarray:
+            padded = _pad_column(source)
+            matrix = padded[rows]
+            matrix[deleted] = _shift_left(padded, rows[deleted], positions[deleted])
+            matrix[inserted] = _shift_right(padded, rows[inserted], positions[inserted])
+            matrix[edited, positions[edited]] = values[edited]
+            return matrix
+
+        lengths = self.lengths[rows] + (kinds == 2) - (kinds == 0)
+        raw = None if self.raw is None else edit(self.raw, _LETTERS[residue])
+        return PeptideBatch(edit(self.matrix, residue), lengths, raw), rows
+
+    def unique(self) -> tuple["PeptideBatch", np.ndarray]:
+        """
+        Distinct sequences in order of first occurrence and the index of their first occurrence.
+        """
+        matrix, _ = self.encoded()
+        if self.raw is not None:
+            # residues outside ALPHABET all share the UNKNOWN code, the raw bytes tell them apart
+            columns = np.arange(matrix.shape[1])
+            matrix = np.where(columns < self.lengths[:, None], self.raw[:, :matrix.shape[1]], PAD)
+        matrix = np.ascontiguousarray(matrix, dtype=np.uint8)
+        keys = matrix.view(np.dtype((np.void, matrix.shape[1]))).ravel() if matrix.shape[1] else \
+            np.zeros(len(self), dtype=np.uint8)
+        _, first = np.unique(keys, return_index=True)
+        first.sort()
+        return self[first], first
@@ -1,16 +1,172 @@
-from modlamp.plot import helical_wheel
+"""
+Helical wheel plots of peptides, drawn with modlamp.plot.helical_wheel.
+Batches are rendered headless (Agg backend) in a pool of processes into content-hashed files,
+so sequences already rendered with the same settings are skipped, optionally tiled into contact sheets.
+"""
+import argparse
+import hashlib
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+SHEET_COLUMNS = 5
+SHEET_ROWS = 4
+
 
 # Generate the plot
 # moment=True will draw an arrow showing the direction of the hydrophobic moment
-def save_helical_wheel(seq: str, path):
-    helical_wheel(seq, moment=True, filename=path)
+def save_helical_wheel(seq: str, path, moment=True):
+    from modlamp.plot import helical_wheel  # matplotlib and scikit-learn, imported on first use
+    import matplotlib.pyplot as plt
+    try:
+        helical_wheel(seq, moment=moment, filename=path)
+    finally:
+        # helical_wheel leaves its figure open
+        plt.close("all")
+
+
+def _init_headless():
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+
+
+def _save_atomic(path: Path, draw):
+    # a killed render must not leave a file that later runs would skip
+    tmp = path.with_name(f"{path.stem}.{os.getpid()}.tmp{path.suffix}")
+    try:
+        draw(tmp)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _render_wheels(jobs: list[tuple[str, str]], moment: bool) -> int:
+    for seq, path in jobs:
+        _save_atomic(Path(path), lambda tmp: save_helical_wheel(seq, str(tmp), moment))
+    return len(jobs)
+
+
+def _render_sheet(job: tuple[list[tuple[str, str, str]], str], columns: int) -> int:
+    import matplotlib.pyplot as plt
+    records, path = job
+    rows = math.ceil(len(records) / columns)
+    fig, axes = plt.subplots(rows, columns, figsize=(columns * 3, rows * 3.3), squeeze=False)
+    try:
+        for ax in axes.flat:
+            ax.axis("off")
+        for ax, (name, seq, wheel) in zip(axes.flat, records):
+            # every 4th pixel is plenty for a 300 px tile
+            ax.imshow(plt.imread(wheel)[::4, ::4])
+            ax.set_title(f"{name}\n{seq}", fontsize=7)
+        fig.tight_layout()
+        _save_atomic(Path(path), lambda tmp: fig.savefig(tmp, dpi=100))
+    finally:
+        plt.close(fig)
+    return len(records)
+
 
+def _run(function, jobs: list, workers: int, **kwargs) -> int:
+    """
+    Calls function(job, **kwargs) for every job, in a pool of headless processes if workers > 1.
+    Returns:
+        int: Sum of the results.
+    """
+    from functools import partial
+    function = partial(function, **kwargs)
+    if workers == -1:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        return sum(map(function, jobs))
+    with ProcessPoolExecutor(workers, initializer=_init_headless) as executor:
+        return sum(executor.map(function, jobs))
 
-def save_helical_wheels(seqs: list[str], path, names=[]):
+
+def _content_hash(*parts) -> str:
+    return hashlib.sha1("\n".join(map(str, parts)).encode()).hexdigest()[:16]
+
+
+def wheel_path(seq: str, folder, moment=True) -> Path:
+    """
+    File of the wheel of seq in folder, named after the hash of the sequence and the plot settings.
+    """
+    return Path(folder) / f"wheel_{_content_hash(seq, moment)}.png"
+
+
+def render_helical_wheels(seqs: list[str], folder, workers=-1, moment=True, overwrite=False,
+                          chunk_size=16) -> dict[str, Path]:
+    """
+    Renders the wheels of all distinct sequences into folder, existing files are kept unless overwrite.
+    Args:
+        workers (int): Rendering processes, -1 for all cpus.
+        chunk_size (int): Wheels rendered per task.
+    Returns:
+        dict: Sequence -> file of its wheel, sequences shorter than 2 residues are left out.
+    """
+    folder = Path(folder)
+    folder.mkdir(exist_ok=True, parents=True)
+    paths = {seq: wheel_path(seq, folder, moment) for seq in dict.fromkeys(seqs) if len(seq) > 1}
+    todo = [(seq, str(path)) for seq, path in paths.items() if overwrite or not path.exists()]
+    jobs = [todo[start:start + chunk_size] for start in range(0, len(todo), chunk_size)]
+    rendered = _run(_render_wheels, jobs, workers, moment=moment)
+    print(f"Rendered {rendered} helical wheels, {len(paths) - rendered} already in {folder}")
+    return paths
+
+
+def render_contact_sheets(seqs: list[str], folder, names: list[str] = None, columns=SHEET_COLUMNS,
+                          rows=SHEET_ROWS, workers=-1, moment=True, overwrite=False) -> list[Path]:
+    """
+    Tiles the wheels of seqs into sheets of rows x columns wheels, titled with the name and sequence.
+    The wheels are rendered (or reused) with render_helical_wheels in the same folder first.
+    A sheet is named after the hash of its wheels and layout, so only sheets with new content are rendered.
+    Returns:
+        list[Path]: Sheets in the order of seqs.
+    """
+    folder = Path(folder)
+    wheels = render_helical_wheels(seqs, folder, workers, moment, overwrite)
+    names = names or [f"seq_{i}" for i in range(len(seqs))]
+    records = [(str(name), seq, str(wheels[seq])) for name, seq in zip(names, seqs) if seq in wheels]
+    per_sheet = columns * rows
+    jobs = []
+    for start in range(0, len(records), per_sheet):
+        sheet = records[start:start + per_sheet]
+        key = _content_hash(columns, moment, *(part for name, seq, _ in sheet for part in (name, seq)))
+        path = folder / f"sheet_{key}.png"
+        jobs.append((sheet, str(path)))
+    todo = [job for job in jobs if overwrite or not Path(job[1]).exists()]
+    _run(_render_sheet, todo, workers, columns=columns)
+    print(f"Rendered {len(todo)} contact sheets, {len(jobs) - len(todo)} already in {folder}")
+    return [Path(path) for _, path in jobs]
+
+
+def save_helical_wheels(seqs: list[str], path, names=[], workers=1):
     if not names:
         names = range(0, len(seqs))
-    for seq, name in zip(seqs, names):
-        if len(seq)>1:
-            save_helical_wheel(seq, path + f"seq_{name}")
+    jobs = [[(seq, path + f"seq_{name}.png")] for seq, name in zip(seqs, names) if len(seq) > 1]
+    _run(_render_wheels, jobs, workers, moment=True)
+
 
+if __name__ == "__main__":
+    import fasta
+    parser = argparse.ArgumentParser(description="Render helical wheels of the peptides of a FASTA file")
+    parser.add_argument("input", help="FASTA file with the peptides")
+    parser.add_argument("--output", default="wheels", help="Folder for the images")
+    parser.add_argument("--top", type=int, help="Only the first top peptides")
+    parser.add_argument("--sheets", action="store_true", help="Tile the wheels into contact sheets")
+    parser.add_argument("--columns", type=int, default=SHEET_COLUMNS, help="Wheels per sheet row")
+    parser.add_argument("--rows", type=int, default=SHEET_ROWS, help="Wheel rows per sheet")
+    parser.add_argument("--no_moment", action="store_true", help="Do not draw the hydrophobic moment")
+    parser.add_argument("--workers", type=int, default=-1, help="Rendering processes, -1 for all cpus")
+    parser.add_argument("--overwrite", action="store_true", help="Render files that already exist again")
+    args = parser.parse_args()
 
+    records = list(fasta.read_fasta(args.input))[:args.top]
+    names = [name for name, _ in records]
+    seqs = [seq for _, seq in records]
+    if args.sheets:
+        sheets = render_contact_sheets(seqs, args.output, names, args.columns, args.rows, args.workers,
+                                       not args.no_moment, args.overwrite)
+        print("\n".join(dict.fromkeys(str(sheet) for sheet in sheets)))
+    else:
+        render_helical_wheels(seqs, args.output, args.workers, not args.no_moment, args.overwrite)
@@ -1,32 +1,135 @@
 """
 Loads macrel onnx model and predicts peptide properties.
+Sessions are kept in a process-wide registry, so every model is decompressed and loaded only once.
+onnxruntime is imported with the first session and calculator (whose predictors subclass Predictor)
+with the first prediction, so importing this module is cheap and free of import cycles.
 """
+from __future__ import annotations
 
 import gzip
+import hashlib
+import os
+import threading
 from abc import abstractmethod, ABC
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
-import onnxruntime as ort
 import numpy as np
 from pathlib import Path
 
-import calculator
+import instrumentation
+
+if TYPE_CHECKING:
+    import onnxruntime as ort
 
 MODEL_PATH = Path(__file__).parents[1] / "models/macrel.onnx.gz"
 
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def model_digest(model_path) -> str:
+    """
+    sha256 of the (gzipped) model file.
+    """
+    return hashlib.sha256(Path(model_path).read_bytes()).hexdigest()
+
+
+def read_model(model_path=MODEL_PATH, cache_dir=None) -> bytes:
+    """
+    Returns the decompressed ONNX model.
+    With cache_dir, the decompressed model is stored there and later processes read it directly.
+    """
+    model_path = Path(model_path)
+    if model_path.suffix != ".gz":
+        return model_path.read_bytes()
+    if cache_dir is None:
+        with gzip.open(model_path, 'rb') as f:
+            return f.read()
+
+    cached = Path(cache_dir) / f"{model_path.stem.removesuffix('.onnx')}.{model_digest(model_path)[:16]}.onnx"
+    if cached.exists():
+        return cached.read_bytes()
+    with gzip.open(model_path, 'rb') as f:
+        model_bytes = f.read()
+    cached.parent.mkdir(exist_ok=True, parents=True)
+    tmp = cached.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_bytes(model_bytes)
+    os.replace(tmp, cached)
+    return model_bytes
+
+
+def load_session(model_path=MODEL_PATH, intra_op_num_threads=0, inter_op_num_threads=0,
+                 graph_optimization_level: ort.GraphOptimizationLevel = None,
+                 cache_dir=None) -> ort.InferenceSession:
+    """
+    Returns the shared InferenceSession of a model, created on the first call for each model and options.
+    InferenceSession.run is thread-safe, so one session serves all predictors of the process.
+    Args:
+        model_path: ONNX model, gzipped or not.
+        intra_op_num_threads (int): Threads of one ONNX run, 0 lets onnxruntime use all cores.
+        inter_op_num_threads (int): Threads running independent graph nodes, 0 for onnxruntime's default.
+        graph_optimization_level (ort.GraphOptimizationLevel): Graph optimizations applied on load,
+            None for ORT_ENABLE_ALL.
+        cache_dir: Optional directory for the decompressed model, see read_model.
+    """
+    import onnxruntime as ort
+    if graph_optimization_level is None:
+        graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    key = (str(Path(model_path).resolve()), intra_op_num_threads, inter_op_num_threads,
+           int(graph_optimization_level))
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = intra_op_num_threads
+            options.inter_op_num_threads = inter_op_num_threads
+            options.graph_optimization_level = graph_optimization_level
+            session = ort.InferenceSession(read_model(model_path, cache_dir), options,
+                                           providers=['CPUExecutionProvider'])
+            _sessions[key] = session
+    return session
+
 
 class Predictor(ABC):
     @abstractmethod
     def calculate_and_predict_seqs(self, sequences: list[str]) -> list[float]:
         pass
 
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies the scoring function, scores cached under one fingerprint are interchangeable.
+        """
+        return self.__class__.__name__
+
+    def calculate_and_predict_substitutions(self, sequence: str, positions: list[int],
+                                            residues: list[str]) -> list[float]:
+        """
+        Predicts single-point mutants of sequence with residues[i] at positions[i].
+        Predictors with an incremental feature path override this.
+        """
+        mutants = [sequence[:pos] + aa + sequence[pos + 1:] for pos, aa in zip(positions, residues)]
+        return self.calculate_and_predict_seqs(mutants)
 
-class MacrelPredictor(Predictor):
-    def __init__(self, model_path=MODEL_PATH):
-        with gzip.open(model_path, 'rb') as f:
-            model_bytes = f.read()
 
-        self._model = ort.InferenceSession(model_bytes, providers=['CPUExecutionProvider'])
+class MacrelPredictor(Predictor):
+    def __init__(self, model_path=MODEL_PATH, intra_op_num_threads=0, inter_op_num_threads=0,
+                 graph_optimization_level: ort.GraphOptimizationLevel = None, cache_dir=None):
+        """
+        Args:
+            model_path: gzipped macrel ONNX model.
+            intra_op_num_threads, inter_op_num_threads, graph_optimization_level, cache_dir: see load_session.
+        """
+        self._model = load_session(model_path, intra_op_num_threads, inter_op_num_threads,
+                                   graph_optimization_level, cache_dir)
         self._input_name = self._model.get_inputs()[0].name
+        self._model_path = Path(model_path)
+
+    @property
+    def fingerprint(self) -> str:
+        return f"{self.__class__.__name__}:{model_digest(self._model_path)}"
 
     def predict_seq(self, features: np.ndarray) -> np.ndarray:
         """
@@ -37,7 +140,8 @@ class MacrelPredictor(Predictor):
             np.ndarray: Predicted properties.
         """
         inputs = {self._input_name: features}
-        outputs = self._model.run(None, inputs)
+        with instrumentation.timer("onnx.run", len(features)):
+            outputs = self._model.run(None, inputs)
         return outputs[1]
 
     def predict_seqs(self, features_list: list[np.ndarray]) -> list:
@@ -49,9 +153,34 @@ class MacrelPredictor(Predictor):
             list of floats (proba of AMP)
         """
         all_features = np.vstack(features_list)
-        raw_results = self.predict_seq(all_features)
+        return self.predict_features(all_features)
+
+    def predict_features(self, features: np.ndarray) -> list:
+        """
+        Predicts peptide properties for a feature matrix.
+        Args:
+            np.ndarray of shape (n_samples, 22) (features)
+        Returns:
+            list of floats (proba of AMP)
+        """
+        raw_results = self.predict_seq(features)
         return [round(p["AMP"], 2) for p in raw_results]
 
+    def predict_matrix(self, features: np.ndarray, batch_size=65536) -> np.ndarray:
+        """
+        Predicts a feature matrix slice by slice, e.g. rows of a memory-mapped feature_store.FeatureStore,
+        only one slice at a time is copied into memory.
+        Args:
+            np.ndarray of shape (n_samples, 22) (features), int (rows per ONNX run)
+        Returns:
+            np.ndarray of n_samples floats (proba of AMP, rounded like predict_features)
+        """
+        scores = np.empty(len(features))
+        for start in range(0, len(features), batch_size):
+            batch = np.ascontiguousarray(features[start:start + batch_size], dtype=np.float32)
+            scores[start:start + len(batch)] = self.predict_features(batch)
+        return scores
+
     def calculate_and_predict_seq(self, sequence: str) -> float:
         """
         Calculates descriptors and predicts from aa sequence.
@@ -60,6 +189,7 @@ class MacrelPredictor(Predictor):
         Returns:
             float (proba of AMP)
         """
+        import calculator
         features = calculator.macrel_descriptors_from_seq(sequence)
         return round(self.predict_seq(features)[0]["AMP"], 3)
 
@@ -71,5 +201,21 @@ class MacrelPredictor(Predictor):
         Returns:
             list of floats (proba of AMP)
         """
-        features_list = [calculator.macrel_descriptors_from_seq(seq) for seq in sequences]
-        return self.predict_seqs(features_list)
+        if not sequences:
+            return []
+        import calculator
+        return self.predict_features(calculator.macrel_descriptors_from_seqs(sequences))
+
+    def calculate_and_predict_substitutions(self, sequence: str, positions: list[int],
+                                            residues: list[str]) -> list[float]:
+        """
+        Predicts single-point mutants of sequence, features are updated from the parent's cached state.
+        Args:
+            str (parent seq), list of int (positions), list of str (new residues)
+        Returns:
+            list of floats (proba of AMP)
+        """
+        if not len(positions):
+            return []
+        import calculator
+        return self.predict_features(calculator.macrel_descriptors_of_substitutions(sequence, positions, residues))
@@ -0,0 +1,137 @@
+"""
+Persistent sequence -> score cache for Predictor implementations.
+Scores live in a local SQLite file keyed by sequence and the predictor's fingerprint,
+recently used ones are also kept in an in-memory LRU.
+"""
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from pydantic import BaseModel
+
+import instrumentation
+from predictor import Predictor
+
+CACHE_PATH = Path(__file__).parents[1] / "cache/scores.sqlite"
+SQLITE_MAX_VARIABLES = 900
+
+
+class CacheStats(BaseModel):
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    @property
+    def lookups(self) -> int:
+        return self.memory_hits + self.disk_hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return (self.memory_hits + self.disk_hits) / self.lookups if self.lookups else 0.0
+
+
+class ScoreStore:
+    """
+    SQLite table of scores with an LRU of at most memory_size entries in front of it.
+    Safe to share between threads, several processes can use the same file.
+    """
+    def __init__(self, path=CACHE_PATH, memory_size=100_000):
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS scores (fingerprint TEXT, sequence TEXT, score REAL, "
+                         "PRIMARY KEY (fingerprint, sequence)) WITHOUT ROWID")
+        self._db.commit()
+        self._memory = OrderedDict()
+        self._memory_size = memory_size
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def get_many(self, fingerprint: str, sequences) -> dict[str, float]:
+        """
+        Returns scores of the sequences that are cached, missing ones are left out.
+        """
+        found = {}
+        with self._lock:
+            for seq in sequences:
+                score = self._memory.get((fingerprint, seq))
+                if score is not None:
+                    self._memory.move_to_end((fingerprint, seq))
+                    found[seq] = score
+            self.stats.memory_hits += len(found)
+
+            missing = [seq for seq in sequences if seq not in found]
+            from_disk = {}
+            for start in range(0, len(missing), SQLITE_MAX_VARIABLES):
+                chunk = missing[start:start + SQLITE_MAX_VARIABLES]
+                rows = self._db.execute(
+                    f"SELECT sequence, score FROM scores WHERE fingerprint = ? "
+                    f"AND sequence IN ({','.join('?' * len(chunk))})", [fingerprint, *chunk])
+                from_disk.update(rows)
+            self.stats.disk_hits += len(from_disk)
+            self.stats.misses += len(missing) - len(from_disk)
+            self._remember(fingerprint, from_disk)
+        found.update(from_disk)
+        return found
+
+    def put_many(self, fingerprint: str, scores: dict[str, float]):
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?)",
+                                 [(fingerprint, seq, score) for seq, score in scores.items()])
+            self._db.commit()
+            self._remember(fingerprint, scores)
+
+    def _remember(self, fingerprint: str, scores: dict[str, float]):
+        for seq, score in scores.items():
+            self._memory[(fingerprint, seq)] = score
+            self._memory.move_to_end((fingerprint, seq))
+        while len(self._memory) > self._memory_size:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class CachedPredictor(Predictor):
+    """
+    Wraps any Predictor and only runs it for sequences that are not in the store yet.
+    """
+    def __init__(self, predictor: Predictor, path=CACHE_PATH, memory_size=100_000, store: ScoreStore = None):
+        self.predictor = predictor
+        self.store = store or ScoreStore(path, memory_size)
+
+    @property
+    def fingerprint(self) -> str:
+        return self.predictor.fingerprint
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.store.stats
+
+    def calculate_and_predict_seqs(self, sequences: list[str]) -> list[float]:
+        unique = list(dict.fromkeys(sequences))
+        scores = self.store.get_many(self.fingerprint, unique)
+        missing = [seq for seq in unique if seq not in scores]
+        instrumentation.count("score_cache", hits=len(scores), misses=len(missing))
+        if missing:
+            new_scores = dict(zip(missing, self.predictor.calculate_and_predict_seqs(missing)))
+            self.store.put_many(self.fingerprint, new_scores)
+            scores.update(new_scores)
+        return [scores[seq] for seq in sequences]
+
+    def calculate_and_predict_substitutions(self, sequence: str, positions: list[int],
+                                            residues: list[str]) -> list[float]:
+        mutants = [sequence[:pos] + aa + sequence[pos + 1:] for pos, aa in zip(positions, residues)]
+        scores = self.store.get_many(self.fingerprint, list(dict.fromkeys(mutants)))
+        missing = [i for i, mutant in enumerate(mutants) if mutant not in scores]
+        instrumentation.count("score_cache", hits=len(mutants) - len(missing), misses=len(missing))
+        if missing:
+            new_scores = self.predictor.calculate_and_predict_substitutions(
+                sequence, [positions[i] for i in missing], [residues[i] for i in missing])
+            new_scores = {mutants[i]: score for i, score in zip(missing, new_scores)}
+            self.store.put_many(self.fingerprint, new_scores)
+            scores.update(new_scores)
+        return [scores[mutant] for mutant in mutants]
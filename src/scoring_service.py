@@ -0,0 +1,272 @@
+"""
+Local scoring daemon: one warm Predictor behind an asyncio server on a Unix socket or localhost TCP port.
+Requests of concurrent clients are coalesced into micro-batches before the model runs.
+The protocol is one JSON object per line, {"sequences": [...]} is answered with {"scores": [...]}.
+RemotePredictor is the matching client, usable anywhere a Predictor is expected.
+"""
+import argparse
+import asyncio
+import json
+import signal
+import socket
+import threading
+import time
+from pathlib import Path
+
+from pydantic import BaseModel
+
+import calculator
+from predictor import MacrelPredictor, Predictor
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# longest request line the server reads, asyncio's default of 64 KiB is only about 2,000 peptides
+MAX_LINE_BYTES = 64 * 1024 * 1024
+# sequences per request sent by RemotePredictor, large inputs are split so each line stays well below the limit
+REQUEST_SIZE = 4096
+
+
+class ServiceStats(BaseModel):
+    requests: int = 0
+    sequences: int = 0
+    batches: int = 0
+    busy_seconds: float = 0.0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.sequences / self.batches if self.batches else 0.0
+
+
+class ScoringService:
+    """
+    Serves predictor over a socket, requests arriving within max_wait_ms of each other are scored together
+    as long as the batch stays below max_batch_size sequences.
+    """
+    def __init__(self, predictor: Predictor, max_batch_size=4096, max_wait_ms=5.0):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = ServiceStats()
+        self._queue = None
+
+    async def score(self, sequences: list[str]) -> list[float]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((sequences, future))
+        return await future
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(request)
+                size += len(request[0])
+
+            await self._score_batch(batch)
+
+    async def _score_batch(self, batch: list[tuple[list[str], asyncio.Future]]):
+        """
+        Scores the coalesced requests together. If that fails and there was more than one request,
+        they are scored one by one, so only the requests that fail themselves get the error.
+        """
+        loop = asyncio.get_running_loop()
+        sequences = [seq for request_sequences, _ in batch for seq in request_sequences]
+        start = time.perf_counter()
+        try:
+            # the model runs in a thread, so requests keep being queued meanwhile
+            scores = await loop.run_in_executor(None, self.predictor.calculate_and_predict_seqs, sequences)
+        except Exception as e:
+            if len(batch) > 1:
+                for request in batch:
+                    await self._score_batch([request])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.stats.busy_seconds += time.perf_counter() - start
+        self.stats.batches += 1
+        self.stats.sequences += len(sequences)
+        offset = 0
+        for request_sequences, future in batch:
+            if not future.done():
+                future.set_result(scores[offset:offset + len(request_sequences)])
+            offset += len(request_sequences)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    # the rest of the oversized line can't be told apart from the next request, so the
+                    # connection ends after the error
+                    writer.write(json.dumps({"error": f"request longer than {MAX_LINE_BYTES} bytes: {e}"})
+                                 .encode() + b"\n")
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("request must be a JSON object")
+                    op = request.get("op", "score")
+                    if op == "score":
+                        sequences = request.get("sequences")
+                        if not isinstance(sequences, list) or not all(isinstance(seq, str) for seq in sequences):
+                            raise ValueError("sequences must be a list of strings")
+                        self.stats.requests += 1
+                        response = {"scores": await self.score(sequences)}
+                    elif op == "fingerprint":
+                        response = {"fingerprint": self.predictor.fingerprint}
+                    elif op == "stats":
+                        response = {"stats": self.stats.model_dump()}
+                    else:
+                        response = {"error": f"unknown op {op}"}
+                except Exception as e:
+                    response = {"error": f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT, ready: threading.Event = None):
+        """
+        Serves forever on the Unix socket socket_path, or on host:port if socket_path is None.
+        """
+        self._queue = asyncio.Queue()
+        batcher = asyncio.create_task(self._batcher())
+        if socket_path:
+            server = await asyncio.start_unix_server(self._handle, path=str(socket_path), limit=MAX_LINE_BYTES)
+        else:
+            server = await asyncio.start_server(self._handle, host, port, limit=MAX_LINE_BYTES)
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if socket_path:
+                Path(socket_path).unlink(missing_ok=True)
+
+
+class RemotePredictor(Predictor):
+    """
+    Client of a ScoringService. Every thread keeps its own connection, so one instance can be
+    shared by threads like the HillClimber in hill_climber.py.
+    """
+    def __init__(self, socket_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=600.0,
+                 request_size=REQUEST_SIZE):
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.request_size = request_size
+        self._local = threading.local()
+        self._fingerprint = None
+
+    @classmethod
+    def from_address(cls, address: str, **kwargs) -> "RemotePredictor":
+        """
+        host:port for TCP, anything else is taken as a Unix socket path.
+        """
+        host, _, port = address.rpartition(":")
+        if host and port.isdigit():
+            return cls(host=host, port=int(port), **kwargs)
+        return cls(socket_path=address, **kwargs)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self.socket_path:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                sock.connect(str(self.socket_path))
+            else:
+                sock = socket.create_connection((self.host, self.port), self.timeout)
+            connection = self._local.connection = (sock, sock.makefile("rb"))
+        return connection
+
+    def _request(self, request: dict) -> dict:
+        sock, reader = self._connection()
+        try:
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            line = reader.readline()
+        except OSError:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise ConnectionError("Scoring service closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Scoring service error: {response['error']}")
+        return response
+
+    @property
+    def fingerprint(self) -> str:
+        if self._fingerprint is None:
+            self._fingerprint = self._request({"op": "fingerprint"})["fingerprint"]
+        return self._fingerprint
+
+    def stats(self) -> ServiceStats:
+        return ServiceStats(**self._request({"op": "stats"})["stats"])
+
+    def calculate_and_predict_seqs(self, sequences: list[str]) -> list[float]:
+        sequences = list(sequences)
+        scores = []
+        for start in range(0, len(sequences), self.request_size):
+            scores += self._request({"sequences": sequences[start:start + self.request_size]})["scores"]
+        return scores
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+            self._local.connection = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a peptide scorer to local clients")
+    parser.add_argument("--socket", type=str, help="Unix socket path (default: TCP on --host and --port)")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--scorer", choices=["macrel", "killer"], default="killer",
+                        help="MacrelPredictor or AMPKillerPredictor")
+    parser.add_argument("--max_batch_size", type=int, default=4096, help="Maximal sequences scored at once")
+    parser.add_argument("--max_wait_ms", type=float, default=5.0,
+                        help="How long the first request of a batch waits for others")
+    parser.add_argument("--intra_op_num_threads", type=int, default=0, help="ONNX threads, 0 for all cores")
+    args = parser.parse_args()
+
+    scorer = MacrelPredictor(intra_op_num_threads=args.intra_op_num_threads)
+    if args.scorer == "killer":
+        scorer = calculator.AMPKillerPredictor(scorer)
+    service = ScoringService(scorer, args.max_batch_size, args.max_wait_ms)
+    print(f"Serving {scorer.fingerprint} on {args.socket or f'{args.host}:{args.port}'}", flush=True)
+
+    async def main():
+        serving = asyncio.current_task()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, serving.cancel)
+        await service.serve(args.socket, args.host, args.port)
+
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        pass
+    print(f"Stopped after {service.stats}")
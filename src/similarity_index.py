@@ -0,0 +1,301 @@
+"""
+Similarity search of peptides against known ones (DBAASP, FASTA libraries), e.g. to drop rediscoveries.
+Indexed sequences are split into k-mers kept in an inverted index (CSR arrays of k-mer -> sequences).
+A candidate within edit distance d of a query of length m has to share at least max(m, n) - k + 1 - k * d
+k-mers with it (q-gram lemma) and differ in length by at most d, only candidates passing both filters
+are verified with a bounded Hamming or Levenshtein distance.
+"""
+import argparse
+from typing import Iterable
+
+import numpy as np
+from pydantic import BaseModel
+
+import fasta
+from features import PAD, UNKNOWN, encode
+
+K = 3
+_BASE = PAD + 1  # residue codes 0..19, unknown residues share code PAD
+METRICS = ("levenshtein", "hamming")
+
+
+class Match(BaseModel):
+    sequence: str
+    name: str
+    distance: int
+
+
+def hamming(a: str, b: str, max_distance: int) -> int:
+    """
+    Hamming distance of equally long a and b, max_distance + 1 as soon as it is exceeded.
+    """
+    if len(a) != len(b):
+        return max_distance + 1
+    distance = 0
+    for x, y in zip(a, b):
+        if x != y:
+            distance += 1
+            if distance > max_distance:
+                break
+    return distance
+
+
+def levenshtein(a: str, b: str, max_distance: int) -> int:
+    """
+    Levenshtein distance of a and b, max_distance + 1 if it is larger.
+    Only the band of 2 * max_distance + 1 diagonals is computed and rows stop once the whole band exceeds it.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if a == b:
+        return 0
+    over = max_distance + 1
+    previous = [j if j <= max_distance else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        low = max(1, i - max_distance)
+        high = min(len(b), i + max_distance)
+        current = [over] * (len(b) + 1)
+        current[0] = i if i <= max_distance else over
+        x = a[i - 1]
+        best = current[0]
+        for j in range(low, high + 1):
+            value = previous[j - 1] + (x != b[j - 1])
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            current[j] = value if value < over else over
+            if value < best:
+                best = value
+        if best > max_distance:
+            return over
+        previous = current
+    return min(previous[len(b)], over)
+
+
+def _kmer_codes(sequences: list[str], k: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Distinct k-mers of every sequence with their counts.
+    Returns:
+        np.ndarray: Row of every (row, k-mer) pair, sorted by k-mer and row.
+        np.ndarray: k-mer codes (base 21 numbers) of the pairs.
+        np.ndarray: How often the k-mer occurs in the sequence.
+    """
+    matrix, lengths = encode(sequences)
+    windows = matrix.shape[1] - k + 1
+    if windows <= 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    codes = matrix.astype(np.int64)
+    codes[codes == UNKNOWN] = PAD
+    kmers = np.zeros((len(sequences), windows), dtype=np.int64)
+    for offset in range(k):
+        kmers = kmers * _BASE + codes[:, offset:offset + windows]
+    valid = np.arange(windows) < (lengths - k + 1)[:, None]
+    rows = np.broadcast_to(np.arange(len(sequences))[:, None], kmers.shape)[valid]
+    keys = kmers[valid] * len(sequences) + rows
+    keys, counts = np.unique(keys, return_counts=True)
+    return keys % len(sequences), keys // len(sequences), counts
+
+
+class SimilarityIndex:
+    """
+    k-mer inverted index of distinct sequences with names.
+    Queries return the indexed sequences within max_distance, see query and query_batch.
+    """
+    def __init__(self, sequences: Iterable[str] = (), names: Iterable[str] = None, k=K):
+        if not 1 <= k <= 6:
+            raise ValueError("k must be between 1 and 6")
+        self.k = k
+        self.sequences = []
+        self.names = []
+        self._rows = {}
+        self.add(sequences, names)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __contains__(self, sequence: str):
+        return sequence in self._rows
+
+    def __repr__(self):
+        return f"SimilarityIndex(sequences={len(self)}, k={self.k})"
+
+    def add(self, sequences: Iterable[str], names: Iterable[str] = None):
+        """
+        Adds sequences that are not indexed yet (first name wins) and rebuilds the inverted index.
+        """
+        sequences = list(sequences)
+        names = list(names) if names is not None else [f"seq_{len(self) + i}" for i in range(len(sequences))]
+        for seq, name in zip(sequences, names):
+            if seq and seq not in self._rows:
+                self._rows[seq] = len(self.sequences)
+                self.sequences.append(seq)
+                self.names.append(name)
+        self._build()
+
+    def _build(self):
+        rows, kmers, counts = _kmer_codes(self.sequences, self.k)
+        self._kmers, starts = np.unique(kmers, return_index=True)
+        self._offsets = np.append(starts, len(kmers))
+        self._posting_rows = rows
+        self._posting_counts = counts
+        self._lengths = np.fromiter(map(len, self.sequences), dtype=np.int64, count=len(self.sequences))
+        # rows sorted by length, for candidates that share no k-mer with the query
+        self._by_length = np.argsort(self._lengths, kind="stable")
+        self._sorted_lengths = self._lengths[self._by_length]
+
+    @classmethod
+    def from_fasta(cls, paths: Iterable, k=K) -> "SimilarityIndex":
+        records = [record for path in paths for record in fasta.read_fasta(path)]
+        return cls([seq for _, seq in records], [header for header, _ in records], k)
+
+    @classmethod
+    def from_dbaasp(cls, k=K, fasta_paths: Iterable = ()) -> "SimilarityIndex":
+        """
+        Index of the DBAASP sequences named by their DBAASP name, plus the records of fasta_paths.
+        """
+        sequences, names = dbaasp_records()
+        index = cls(sequences, names, k)
+        for path in fasta_paths:
+            records = list(fasta.read_fasta(path))
+            index.add([seq for _, seq in records], [header for header, _ in records])
+        return index
+
+    def _candidates(self, kmers: np.ndarray, counts: np.ndarray, length: int, max_distance: int,
+                    metric: str) -> np.ndarray:
+        low, high = (length, length) if metric == "hamming" else (length - max_distance, length + max_distance)
+        threshold = length - self.k + 1 - self.k * max_distance
+        if threshold <= 0 or not len(kmers):
+            # the count filter cannot rule out sequences sharing no k-mer, take all of fitting length
+            return self._by_length[np.searchsorted(self._sorted_lengths, low):
+                                   np.searchsorted(self._sorted_lengths, high, side="right")]
+        positions = np.searchsorted(self._kmers, kmers)
+        positions = np.minimum(positions, len(self._kmers) - 1) if len(self._kmers) else positions
+        found = (self._kmers[positions] == kmers) if len(self._kmers) else np.zeros(len(kmers), dtype=bool)
+        starts = self._offsets[positions[found]]
+        ends = self._offsets[positions[found] + 1]
+        if not len(starts):
+            return np.zeros(0, dtype=np.int64)
+        sizes = ends - starts
+        postings = np.repeat(ends - sizes.cumsum(), sizes) + np.arange(sizes.sum())
+        rows = self._posting_rows[postings]
+        shared = np.minimum(self._posting_counts[postings], np.repeat(counts[found], sizes))
+        rows, inverse = np.unique(rows, return_inverse=True)
+        shared = np.bincount(inverse, weights=shared)
+        lengths = self._lengths[rows]
+        needed = np.maximum(lengths, length) - self.k + 1 - self.k * max_distance
+        return rows[(shared >= needed) & (lengths >= low) & (lengths <= high)]
+
+    def _verify(self, query: str, rows: np.ndarray, max_distance: int, metric: str, first=False) -> list[Match]:
+        distance = hamming if metric == "hamming" else levenshtein
+        matches = []
+        for row in np.sort(rows).tolist():
+            value = distance(query, self.sequences[row], max_distance)
+            if value <= max_distance:
+                matches.append(Match(sequence=self.sequences[row], name=self.names[row], distance=value))
+                if first:
+                    break
+        matches.sort(key=lambda match: match.distance)
+        return matches
+
+    def query_batch(self, queries: list[str], max_distance=2, metric="levenshtein", limit: int = None,
+                    first=False) -> list[list[Match]]:
+        """
+        Indexed sequences within max_distance of every query, nearest first (ties in index order).
+        Args:
+            metric (str): "levenshtein" (substitutions, insertions, deletions) or "hamming" (substitutions only).
+            limit (int): Return at most the limit nearest matches per query.
+            first (bool): Stop verifying a query at its first match, enough to tell whether there is one.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, use one of {METRICS}")
+        queries = list(queries)
+        results = [[] for _ in queries]
+        if not queries or not len(self):
+            return results
+        rows, kmers, counts = _kmer_codes(queries, self.k)
+        order = np.argsort(rows, kind="stable")
+        rows, kmers, counts = rows[order], kmers[order], counts[order]
+        bounds = np.searchsorted(rows, np.arange(len(queries) + 1))
+        for i, query in enumerate(queries):
+            start, end = bounds[i], bounds[i + 1]
+            candidates = self._candidates(kmers[start:end], counts[start:end], len(query), max_distance, metric)
+            matches = self._verify(query, candidates, max_distance, metric, first)
+            results[i] = matches[:limit] if limit else matches
+        return results
+
+    def query(self, query: str, max_distance=2, metric="levenshtein", limit: int = None) -> list[Match]:
+        """
+        Indexed sequences within max_distance of query, nearest first, see query_batch.
+        """
+        return self.query_batch([query], max_distance, metric, limit)[0]
+
+    def nearest(self, query: str, max_distance=2, metric="levenshtein") -> Match:
+        """
+        The nearest indexed sequence within max_distance, None if there is none.
+        """
+        matches = self.query(query, max_distance, metric)
+        return matches[0] if matches else None
+
+    def is_novel(self, queries: list[str], min_distance=3, metric="levenshtein") -> list[bool]:
+        """
+        True for queries with no indexed sequence closer than min_distance.
+        """
+        if min_distance <= 0:
+            return [True] * len(queries)
+        return [not matches for matches in self.query_batch(queries, min_distance - 1, metric, first=True)]
+
+
+class NoveltyFilter:
+    """
+    Filter stage keeping only sequences at least min_distance away from every indexed one,
+    e.g. NoveltyFilter(SimilarityIndex.from_dbaasp())(generator.generate_amphipatic_helices()).
+    """
+    def __init__(self, index: SimilarityIndex, min_distance=3, metric="levenshtein"):
+        self.index = index
+        self.min_distance = min_distance
+        self.metric = metric
+
+    def __call__(self, sequences: list[str]) -> list[str]:
+        sequences = list(sequences)
+        return [seq for seq, novel in zip(sequences, self.index.is_novel(sequences, self.min_distance, self.metric))
+                if novel]
+
+
+def dbaasp_records() -> tuple[list[str], list[str]]:
+    """
+    Distinct sequences of the DBAASP strain files and the DBAASP name of their first entry.
+    """
+    import pandas as pd
+    from DBAASP.DBAASP_loader import SOURCES, ROOT_PATH
+    frames = [pd.read_csv(ROOT_PATH / path, usecols=["NAME", "SEQUENCE"], keep_default_na=False, dtype=str)
+              for path in SOURCES.values()]
+    records = pd.concat(frames).drop_duplicates("SEQUENCE")
+    records = records[records["SEQUENCE"] != ""]
+    return records["SEQUENCE"].tolist(), records["NAME"].tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find known peptides similar to the query sequences")
+    parser.add_argument("queries", help="FASTA file with the query sequences")
+    parser.add_argument("--known", nargs="*", default=[], help="FASTA files indexed together with DBAASP")
+    parser.add_argument("--no_dbaasp", action="store_true", help="Index only the --known files")
+    parser.add_argument("--max_distance", type=int, default=2)
+    parser.add_argument("--metric", choices=METRICS, default="levenshtein")
+    parser.add_argument("--k", type=int, default=K, help="k-mer length of the index")
+    parser.add_argument("--novel", help="Write the queries without a match to this FASTA file")
+    args = parser.parse_args()
+
+    if args.no_dbaasp:
+        index = SimilarityIndex.from_fasta(args.known, args.k)
+    else:
+        index = SimilarityIndex.from_dbaasp(args.k, args.known)
+    records = list(fasta.read_fasta(args.queries))
+    matches = index.query_batch([seq for _, seq in records], args.max_distance, args.metric)
+    for (header, seq), found in zip(records, matches):
+        for match in found:
+            print(f"{header}\t{seq}\t{match.name}\t{match.sequence}\t{match.distance}")
+    print(f"{sum(map(bool, matches))} of {len(records)} queries within {args.max_distance} of {index}")
+    if args.novel:
+        fasta.write_fasta(args.novel, (record for record, found in zip(records, matches) if not found))